@@ -0,0 +1,187 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Benchmark suite for airspeed velocity (asv), see README.devel.md"""
+
+import heapq
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from cmiclassirot import kernels
+from cmiclassirot.propagate import Propagate
+from cmiclassirot.sample import Ensemble
+
+from .workloads import ensemble, reset, workloads
+
+
+
+class Derivative(object):
+    """Right-hand side of the equations of motion, `Propagate._derivative`"""
+
+    params = list(workloads)
+    param_names = ['top']
+
+    def setup(self, top):
+        workload = workloads[top]()
+        self.molecule = ensemble(workload, 1).molecules[0]
+        self.propagate = Propagate(Ensemble(0, workload['molecule']), workload['field'],
+                                   workload['timerange'], workload['dt_save'])
+        self.y = np.concatenate((self.molecule.pos[0].angle.elements, self.molecule.pos[0].velocity))
+        self.t = workload['field'].t_peak
+
+    def time_derivative(self, top):
+        self.propagate._derivative(self.t, self.y, self.molecule)
+
+    def track_derivative_rate(self, top):
+        n = 2000
+        starttime = time.perf_counter()
+        for i in range(n):
+            self.propagate._derivative(self.t, self.y, self.molecule)
+        return n / (time.perf_counter() - starttime)
+
+    track_derivative_rate.unit = 'calls/s'
+
+
+
+class Propagation(object):
+    """Full propagation of thermal ensembles, `Propagate.run`, with the scipy and batched backends"""
+
+    params = (list(workloads), [1, 4, 16], ['scipy', 'numpy', 'numba'])
+    param_names = ['top', 'N', 'backend']
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup(self, top, N, backend):
+        if not kernels.available(backend) and backend != 'scipy':
+            raise NotImplementedError
+        self.workload = workloads[top]()
+        self.ensemble = ensemble(self.workload, N)
+
+    def time_run(self, top, N, backend):
+        reset(self.ensemble)
+        Propagate(self.ensemble, self.workload['field'], self.workload['timerange'], self.workload['dt_save'],
+                  solver={'backend': backend})
+
+
+
+class Scheduling(object):
+    """Load balancing of a hot (20 K) Au-nanorod ensemble over the worker pool
+
+    Compares the static split of the ensemble (as `Pool.map`) with dynamic scheduling of single
+    molecules, unordered and ordered by estimated cost; `track_utilization` reports the fraction of
+    the pool's capacity that was used for propagation.
+
+    `track_makespan` does not depend on the cores of the benchmark machine: the molecules are
+    propagated in one process in the order of the schedule, and their measured run times are handed
+    out to `workers` simulated workers as they become idle. It reports the resulting run time
+    relative to that of a perfect balance of the same costs.
+
+    """
+
+    params = (['static', 'dynamic', 'velocity', 'pilot'], [32])
+    param_names = ['schedule', 'N']
+    number = 1
+    repeat = 3
+    timeout = 900
+    workers = 8
+
+    def setup(self, schedule, N):
+        self.workload = workloads['symmetric']()
+        self.ensemble = ensemble(self.workload, N)
+
+    def propagate(self, schedule, profile=False, processes=None):
+        reset(self.ensemble)
+        ordering = schedule if schedule in ('velocity', 'pilot') else None
+        return Propagate(self.ensemble, self.workload['field'], self.workload['timerange'],
+                         self.workload['dt_save'], schedule='static' if schedule == 'static' else 'dynamic',
+                         ordering=ordering, profile=profile, processes=processes)
+
+    def time_run(self, schedule, N):
+        self.propagate(schedule)
+
+    def track_utilization(self, schedule, N):
+        return self.propagate(schedule, profile=True).statistics.as_dict()['utilization']
+
+    track_utilization.unit = 'fraction'
+
+    def track_makespan(self, schedule, N):
+        # in one process, the molecules are propagated in the order in which they are handed out
+        statistics = self.propagate(schedule, profile=True, processes=1).statistics
+        costs = [stats['wall_time'] for stats in statistics.molecules]
+        size = -(-N // (4 * self.workers)) if schedule == 'static' else 1
+        workers = [0.] * self.workers
+        for start in range(0, N, size):
+            heapq.heappush(workers, heapq.heappop(workers) + sum(costs[start:start+size]))
+        return max(workers) / max(sum(costs) / self.workers, max(costs))
+
+    track_makespan.unit = 'relative'
+
+
+
+class Sampling(object):
+    """Creation of thermal ensembles, `Ensemble.__init__`"""
+
+    params = (list(workloads), [100, 1000])
+    param_names = ['top', 'N']
+
+    def setup(self, top, N):
+        self.workload = workloads[top]()
+
+    def time_ensemble(self, top, N):
+        ensemble(self.workload, N)
+
+
+
+class Storage(object):
+    """Writing and reading of propagated ensembles, `Ensemble._save` and `Ensemble._load`"""
+
+    params = [4, 16]
+    param_names = ['N']
+    number = 1
+    repeat = 3
+    timeout = 600
+
+    def setup_cache(self):
+        # propagate once and share the result between all storage benchmarks
+        directory = tempfile.mkdtemp()
+        for N in self.params:
+            workload = workloads['linear']()
+            e = ensemble(workload, N)
+            Propagate(e, workload['field'], workload['timerange'], workload['dt_save'])
+            e._save(os.path.join(directory, f'{N}.h5'))
+        return directory
+
+    def setup(self, directory, N):
+        self.filename = os.path.join(directory, f'{N}.h5')
+        self.ensemble = Ensemble(0, workloads['linear']()['molecule'])
+        self.ensemble._load(self.filename)
+        self.output = os.path.join(directory, f'{N}-save.h5')
+
+    def teardown(self, directory, N):
+        if os.path.exists(self.output):
+            os.remove(self.output)
+
+    def time_save(self, directory, N):
+        self.ensemble._save(self.output)
+
+    def time_load(self, directory, N):
+        Ensemble(0, workloads['linear']()['molecule'])._load(self.filename)
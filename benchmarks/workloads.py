@@ -0,0 +1,77 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Reference workloads of the benchmark suite
+
+The linear top is OCS in the 500 fs alignment pulse of `examples/OCS-impulsive-alignment.py`, the
+symmetric top is the 10 nm x 4 nm Au nanorod of `examples/Au20x2nm.py`, and the asymmetric top is the
+same nanorod flattened to a ribbon. The time ranges are shortened versions of the examples' ones.
+
+"""
+
+import math
+
+import numpy as np
+from scipy.constants import c, epsilon_0, h, pi, physical_constants
+
+from cmiclassirot.field import Field
+from cmiclassirot.sample import Ensemble, Molecule
+
+
+def ocs():
+    """OCS at 2 K in a 500 fs pulse of 10^13 W/cm^2"""
+    a0 = physical_constants['Bohr radius'][0]
+    P = np.diag([26.15, 26.15, 50.72]) * 4 * pi * epsilon_0 * a0**3
+    I = h / (8 * pi**2 * c * 0.20286e2)
+    I = np.diag([I, I, 0.])
+    field = Field(peak_intensity=1e13 * 1e4, FWHM=500e-15, t_peak=0.)
+    return {'molecule': Molecule(I, P), 'field': field, 'T': 2., 'timerange': (-2e-12, 8e-12),
+            'dt_save': 250e-15}
+
+
+def nanorod(asymmetric=False, T=20.):
+    """Au nanorod of 10 nm length and 2 nm radius in a 1 ns pulse of 10^11 W/cm^2"""
+    P = 1.e-30 * epsilon_0 * np.diag([5.646E5, 5.646E5, 4.860E6])
+    height, radius = 10e-9, 2e-9
+    mass = math.pi * radius**2 * height * 19.3e3
+    Ix = 1./12 * mass * (3*radius**2 + height**2)
+    Iz = 0.5*mass*radius**2
+    I = np.diag([Ix, 1.5*Ix if asymmetric else Ix, Iz])
+    field = Field(peak_intensity=1e15, FWHM=1e-9, t_peak=3e-9)
+    return {'molecule': Molecule(I, P), 'field': field, 'T': T, 'timerange': (0., 6e-9),
+            'dt_save': 1e-10}
+
+
+workloads = {'linear': ocs,
+             'symmetric': nanorod,
+             'asymmetric': lambda: nanorod(asymmetric=True)}
+
+
+def ensemble(workload, size, seed=1):
+    """Create a thermal ensemble of `size` molecules for the `workload` definition
+
+    The fixed `seed` gives identical initial conditions, and thus comparable timings, in all runs.
+
+    """
+    return Ensemble(size, workload['molecule'], T=workload['T'], t=workload['timerange'][0], seed=seed)
+
+
+def reset(ensemble):
+    """Reset all molecules of a propagated `ensemble` to their initial phase-space positions"""
+    for mol in ensemble.molecules:
+        mol.pos = mol.pos[:1]
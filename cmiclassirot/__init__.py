@@ -15,3 +15,4 @@
 # <http://www.gnu.org/licenses/>.
 
 __author__ = "Jochen Küpper <jochen.kuepper@cfel.de>"
+__version__ = "0.9.1"
@@ -0,0 +1,218 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+import cmiclassirot
+
+
+# default location and size limit of the on-disk cache
+default_directory = os.path.join(os.path.expanduser('~'), '.cache', 'cmiclassirot')
+default_max_size = 10 * 1024**3
+
+
+
+def _update_hash(h, obj):
+    """Feed a canonical representation of `obj` into the hash object `h`
+
+    Supports (nested) dictionaries, sequences, `ndarray`s and scalars; floating-point data is hashed
+    by its exact binary representation.
+
+    """
+    if isinstance(obj, dict):
+        h.update(b'dict')
+        for key in sorted(obj):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'list%d' % len(obj))
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, np.ndarray) or isinstance(obj, (float, np.floating)):
+        a = np.ascontiguousarray(obj, dtype=np.float64)
+        h.update(b'array' + repr(a.shape).encode())
+        h.update(a.tobytes())
+    else:
+        h.update(repr(obj).encode())
+
+
+
+class ResultCache(object):
+    """Content-addressed on-disk cache of propagation results
+
+    Results are stored as the output files of :meth:`Ensemble._save`, named by the SHA-256 digest of
+    all inputs that determine the result: the molecular parameters, the :class:`Field`, the initial
+    phase-space positions and statistical weights of the :class:`Ensemble`, the time range, the solver settings, and the
+    package version. Every entry is accompanied by a small JSON file with descriptive information;
+    its modification time is used as last-access time for the least-recently-used eviction that keeps
+    the cache below `max_size` bytes.
+
+    .. note:: Cache hits require reproducible initial conditions, i.e., an identical ensemble.
+
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        """Open (and possibly create) a result cache
+
+        :param directory: Directory of the cache (default: environment variable
+        `CMICLASSIROT_CACHE` or `~/.cache/cmiclassirot`)
+
+        :param max_size: Maximum total size of the cache in bytes (default: 10 GiB)
+
+        """
+        if directory is None:
+            directory = os.environ.get('CMICLASSIROT_CACHE', default_directory)
+        self.directory = directory
+        self.max_size = default_max_size if max_size is None else max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    @staticmethod
+    def inputs(propagator):
+        """All inputs determining the result of `propagator` as a (nested) dictionary"""
+        ensemble = propagator.ensemble
+        molecules = ensemble.molecules
+        return {'version': cmiclassirot.__version__,
+                'I': molecules[0].I,
+                'P': molecules[0].P,
+                'mu': molecules[0].mu,
+                'species': None if len(getattr(ensemble, 'species', ())) < 2 else
+                    ([[mol.I, mol.P, mol.mu] for mol in ensemble.species], ensemble.species_index),
+                'field': propagator.field.parameters(),
+                'ensemble': {'size': ensemble.size, 'T': ensemble.temperature, 't': ensemble.time},
+                # the stored observables are weighted; unit weights keep the keys of unweighted ensembles
+                'weights': None if np.all(np.asarray(ensemble.weights) == 1) else np.asarray(ensemble.weights),
+                'initial': np.array([np.concatenate((mol.pos[0].angle.elements, mol.pos[0].velocity,
+                                                     [mol.pos[0].time]))
+                                     for mol in molecules]),
+                'timerange': propagator.t_range,
+                'dt_save': propagator.dt_save,
+                'solver': propagator.solver,
+                'convergence': None if propagator.target_error is None else
+                    (propagator.observable.__name__, propagator.target_error, propagator.batch_size,
+                     propagator.max_size)}
+
+
+    def key(self, propagator):
+        """Cache key, i.e., the hex digest of all inputs of `propagator`"""
+        h = hashlib.sha256()
+        _update_hash(h, self.inputs(propagator))
+        return h.hexdigest()
+
+
+    def _path(self, key, extension='.h5'):
+        return os.path.join(self.directory, key + extension)
+
+
+    def lookup(self, key):
+        """Look up a cached result
+
+        :return: Filename of the stored result or `None` if there is no entry for `key`
+
+        """
+        filename = self._path(key)
+        if not (os.path.exists(filename) and os.path.exists(self._path(key, '.json'))):
+            return None
+        # mark as recently used
+        os.utime(self._path(key, '.json'))
+        return filename
+
+
+    def store(self, key, ensemble, description=None):
+        """Store the propagated `ensemble` under `key` and evict old entries if necessary
+
+        :return: Filename of the stored result
+
+        """
+        filename = self._path(key)
+        tmpname = self._path(key, f'.{os.getpid()}.tmp')
+        ensemble._save(tmpname)
+        os.replace(tmpname, filename)
+        info = {'key': key, 'created': time.time(), 'size': os.path.getsize(filename),
+                'molecules': ensemble.size, 'description': description}
+        with open(self._path(key, '.json'), 'w') as f:
+            json.dump(info, f)
+        self.evict()
+        return filename
+
+
+    def entries(self):
+        """List all cache entries, most recently used first
+
+        :return: `list` of `dict`s with key, size, creation and last-access time, and description
+
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                with open(self._path(key, '.json')) as f:
+                    info = json.load(f)
+                info['accessed'] = os.path.getmtime(self._path(key, '.json'))
+                info['size'] = os.path.getsize(self._path(key))
+            except (OSError, ValueError):
+                continue
+            entries.append(info)
+        entries.sort(key=lambda info: info['accessed'], reverse=True)
+        return entries
+
+
+    def size(self):
+        """Total size of all cache entries in bytes"""
+        return sum(info['size'] for info in self.entries())
+
+
+    def remove(self, key):
+        """Remove entry `key` from the cache"""
+        for extension in ('.json', '.h5'):
+            try:
+                os.remove(self._path(key, extension))
+            except FileNotFoundError:
+                pass
+
+
+    def evict(self, max_size=None):
+        """Remove least-recently-used entries until the cache is smaller than `max_size`
+
+        :param max_size: Size limit in bytes (default: `self.max_size`)
+
+        :return: `list` of the removed keys
+
+        """
+        max_size = self.max_size if max_size is None else max_size
+        removed = []
+        entries = self.entries()
+        total = sum(info['size'] for info in entries)
+        while entries and total > max_size:
+            info = entries.pop()
+            self.remove(info['key'])
+            total -= info['size']
+            removed.append(info['key'])
+        return removed
+
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        return self.evict(0)
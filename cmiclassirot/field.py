@@ -16,8 +16,9 @@
 # You should have received a copy of the GNU General Public License along with this program. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import copy
+
 import numpy as np
-from scipy import interpolate
 from scipy.constants import c, epsilon_0
 from pyquaternion import Quaternion
 
@@ -53,8 +54,7 @@ class Field(object):
 
     .. todo:: document class, constructor, and methods
 
-    .. todo:: Implement mixed field handling, here this is always providing (DC, AC) tuples on
-    __call__; maybe should be done via a derived class MixedField for performance reasons.
+    Mixed (DC and AC) fields are represented by the derived class :class:`MixedField`.
 
     """
     def __init__(self, peak_amplitude=None, peak_intensity=None, t_peak=0., FWHM=10.e-9,
@@ -70,6 +70,7 @@ class Field(object):
             self.sigma = FWHM / 2*np.sqrt(2*np.log(2))
             self.t_peak = t_peak
         else:
+            from scipy import interpolate
             self.peak_amplitude = None
             f = open(filename)
             E=[]
@@ -80,6 +81,7 @@ class Field(object):
                 E.append(float(token[1]))
             t = np.array(t)
             E = np.array(E)
+            self._table = (t, E)
             self.amplitude = interpolate.interp1d(t,E)
         # initially the field is alog :math:`Z`
         self.Ez = np.array([0., 0., 1.])
@@ -97,6 +99,42 @@ class Field(object):
             return self.amplitude(t)
 
 
+    def parameters(self):
+        """Parameters defining the field
+
+        :return: `dict` of the parameters that fully determine the field, i.e., of the synthetic
+        Gaussian pulse or of the numerically specified amplitude table. This is used, e.g., to
+        identify identical calculations in the :class:`cmiclassirot.cache.ResultCache`.
+
+        """
+        if self.peak_amplitude:
+            parameters = {'peak_amplitude': self.peak_amplitude, 'sigma': self.sigma, 't_peak': self.t_peak}
+        else:
+            parameters = {'time': self._table[0], 'amplitude': self._table[1]}
+        parameters['type'] = type(self).__name__
+        parameters['Ez'] = self.Ez
+        return parameters
+
+
+    def peak_intensity(self):
+        """Peak intensity (W/m**2) of the field, the maximum of the table for numerically specified fields"""
+        if self.peak_amplitude:
+            return Field.amplitude2intensity(self.peak_amplitude)
+        return Field.amplitude2intensity(np.abs(self._table[1]).max())
+
+
+    def rescaled(self, peak_intensity):
+        """Copy of the field with the same temporal profile and the peak intensity `peak_intensity` (W/m**2)"""
+        field = copy.copy(self)
+        if self.peak_amplitude:
+            field.peak_amplitude = Field.intensity2amplitude(peak_intensity)
+        else:
+            from scipy import interpolate
+            field._table = (self._table[0], self._table[1] * np.sqrt(peak_intensity / self.peak_intensity()))
+            field.amplitude = interpolate.interp1d(*field._table)
+        return field
+
+
     @staticmethod
     def intensity2amplitude(I):
         """Converts intensity (in W/m**2) to electric field (in V/m)"""
@@ -119,3 +157,82 @@ class Field(object):
 
         """
         return quaternion.rotate(self.Ez)
+
+
+
+class MixedField(Field):
+    """Alignment-laser field combined with a static (DC) electric field
+
+    The laser field is defined as for :class:`Field`, and calling the object provides its amplitude;
+    the DC field is the constant laboratory-frame vector `dc`, which acts on the permanent dipole
+    moment of the molecules and on the dipole it induces, see :meth:`Molecule.acceleration`. The angle
+    between the DC field and the laser polarization (`Ez`) is arbitrary.
+
+    :param dc: DC field vector in the laboratory frame (V/m)
+
+    """
+    def __init__(self, dc=(0., 0., 0.), **kwargs):
+        super().__init__(**kwargs)
+        self.dc = np.asarray(dc, dtype=float)
+
+
+    def parameters(self):
+        parameters = super().parameters()
+        parameters['dc'] = self.dc
+        return parameters
+
+
+
+class PulseTrain(Field):
+    """Train of Gaussian alignment-laser pulses
+
+    Every pulse is defined as the synthetic Gaussian pulse of :class:`Field`, by its peak intensity
+    (or amplitude), width, and time of its peak; scalars apply to all pulses. The pulses do not
+    interfere, i.e., their intensities add up, and the amplitude of the train is the square root of
+    the sum of the squared amplitudes of the pulses.
+
+    :param peak_intensity: Peak intensities of the pulses (W/m**2)
+
+    :param peak_amplitude: Peak amplitudes of the pulses (V/m), alternatively to `peak_intensity`
+
+    :param t_peak: Times of the peaks of the pulses (s)
+
+    :param FWHM: Full widths at half maximum of the pulses (s)
+
+    """
+    def __init__(self, peak_intensity=None, peak_amplitude=None, t_peak=(0.,), FWHM=10.e-9):
+        assert (peak_amplitude is not None) != (peak_intensity is not None)
+        if peak_intensity is not None:
+            peak_amplitude = Field.intensity2amplitude(np.asarray(peak_intensity, dtype=float))
+        self.peak_amplitudes, self.t_peak, FWHM = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(peak_amplitude, dtype=float)), np.atleast_1d(np.asarray(t_peak, dtype=float)),
+            np.atleast_1d(np.asarray(FWHM, dtype=float)))
+        # same conversion of the width as for a single pulse
+        self.sigma = FWHM / 2*np.sqrt(2*np.log(2))
+        # not a single synthetic pulse, see Field.__call__
+        self.peak_amplitude = None
+        self.Ez = np.array([0., 0., 1.])
+
+
+    def __call__(self, t):
+        """Field amplitude of the train at time(s) `t`"""
+        t = np.asarray(t, dtype=float)[..., None]
+        return np.sqrt(np.sum((self.peak_amplitudes * np.exp(-0.5 * ((t - self.t_peak)/self.sigma)**2))**2,
+                              axis=-1))
+
+
+    def parameters(self):
+        return {'peak_amplitude': self.peak_amplitudes, 'sigma': self.sigma, 't_peak': self.t_peak,
+                'type': type(self).__name__, 'Ez': self.Ez}
+
+
+    def peak_intensity(self):
+        """Largest peak intensity (W/m**2) of the pulses"""
+        return Field.amplitude2intensity(self.peak_amplitudes.max())
+
+
+    def rescaled(self, peak_intensity):
+        """Copy of the train with all pulses scaled such that the largest peak intensity is `peak_intensity`"""
+        field = copy.copy(self)
+        field.peak_amplitudes = self.peak_amplitudes * np.sqrt(peak_intensity / self.peak_intensity())
+        return field
@@ -0,0 +1,118 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Focal-volume averaging over the spatial intensity profile of the alignment laser"""
+
+import copy
+import hashlib
+
+import numpy as np
+
+from cmiclassirot.cache import _update_hash
+from cmiclassirot.postprocessing import cos2theta
+
+
+
+class FocalVolume(object):
+    """Average observables over the intensities in a Gaussian laser focus
+
+    Molecules are uniformly distributed over a disk of `radius` across the focus of the alignment
+    laser with waist (1/e^2 intensity radius) `waist`; optionally, they are detected with a
+    probability given by a Gaussian probe focus of waist `probe_waist`. The relative intensities of
+    `samples` random positions are grouped into bins on a fixed logarithmic grid of absolute peak
+    intensities with `per_decade` points per decade, and the ensemble is propagated once per bin in
+    the correspondingly scaled :class:`Field`. The observable is averaged over the bins with their
+    volume (and detection) weights.
+
+    As the grid does not depend on the peak intensity of the field, scans over the peak intensity
+    share most bins; their results are reused within the object and, through the
+    :class:`ResultCache`, across runs.
+
+    """
+
+    def __init__(self, waist, probe_waist=None, radius=None, per_decade=10, samples=100000, seed=0):
+        """Define the focal geometry
+
+        :param waist: Waist of the alignment laser (m)
+
+        :param probe_waist: Waist of the probe laser (m) (default: None, i.e., uniform detection)
+
+        :param radius: Radius of the disk of molecules (default: 1.5 `waist`, or 3 `probe_waist`)
+
+        :param per_decade: Number of intensity bins per decade
+
+        :param samples: Number of sampled positions
+
+        :param seed: Seed of the position sampling
+
+        """
+        self.waist = waist
+        self.probe_waist = probe_waist
+        if radius is None:
+            radius = 1.5 * waist if probe_waist is None else 3 * probe_waist
+        self.radius = radius
+        self.per_decade = per_decade
+        rng = np.random.default_rng(seed)
+        # uniform positions in the disk: r = R sqrt(u)
+        r = radius * np.sqrt(rng.random(samples))
+        self.scale = np.exp(-2 * r**2 / waist**2)
+        self.weight = np.ones(samples) if probe_waist is None else np.exp(-2 * r**2 / probe_waist**2)
+        self.results = {}
+
+
+    def bins(self, field):
+        """Intensity bins of the focus of `field`
+
+        :return: `list` of tuples of the peak intensity (W/m**2) and the normalized weight of the bins
+
+        """
+        peak = field.peak_intensity()
+        levels, index = np.unique(np.rint(np.log10(peak * self.scale) * self.per_decade).astype(int),
+                                  return_inverse=True)
+        weights = np.bincount(index, weights=self.weight)
+        weights /= weights.sum()
+        return [(10**(k / self.per_decade), w) for k, w in zip(levels, weights) if w > 0]
+
+
+    def propagate(self, ensemble, field, timerange, dt_save, observable=cos2theta, **kwargs):
+        """Focal-volume averaged expectation value of `observable`
+
+        Every intensity bin is propagated with a copy of the initial positions of `ensemble`, i.e.,
+        with common initial conditions, also if the ensemble has been propagated before; further
+        keyword arguments, e.g., `cache`, are passed to :class:`Propagate`.
+
+        :return: Tuple of the `ndarray`s of the save times and of the averaged expectation values
+
+        """
+        from cmiclassirot.propagate import Propagate
+        average, time = 0., None
+        for intensity, weight in self.bins(field):
+            scaled = field.rescaled(intensity)
+            h = hashlib.sha256()
+            _update_hash(h, [[mol.states()[0] for mol in ensemble.molecules], scaled.parameters(), list(timerange),
+                             dt_save, observable.__name__, kwargs.get('solver')])
+            key = h.hexdigest()
+            if key not in self.results:
+                propagated = copy.deepcopy(ensemble)
+                for molecule in propagated.molecules:
+                    molecule.pos = molecule.pos[:1]
+                Propagate(propagated, scaled, timerange, dt_save, **kwargs)
+                self.results[key] = (propagated.states()[0, :, 7], observable(propagated)())
+            time, values = self.results[key]
+            average = average + weight * values
+        return time, average
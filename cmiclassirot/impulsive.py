@@ -0,0 +1,270 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Sudden-kick surrogate of the propagation in laser pulses much shorter than the rotational period
+
+In the impulsive limit the molecules do not rotate during the pulse, and the torque of the induced
+dipole, :math:`\\tau = \\pm (P E) \\times E`, integrates to a kick of the angular momentum that is
+proportional to the fluence :math:`F = \\int E^2(t) dt` of the pulse. Before and after the kick the
+molecules rotate freely, which is solved analytically for symmetric tops, including linear molecules,
+and integrated with the Runge-Kutta kernels of :mod:`cmiclassirot.kernels` otherwise.
+
+"""
+
+import numpy as np
+import scipy.integrate
+
+from cmiclassirot import kernels
+from cmiclassirot.field import PulseTrain
+from cmiclassirot.postprocessing import cos2theta
+
+
+
+def pulse(field, timerange):
+    """Fluence, center, and duration of the intensity profile of `field` within `timerange`
+
+    :return: Tuple of the fluence :math:`\\int E^2 dt` ((V/m)^2 s), the :math:`E^2`-weighted mean
+    time (s), and the :math:`E^2`-weighted standard deviation of the time (s)
+
+    """
+    dc = getattr(field, 'dc', None)
+    if dc is not None and np.any(dc):
+        raise ValueError('the sudden approximation does not apply to static fields')
+    if isinstance(field, PulseTrain):
+        if len(field.t_peak) > 1:
+            raise ValueError('the sudden approximation applies to single pulses only')
+        amplitude, sigma, center = field.peak_amplitudes[0], field.sigma[0], field.t_peak[0]
+    elif getattr(field, 'peak_amplitude', None):
+        amplitude, sigma, center = field.peak_amplitude, field.sigma, field.t_peak
+    else:
+        amplitude = None
+    if amplitude is not None:
+        # E^2 of the Gaussian amplitude is a Gaussian of width sigma/sqrt(2)
+        return amplitude**2 * sigma * np.sqrt(np.pi), center, sigma / np.sqrt(2)
+    t = np.asarray(field._table[0], dtype=float)
+    t = np.concatenate(([timerange[0]], t[(t > timerange[0]) & (t < timerange[1])], [timerange[1]]))
+    intensity = np.asarray(field(t), dtype=float)**2
+    fluence = scipy.integrate.trapezoid(intensity, t)
+    center = scipy.integrate.trapezoid(t * intensity, t) / fluence
+    duration = np.sqrt(scipy.integrate.trapezoid((t - center)**2 * intensity, t) / fluence)
+    return fluence, center, duration
+
+
+def _multiply(p, q):
+    """Hamilton products of the quaternions (w, x, y, z) along the last axes of `p` and `q`"""
+    w1, x1, y1, z1 = np.moveaxis(p, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q, -1, 0)
+    return np.stack((w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2), axis=-1)
+
+
+def _exp(v):
+    """Unit quaternions of the rotations by the rotation vectors `v` along the last axis"""
+    angle = np.linalg.norm(v, axis=-1)
+    # sin(angle/2) / angle without division by zero
+    return np.concatenate((np.cos(angle / 2)[..., None], v * (0.5 * np.sinc(angle / (2 * np.pi)))[..., None]),
+                          axis=-1)
+
+
+def _rotate(q, v):
+    """Vectors `v` rotated by the unit quaternions `q`, i.e., from the molecular to the laboratory frame"""
+    w, u = q[..., :1], q[..., 1:]
+    t = 2 * np.cross(u, v)
+    return v + w * t + np.cross(u, t)
+
+
+def free(y, I, t0, times):
+    """Field-free rotation of the states `y` (N, 7) at time `t0` to the `times` (>= `t0`)
+
+    Symmetric tops (:math:`I_x = I_y`) rotate about their constant angular momentum
+    :math:`L` with :math:`L/I_x` and about their figure axis with
+    :math:`\\omega_z (1 - I_z/I_x)`, which is exact; other molecules are integrated by the
+    Runge-Kutta kernels with steps of at most 0.02 rad.
+
+    :return: `ndarray` of shape (N, len(`times`), 7) of the states at `times`
+
+    """
+    y, I = np.asarray(y, dtype=float), np.asarray(I, dtype=float)
+    times = np.asarray(times, dtype=float)
+    out = np.empty((len(y), len(times), 7))
+    symmetric = np.isclose(I[:, 0], I[:, 1], rtol=1e-12, atol=0.)
+    if np.any(symmetric):
+        q, omega, Ix, Iz = y[symmetric, :4], y[symmetric, 4:], I[symmetric, 0], I[symmetric, 2]
+        dt = (times - t0)[None, :, None]
+        precession = _rotate(q, omega * I[symmetric]) / Ix[:, None]
+        spin = omega[:, 2] * (1 - Iz / Ix)
+        figure = np.zeros((len(q), len(times), 3))
+        figure[..., 2] = spin[:, None] * dt[..., 0]
+        out[symmetric, :, :4] = _multiply(_multiply(_exp(precession[:, None] * dt), q[:, None]), _exp(figure))
+        phase = figure[..., 2]
+        out[symmetric, :, 4] = omega[:, None, 0] * np.cos(phase) + omega[:, None, 1] * np.sin(phase)
+        out[symmetric, :, 5] = omega[:, None, 1] * np.cos(phase) - omega[:, None, 0] * np.sin(phase)
+        out[symmetric, :, 6] = omega[:, None, 2]
+    if not np.all(symmetric):
+        state = y[~symmetric]
+        n = len(state)
+        velocity = np.abs(state[:, 4:]).max()
+        zero, P, factor = np.zeros(3), np.zeros((n, 3, 3)), np.ones(n)
+        t = t0
+        for j, target in enumerate(times):
+            m = max(1, int(np.ceil((target - t) * velocity / 0.02)))
+            state = kernels.rk4(state, 1, m, (target - t) / m, np.zeros(2*m + 1), zero, I[~symmetric], P,
+                                factor)[:, 0]
+            out[~symmetric, j] = state
+            t = target
+    return out
+
+
+
+class SuddenKick(object):
+    """Sudden-kick surrogate of the propagation of |Molecule|s in a short laser pulse
+
+    The molecules rotate freely up to the center of the pulse, see :func:`pulse`, where their angular
+    velocities are changed instantaneously by the kicks per unit fluence,
+    :math:`\\Delta\\omega_i = \\pm [(P e) \\times e]_i / I_i` for the field direction :math:`e` in the
+    molecular frame, times the fluence of the field, and rotate freely afterwards. The kicks are
+    tabulated for the orientations at the pulse center, which do not depend on the field strength,
+    such that the states for further pulses of the same center and polarization, e.g., of an intensity
+    scan, only require the free rotation after the kick.
+
+    The approximation holds for pulses much shorter than the rotational period of the molecules at all
+    reached angular velocities; :meth:`validate` compares it with the full integration of a subsample.
+
+    """
+
+    def __init__(self, molecules, field, timerange, dt_save):
+        """Tabulate the free rotation up to the pulse center and the kicks
+
+        :param molecules: `list` of |Molecule|s, of which the initial positions are used
+
+        :param field: :class:`Field` defining the center and polarization of the pulse
+
+        :param timerange: Tuple of the initial and final time (s)
+
+        :param dt_save: Interval of the save times (s), which are the same as those of
+        :class:`Propagate`
+
+        """
+        self.molecules = molecules
+        self.timerange = timerange
+        self.dt_save = dt_save
+        times = []
+        t = timerange[0]
+        while t <= timerange[1]:
+            t = t + dt_save
+            times.append(t)
+        self.times = np.array(times)
+        self.y0 = np.array([np.concatenate((mol.pos[0].angle.elements, mol.pos[0].velocity)) for mol in molecules])
+        self.I, self.P, self.factor = kernels.parameters(molecules)
+        self.tables = {}
+        self.validation = None
+        self._table(field)
+
+
+    def _table(self, field):
+        """States at the save times before, and states and kicks per unit fluence at, the pulse center"""
+        fluence, center, duration = pulse(field, self.timerange)
+        key = (center, tuple(field.Ez))
+        if key not in self.tables:
+            if center < self.timerange[0]:
+                raise ValueError('the pulse must be centered after the initial time')
+            before = self.times < center
+            y = free(self.y0, self.I, self.timerange[0], np.append(self.times[before], center))
+            e = kernels.field_direction(y[:, -1, :4], field.Ez)
+            torque = self.factor[:, None] * np.cross(np.einsum('nij,nj->ni', self.P, e), e)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kicks = np.where(self.I != 0, torque / self.I, 0.)
+            self.tables[key] = (y[:, :-1], y[:, -1], kicks, center)
+        return self.tables[key], fluence, duration
+
+
+    def states(self, field):
+        """Phase-space positions of all molecules at the initial and all save times in `field`
+
+        :return: `ndarray` of shape (molecules, times, 8) of the quaternions, angular velocities, and
+        times, as :meth:`Ensemble.states`
+
+        """
+        (before, kicked, kicks, center), fluence, duration = self._table(field)
+        kicked = kicked.copy()
+        kicked[:, 4:] += fluence * kicks
+        after = free(kicked, self.I, center, self.times[len(before[0]):])
+        states = np.empty((len(self.y0), len(self.times) + 1, 8))
+        states[:, 0, :7] = self.y0
+        states[:, 1:, :7] = np.concatenate((before, after), axis=1)
+        states[..., 7] = np.append(self.timerange[0], self.times)
+        return states
+
+
+    def expectation(self, field, observable=cos2theta, weights=None):
+        """Expectation value of `observable` at the initial and all save times in `field`"""
+        return np.average(observable.evaluate(self.states(field)[..., :4]), axis=0, weights=weights)
+
+
+    def scan(self, field, intensities, observable=cos2theta, weights=None):
+        """Expectation values of `observable` for `field` rescaled to all peak `intensities` (W/m**2)
+
+        :return: `ndarray` of shape (intensities, times)
+
+        """
+        return np.array([self.expectation(field.rescaled(intensity), observable, weights)
+                         for intensity in intensities])
+
+
+    def apply(self, field):
+        """Set the trajectories of all molecules in `field`, as :class:`Propagate` does
+
+        :return: `list` of the molecules
+
+        """
+        from pyquaternion import Quaternion
+        from cmiclassirot.sample import Position
+        for molecule, state in zip(self.molecules, self.states(field)[:, 1:]):
+            molecule.pos = molecule.pos[:1] + [Position(Quaternion(s[:4]), s[4:7], t=s[7]) for s in state]
+        return self.molecules
+
+
+    def validate(self, field, size=20, tolerance=1e-2, solver=None):
+        """Compare the surrogate with the full integration of the first `size` molecules
+
+        The subsample is propagated by :class:`Propagate` in this process with the `solver` settings
+        (default: the adaptive dopri5 integrator). As both start from identical initial conditions,
+        their difference is systematic; it is evaluated after the pulse, i.e., at least three
+        durations after its center.
+
+        :return: `dict` of the `size` of the subsample, the maximal `deviation` of the expectation
+        values of :math:`\\cos^2\\theta` after the pulse, the `tolerance`, and whether the
+        approximation is `valid`; also stored as `validation`
+
+        """
+        from cmiclassirot.propagate import Propagate
+        from cmiclassirot.sample import Ensemble, Molecule
+        size = min(size, len(self.molecules))
+        ensemble = Ensemble.FromMolecules(Molecule(mol, pos=[mol.pos[0]]) for mol in self.molecules[:size])
+        # the subsample is small and may be validated within a worker, e.g., of a PulseOptimizer
+        Propagate(ensemble, field, self.timerange, self.dt_save, solver=solver, processes=1)
+        (before, kicked, kicks, center), fluence, duration = self._table(field)
+        surrogate = cos2theta.evaluate(self.states(field)[:size, :, :4]).mean(axis=0)
+        full = cos2theta.evaluate(ensemble.states()[..., :4]).mean(axis=0)
+        after = np.append(self.timerange[0], self.times) >= center + 3 * duration
+        deviation = float(np.abs(surrogate - full)[after].max()) if np.any(after) else 0.
+        self.validation = {'size': size, 'deviation': deviation, 'tolerance': tolerance,
+                           'valid': deviation <= tolerance}
+        return self.validation
@@ -0,0 +1,219 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Batched equations of motion and fixed-step Runge-Kutta integration of many rigid rotors
+
+The state of `N` molecules is an `ndarray` of shape (N, 7) of the orientation quaternions (w, x, y,
+z) and the angular velocities in the molecular frame. The molecular parameters are given as arrays
+of the principal moments of inertia `I` (N, 3), the polarizability tensors `P` (N, 3, 3), and the
+sign `factor` (N,) of the induced torque, see :meth:`Molecule.acceleration`. The field is specified
+by its (laboratory-frame) direction and a table of its amplitude at all half steps of the
+integration, such that arbitrary :class:`Field`s are supported. For mixed fields, the permanent
+dipole moments `mu` (N, 3) and the laboratory-frame DC field `dc` are given additionally; without
+them, the DC terms are skipped entirely.
+
+Two backends implement the same physics as :meth:`Propagate._derivative`: vectorized NumPy code
+(`numpy`) and, if numba is installed, compiled kernels looping over the molecules in parallel
+(`numba`); the compiled code is cached on disk, see numba's `NUMBA_CACHE_DIR`.
+
+"""
+
+import numpy as np
+
+try:
+    import numba
+    prange = numba.prange
+except ImportError:
+    numba = None
+    prange = range
+
+
+
+def parameters(molecules):
+    """Molecular parameters `I`, `P`, and `factor` of a list of |Molecule|s as arrays"""
+    I = np.array([np.diagonal(mol.I) for mol in molecules], dtype=float).reshape(-1, 3)
+    P = np.array([mol.P for mol in molecules], dtype=float).reshape(-1, 3, 3)
+    factor = np.where(I[:, 2] < I[:, 0], 1., -1.)
+    return I, P, factor
+
+
+def field_direction(q, direction):
+    """Laboratory-fixed `direction` in the molecular frames of the quaternions `q` (N, 4)"""
+    w, x, y, z = q.T
+    n2 = w*w + x*x + y*y + z*z
+    ex, ey, ez = direction
+    # transpose of the rotation matrix of the normalized quaternion applied to direction
+    return np.stack((ex * (1 - 2*(y*y + z*z)/n2) + ey * 2*(x*y + w*z)/n2 + ez * 2*(x*z - w*y)/n2,
+                     ex * 2*(x*y - w*z)/n2 + ey * (1 - 2*(x*x + z*z)/n2) + ez * 2*(y*z + w*x)/n2,
+                     ex * 2*(x*z + w*y)/n2 + ey * 2*(y*z - w*x)/n2 + ez * (1 - 2*(x*x + y*y)/n2)), axis=-1)
+
+
+def dipoles(molecules):
+    """Permanent dipole moments of a list of |Molecule|s as array"""
+    return np.array([mol.mu for mol in molecules], dtype=float).reshape(-1, 3)
+
+
+def derivative(y, amplitude, direction, I, P, factor, mu=None, dc=None):
+    """Time derivative of the states `y` (N, 7) in a field of `amplitude` along `direction`
+
+    :param mu: Permanent dipole moments (N, 3) for a DC field `dc` (laboratory frame)
+
+    """
+    w, x, y_, z = y[:, 0], y[:, 1], y[:, 2], y[:, 3]
+    vx, vy, vz = y[:, 4], y[:, 5], y[:, 6]
+    E = amplitude * field_direction(y[:, :4], direction)
+    torque = factor[:, None] * np.cross(np.einsum('nij,nj->ni', P, E), E)
+    if dc is not None:
+        E = field_direction(y[:, :4], dc)
+        torque += np.cross(mu, E) + factor[:, None] * np.cross(np.einsum('nij,nj->ni', P, E), E)
+    dy = np.empty_like(y)
+    # quaternion kinematics, 0.5 * q * (0, omega)
+    dy[:, 0] = -0.5 * (x*vx + y_*vy + z*vz)
+    dy[:, 1] = 0.5 * (w*vx + y_*vz - z*vy)
+    dy[:, 2] = 0.5 * (w*vy + z*vx - x*vz)
+    dy[:, 3] = 0.5 * (w*vz + x*vy - y_*vx)
+    # Euler's equations; rotations about axes without inertia (linear molecules) are not accelerated
+    Ix, Iy, Iz = I[:, 0], I[:, 1], I[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dy[:, 4] = np.where(Ix != 0, (torque[:, 0] - (Iz - Iy)*vy*vz) / Ix, 0.)
+        dy[:, 5] = np.where(Iy != 0, (torque[:, 1] - (Ix - Iz)*vx*vz) / Iy, 0.)
+        dy[:, 6] = np.where(Iz != 0, (torque[:, 2] - (Iy - Ix)*vx*vy) / Iz, 0.)
+    return dy
+
+
+def rk4(y0, n_save, m, h, table, direction, I, P, factor, mu=None, dc=None):
+    """Integrate states `y0` (N, 7) with `n_save` * `m` classical Runge-Kutta steps of size `h`
+
+    :param table: Field amplitudes at all half steps, i.e., of length 2 * `n_save` * `m` + 1
+
+    :return: `ndarray` of shape (N, n_save, 7) of the states after every `m` steps
+
+    """
+    out = np.empty((len(y0), n_save, 7), dtype=y0.dtype)
+    y = y0.copy()
+    # compensation of the rounding errors of the state updates (Kahan summation), which otherwise
+    # accumulate linearly with the number of steps in single precision
+    compensation = np.zeros_like(y)
+    for j in range(n_save):
+        for s in range(m):
+            k = 2 * (j*m + s)
+            k1 = derivative(y, table[k], direction, I, P, factor, mu, dc)
+            k2 = derivative(y + 0.5*h*k1, table[k+1], direction, I, P, factor, mu, dc)
+            k3 = derivative(y + 0.5*h*k2, table[k+1], direction, I, P, factor, mu, dc)
+            k4 = derivative(y + h*k3, table[k+2], direction, I, P, factor, mu, dc)
+            increment = h/6 * (k1 + 2*k2 + 2*k3 + k4) - compensation
+            updated = y + increment
+            compensation = (updated - y) - increment
+            y = updated
+        out[:, j] = y
+    return out
+
+
+
+def _rhs(y, amplitude, direction, I, P, factor, mu, dc, mixed, dy):
+    """Time derivative of a single state `y` (7,), stored in `dy`; scalar code for compilation
+
+    The DC terms are only evaluated if `mixed` is true.
+
+    """
+    w, x, y_, z = y[0], y[1], y[2], y[3]
+    vx, vy, vz = y[4], y[5], y[6]
+    n2 = w*w + x*x + y_*y_ + z*z
+    ex, ey, ez = direction[0], direction[1], direction[2]
+    Ex = amplitude * (ex * (1 - 2*(y_*y_ + z*z)/n2) + ey * 2*(x*y_ + w*z)/n2 + ez * 2*(x*z - w*y_)/n2)
+    Ey = amplitude * (ex * 2*(x*y_ - w*z)/n2 + ey * (1 - 2*(x*x + z*z)/n2) + ez * 2*(y_*z + w*x)/n2)
+    Ez = amplitude * (ex * 2*(x*z + w*y_)/n2 + ey * 2*(y_*z - w*x)/n2 + ez * (1 - 2*(x*x + y_*y_)/n2))
+    dx = P[0, 0]*Ex + P[0, 1]*Ey + P[0, 2]*Ez
+    dyp = P[1, 0]*Ex + P[1, 1]*Ey + P[1, 2]*Ez
+    dz = P[2, 0]*Ex + P[2, 1]*Ey + P[2, 2]*Ez
+    tx = factor * (dyp*Ez - dz*Ey)
+    ty = factor * (dz*Ex - dx*Ez)
+    tz = factor * (dx*Ey - dyp*Ex)
+    if mixed:
+        ex, ey, ez = dc[0], dc[1], dc[2]
+        Ex = ex * (1 - 2*(y_*y_ + z*z)/n2) + ey * 2*(x*y_ + w*z)/n2 + ez * 2*(x*z - w*y_)/n2
+        Ey = ex * 2*(x*y_ - w*z)/n2 + ey * (1 - 2*(x*x + z*z)/n2) + ez * 2*(y_*z + w*x)/n2
+        Ez = ex * 2*(x*z + w*y_)/n2 + ey * 2*(y_*z - w*x)/n2 + ez * (1 - 2*(x*x + y_*y_)/n2)
+        dx = P[0, 0]*Ex + P[0, 1]*Ey + P[0, 2]*Ez
+        dyp = P[1, 0]*Ex + P[1, 1]*Ey + P[1, 2]*Ez
+        dz = P[2, 0]*Ex + P[2, 1]*Ey + P[2, 2]*Ez
+        tx += mu[1]*Ez - mu[2]*Ey + factor * (dyp*Ez - dz*Ey)
+        ty += mu[2]*Ex - mu[0]*Ez + factor * (dz*Ex - dx*Ez)
+        tz += mu[0]*Ey - mu[1]*Ex + factor * (dx*Ey - dyp*Ex)
+    dy[0] = -0.5 * (x*vx + y_*vy + z*vz)
+    dy[1] = 0.5 * (w*vx + y_*vz - z*vy)
+    dy[2] = 0.5 * (w*vy + z*vx - x*vz)
+    dy[3] = 0.5 * (w*vz + x*vy - y_*vx)
+    dy[4] = (tx - (I[2] - I[1])*vy*vz) / I[0] if I[0] != 0 else 0.
+    dy[5] = (ty - (I[0] - I[2])*vx*vz) / I[1] if I[1] != 0 else 0.
+    dy[6] = (tz - (I[1] - I[0])*vx*vy) / I[2] if I[2] != 0 else 0.
+
+
+def _rk4(y0, n_save, m, h, table, direction, I, P, factor, mu, dc, mixed, out):
+    """Compiled counterpart of :func:`rk4`, parallelized over molecules; results are stored in `out`"""
+    for i in prange(y0.shape[0]):
+        y = y0[i].copy()
+        compensation = np.zeros_like(y)
+        tmp = np.empty_like(y)
+        k1, k2, k3, k4 = np.empty_like(y), np.empty_like(y), np.empty_like(y), np.empty_like(y)
+        for j in range(n_save):
+            for s in range(m):
+                k = 2 * (j*m + s)
+                _rhs(y, table[k], direction, I[i], P[i], factor[i], mu[i], dc, mixed, k1)
+                for l in range(7):
+                    tmp[l] = y[l] + 0.5*h*k1[l]
+                _rhs(tmp, table[k+1], direction, I[i], P[i], factor[i], mu[i], dc, mixed, k2)
+                for l in range(7):
+                    tmp[l] = y[l] + 0.5*h*k2[l]
+                _rhs(tmp, table[k+1], direction, I[i], P[i], factor[i], mu[i], dc, mixed, k3)
+                for l in range(7):
+                    tmp[l] = y[l] + h*k3[l]
+                _rhs(tmp, table[k+2], direction, I[i], P[i], factor[i], mu[i], dc, mixed, k4)
+                for l in range(7):
+                    increment = h/6 * (k1[l] + 2*k2[l] + 2*k3[l] + k4[l]) - compensation[l]
+                    updated = y[l] + increment
+                    compensation[l] = (updated - y[l]) - increment
+                    y[l] = updated
+            out[i, j] = y
+
+
+if numba is not None:
+    _rhs = numba.njit(cache=True)(_rhs)
+    _rk4 = numba.njit(cache=True, parallel=True)(_rk4)
+
+
+
+backends = ('numpy', 'numba')
+
+
+def available(backend):
+    """Check whether `backend` can be used, i.e., whether numba is installed for `numba`"""
+    return backend == 'numpy' or (backend == 'numba' and numba is not None)
+
+
+def integrate(backend, y0, n_save, m, h, table, direction, I, P, factor, mu=None, dc=None):
+    """Integrate with the specified backend, see :func:`rk4`"""
+    if backend == 'numba':
+        out = np.empty((len(y0), n_save, 7), dtype=y0.dtype)
+        mixed = dc is not None
+        if not mixed:
+            mu, dc = np.zeros((len(y0), 3), dtype=y0.dtype), np.zeros(3, dtype=y0.dtype)
+        _rk4(y0, n_save, m, h, table, np.asarray(direction, dtype=y0.dtype), I, P, factor, mu,
+             np.asarray(dc, dtype=y0.dtype), mixed, out)
+        return out
+    return rk4(y0, n_save, m, h, table, direction, I, P, factor, mu, dc)
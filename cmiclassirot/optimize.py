@@ -0,0 +1,173 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Optimization of the parameters of the alignment field"""
+
+import copy
+import hashlib
+import multiprocessing as mp
+
+import numpy as np
+import scipy.optimize
+
+from cmiclassirot.cache import _update_hash
+from cmiclassirot.postprocessing import cos2theta
+
+
+
+class PulseOptimizer(object):
+    """Maximize the alignment by the parameters of the alignment field
+
+    The field is created by the function `field`, e.g., a module-level function returning a
+    :class:`PulseTrain`, from keyword arguments whose ranges are given by `bounds`; the parameters are
+    optimized by scipy's differential evolution.
+
+    Every candidate is propagated with a copy of the same, typically small, `ensemble`, i.e., with
+    common initial conditions, such that the differences between candidates are not masked by the
+    sampling noise of the ensemble. The objectives of all evaluated candidates are kept in `results`,
+    the candidates of a generation are propagated in parallel on a local process pool, and further
+    keyword arguments of the constructor, e.g., `cache`, are passed to :class:`Propagate`.
+
+    """
+
+    def __init__(self, field, bounds, ensemble, timerange, dt_save, objective='peak', threshold=0.5,
+                 solver=None, processes=None, **kwargs):
+        """Define the optimization problem
+
+        :param field: Function that returns the :class:`Field` for keyword arguments of the names of
+        `bounds`; it must be picklable for parallel evaluation
+
+        :param bounds: `dict` of the (lower, upper) bounds of all parameters
+
+        :param ensemble: :class:`Ensemble` whose initial positions are used for all candidates
+
+        :param timerange: Time range of the propagation
+
+        :param dt_save: Interval of the save times
+
+        :param objective: 'peak' for the maximum of :math:`\\langle\\cos^2\\theta\\rangle`, 'duration'
+        for the time during which it is at least `threshold`, or a function of the save times and the
+        expectation values (default: 'peak')
+
+        :param solver: Solver settings of :class:`Propagate` (default: the numpy backend)
+
+        :param processes: Number of worker processes (default: number of CPUs)
+
+        """
+        if not callable(objective) and objective not in ('peak', 'duration'):
+            raise ValueError(f'unknown objective {objective}')
+        self.field = field
+        self.names = list(bounds)
+        self.bounds = [tuple(bounds[name]) for name in self.names]
+        self.ensemble = ensemble
+        self.timerange = timerange
+        self.dt_save = dt_save
+        self.objective = objective
+        self.threshold = threshold
+        self.solver = solver if solver else {'backend': 'numpy'}
+        self.processes = processes if processes else mp.cpu_count()
+        self.kwargs = kwargs
+        self.results = {}
+        self.pool = None
+
+
+    def __getstate__(self):
+        # workers evaluate candidates only; they need neither the pool nor the evaluated points
+        state = self.__dict__.copy()
+        state['pool'], state['results'] = None, {}
+        return state
+
+
+    def parameters(self, x):
+        """`dict` of the named parameters of the parameter vector `x`"""
+        return dict(zip(self.names, (float(value) for value in x)))
+
+
+    def _key(self, x):
+        h = hashlib.sha256()
+        _update_hash(h, [float(value) for value in x])
+        return h.hexdigest()
+
+
+    def propagate(self, x):
+        """Expectation values of :math:`\\cos^2\\theta` for the parameter vector `x`
+
+        :return: Tuple of the `ndarray`s of the save times and of the expectation values
+
+        """
+        from cmiclassirot.propagate import Propagate
+        ensemble = copy.deepcopy(self.ensemble)
+        for molecule in ensemble.molecules:
+            molecule.pos = molecule.pos[:1]
+        Propagate(ensemble, self.field(**self.parameters(x)), self.timerange, self.dt_save, solver=self.solver,
+                  processes=1, **self.kwargs)
+        return ensemble.states()[0, :, 7], cos2theta(ensemble)()
+
+
+    def evaluate(self, x):
+        """Objective for the parameter vector `x`, see :meth:`__init__`"""
+        t, values = self.propagate(x)
+        if callable(self.objective):
+            return float(self.objective(t, values))
+        if self.objective == 'peak':
+            return float(values.max())
+        return float(np.count_nonzero(values >= self.threshold) * self.dt_save)
+
+
+    def _map(self, function, population):
+        """Objectives, negated for minimization, of all candidates of a generation
+
+        This is used as `workers` of the differential evolution; candidates that have been evaluated
+        before are taken from `results`, the others are evaluated by :meth:`evaluate` on the pool.
+
+        """
+        population = [np.asarray(x, dtype=float) for x in population]
+        keys = [self._key(x) for x in population]
+        missing = {}
+        for key, x in zip(keys, population):
+            if key not in self.results:
+                missing.setdefault(key, x)
+        if missing:
+            candidates = list(missing.values())
+            values = self.pool.map(self.evaluate, candidates) if self.pool is not None else map(self.evaluate,
+                                                                                                 candidates)
+            for key, x, value in zip(missing, candidates, values):
+                self.results[key] = (self.parameters(x), value)
+        return [-self.results[key][1] for key in keys]
+
+
+    def run(self, maxiter=20, popsize=8, seed=0, **kwargs):
+        """Optimize the field parameters
+
+        Further keyword arguments are passed to :func:`scipy.optimize.differential_evolution`.
+
+        :return: Tuple of the `dict` of the best parameters and its objective
+
+        """
+        self.pool = mp.Pool(self.processes) if self.processes > 1 else None
+        try:
+            result = scipy.optimize.differential_evolution(
+                lambda x: -self.evaluate(x), self.bounds, maxiter=maxiter, popsize=popsize, seed=seed,
+                polish=False, updating='deferred', workers=self._map, **kwargs)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        self.result = result
+        return self.parameters(result.x), -float(result.fun)
@@ -18,28 +18,442 @@
 
 
 import numpy as np
+import scipy.optimize
 
 
 class Expectation(object):
     """Calculate expectation values of a probability density function given as an :class:`Ensemble`
 
-    .. todo:: implement
+    Derived classes implement :meth:`evaluate`, which calculates the observable for every molecule
+    and save time from the array of orientation quaternions.
+
+    Expectation values are averages over the molecules with the statistical weights `weights`
+    (default: the weights of the ensemble), see :meth:`Ensemble.reweight`.
 
     """
 
-    def __init__(self, Ensemble):
-        pass
+    def __init__(self, ensemble, weights=None):
+        self.ensemble = ensemble
+        self.weights = weights
+
+
+    @staticmethod
+    def evaluate(quaternions):
+        """Observable for an `ndarray` of quaternions (w, x, y, z) along the last axis"""
+        raise NotImplementedError
+
+
+    def values(self):
+        """Observable for all molecules and save times as `ndarray` of shape (molecules, times)"""
+        return self.evaluate(self.ensemble.states()[..., :4])
+
+
+    def _weights(self):
+        weights = self.weights if self.weights is not None else getattr(self.ensemble, 'weights', None)
+        return np.ones(self.ensemble.size) if weights is None else np.asarray(weights)
+
 
     def __call__(self):
-        pass
+        """Expectation value at all save times"""
+        return np.average(self.values(), axis=0, weights=self._weights())
+
+
+    def by_species(self):
+        """Expectation values of the individual species of the ensemble at all save times
+
+        :return: `ndarray` of shape (species, times); NaN for species without molecules
+
+        """
+        species = getattr(self.ensemble, 'species', [None])
+        values = self.values()
+        index = getattr(self.ensemble, 'species_index', np.zeros(len(values), dtype=int))
+        return species_average(values, self._weights(), index[:len(values)], len(species))
+
+
+    def standard_error(self):
+        """Standard error of the expectation value at all save times
+
+        For weighted molecules this uses the effective sample size instead of the number of molecules.
+
+        """
+        values, weights = self.values(), self._weights()
+        mean = np.average(values, axis=0, weights=weights)
+        variance = np.average((values - mean)**2, axis=0, weights=weights)
+        n = np.sum(weights)**2 / np.sum(weights**2)
+        return np.sqrt(variance / max(n - 1, 1))
+
+
+
+def species_average(values, weights, index, count):
+    """Weighted averages of `values` (molecules, times) over the molecules of each of `count` species
+
+    :param index: Species of every molecule
+
+    :return: `ndarray` of shape (count, times); NaN for species without molecules
+
+    """
+    values = np.asarray(values)
+    sums = np.zeros((count,) + values.shape[1:])
+    np.add.at(sums, index, values * np.reshape(weights, (-1,) + (1,) * (values.ndim - 1)))
+    norm = np.bincount(index, weights=weights, minlength=count).reshape((-1,) + (1,) * (values.ndim - 1))
+    return np.divide(sums, norm, out=np.full_like(sums, np.nan), where=norm > 0)
+
+
+
+def molecular_axis(quaternions):
+    """Space-fixed direction of the molecular :math:`z` axis for an `ndarray` of quaternions
+
+    This is the third column of the rotation matrix of the (normalized) quaternions.
+
+    """
+    w, x, y, z = np.moveaxis(quaternions, -1, 0)
+    norm = w**2 + x**2 + y**2 + z**2
+    return np.stack((2*(x*z + w*y), 2*(y*z - w*x), w**2 - x**2 - y**2 + z**2), axis=-1) / norm[..., None]
+
 
 
 class cos2theta(Expectation):
-    pass
+    """Degree of alignment :math:`\\left<\\cos^2\\theta\\right>` of the molecular axis with the laboratory Z
+    axis"""
+
+    @staticmethod
+    def evaluate(quaternions):
+        return molecular_axis(quaternions)[..., 2]**2
+
+
+    @staticmethod
+    def derivative(quaternions, velocities):
+        """Time derivative of the observable for quaternions and angular velocities (molecular frame)"""
+        w, x, y, z = np.moveaxis(quaternions, -1, 0)
+        vx, vy, vz = np.moveaxis(velocities, -1, 0)
+        norm = w**2 + x**2 + y**2 + z**2
+        # quaternion kinematics, 0.5 * q * (0, omega), see kernels.derivative
+        dw, dx = -0.5 * (x*vx + y*vy + z*vz), 0.5 * (w*vx + y*vz - z*vy)
+        dy, dz = 0.5 * (w*vy + z*vx - x*vz), 0.5 * (w*vz + x*vy - y*vx)
+        cos = (w**2 - x**2 - y**2 + z**2) / norm
+        return 4 * cos * (w*dw - x*dx - y*dy + z*dz) / norm
+
 
 
 class cos2theta_2D(Expectation):
-    pass
+    """Degree of alignment :math:`\\left<\\cos^2\\theta_{2D}\\right>` of the molecular axis projected onto
+    the YZ plane"""
+
+    @staticmethod
+    def evaluate(quaternions):
+        axis = molecular_axis(quaternions)
+        projection = axis[..., 1]**2 + axis[..., 2]**2
+        return np.divide(axis[..., 2]**2, projection, out=np.ones_like(projection), where=projection > 0)
+
+
+
+# observables stored with every ensemble file, see :meth:`Ensemble.observables`
+observables = {'cos2theta': cos2theta, 'cos2theta_2D': cos2theta_2D}
+
+
+
+class ObservableSums(object):
+    """Weighted sums of the stored :data:`observables`, accumulated over chunks of molecules
+
+    This provides the expectation values stored with every ensemble file, see
+    :meth:`Ensemble.observables`, without holding all trajectories in memory; the sums are truncated to
+    the save times available for all molecules.
+
+    """
+
+    def __init__(self, species=1):
+        """Initialize empty sums for an ensemble with `species` species"""
+        self.species = species
+        self.time = None
+        self.norm = np.zeros(species)
+        self.sums = {}
+
+
+    def accumulate(self, states, weights, species_index=None):
+        """Add the trajectories `states` (molecules, frames, 8) with their `weights` and species"""
+        states = np.asarray(states)
+        if not len(states):
+            return
+        if self.time is None or states.shape[1] < len(self.time):
+            self.time = states[0, :, 7]
+            self.sums = {name: total[:, :len(self.time)] for name, total in self.sums.items()}
+        frames = len(self.time)
+        weights = np.asarray(weights, dtype=float)
+        index = np.zeros(len(states), dtype=int) if species_index is None else np.asarray(species_index)
+        self.norm += np.bincount(index, weights=weights, minlength=self.species)
+        for name, observable in observables.items():
+            values = weights[:, None] * observable.evaluate(states[:, :frames, :4])
+            total = self.sums.get(name, np.zeros((self.species, frames)))
+            np.add.at(total, index, values)
+            self.sums[name] = total
+
+
+    def result(self):
+        """Expectation values of all observables, and for several species the `dict` `species` of their
+        expectation values of shape (species, times)"""
+        result = {name: total.sum(axis=0) / self.norm.sum() for name, total in self.sums.items()}
+        if self.species > 1:
+            norm = self.norm[:, None]
+            result['species'] = {name: np.divide(total, norm, out=np.full_like(total, np.nan), where=norm > 0)
+                                 for name, total in self.sums.items()}
+        return result
+
+
+
+class AlignmentEvents(object):
+    """Local extrema of :math:`\\left<\\cos^2\\theta\\right>(t)` between the save times
+
+    The weighted sums of :math:`\\cos^2\\theta` and of its exact time derivative, calculated from the
+    angular velocities, are accumulated over chunks of molecules at all save times, as an analysis
+    stage of :class:`Propagate`. The expectation value is interpolated between the save times by cubic
+    Hermite polynomials of its values and derivatives, i.e., by a dense output of fourth order in the
+    save interval, and the extrema are refined to the roots of the derivative of the interpolant. Thus,
+    times and values of alignment maxima and revivals are obtained from a coarse grid of save times.
+
+    """
+
+    kinds = ('maximum', 'minimum')
+    labels = {'maximum': 'maxima', 'minimum': 'minima'}
+
+
+    def __init__(self, kinds=('maximum',)):
+        """Initialize empty sums
+
+        :param kinds: Kinds of events to detect, 'maximum' and/or 'minimum'
+
+        """
+        if not set(kinds) <= set(self.kinds):
+            raise ValueError(f'unknown events {sorted(set(kinds) - set(self.kinds))}')
+        self.kinds = tuple(kinds)
+        self.time = None
+        self.norm = 0.
+        self.sums = None
+
+
+    def accumulate(self, states, weights=None):
+        """Add the molecules with trajectories `states` (molecules, frames, 8)
+
+        :param weights: Statistical weights of the molecules (default: 1)
+
+        """
+        states = np.asarray(states)
+        if not len(states):
+            return self
+        if self.time is None or states.shape[1] < len(self.time):
+            self.time = states[0, :, 7].copy()
+            self.sums = None if self.sums is None else self.sums[:, :len(self.time)]
+        frames = len(self.time)
+        weights = np.ones(len(states)) if weights is None else np.asarray(weights, dtype=float)
+        values = np.stack((cos2theta.evaluate(states[:, :frames, :4]),
+                           cos2theta.derivative(states[:, :frames, :4], states[:, :frames, 4:7])))
+        sums = np.einsum('n,knt->kt', weights, values)
+        self.sums = sums if self.sums is None else self.sums + sums
+        self.norm += weights.sum()
+        return self
+
+
+    def events(self):
+        """Times and values of all detected events
+
+        :return: `dict` of the kinds of events with tuples of the `ndarray`s of their times and values
+
+        """
+        value, rate = self.sums / self.norm
+        t = self.time
+        events = {kind: ([], []) for kind in self.kinds}
+        for k in range(len(t) - 1):
+            h = t[k+1] - t[k]
+            for kind in self.kinds:
+                sign = 1 if kind == 'maximum' else -1
+                if not (sign * rate[k] > 0 and sign * rate[k+1] <= 0):
+                    continue
+                # derivative of the Hermite interpolant on [t_k, t_k+1] for s = (t - t_k)/h in [0, 1]
+                def derivative(s):
+                    return (6*s*(s-1) * (value[k] - value[k+1]) / h + (3*s*s - 4*s + 1) * rate[k]
+                            + (3*s*s - 2*s) * rate[k+1])
+                s = scipy.optimize.brentq(derivative, 0., 1.) if derivative(1.) != 0 else 1.
+                events[kind][0].append(t[k] + s * h)
+                events[kind][1].append((2*s**3 - 3*s*s + 1) * value[k] + (s**3 - 2*s*s + s) * h * rate[k]
+                                       + (3*s*s - 2*s**3) * value[k+1] + (s**3 - s*s) * h * rate[k+1])
+        return {kind: (np.array(times), np.array(values)) for kind, (times, values) in events.items()}
+
+
+    @classmethod
+    def report(cls, events):
+        """Human-readable table of the times and values of `events`, see :meth:`events`"""
+        lines = []
+        for kind, (times, values) in (events or {}).items():
+            lines.append(f'Alignment {cls.labels[kind]} (t, <cos^2 theta>)')
+            lines.extend(f'  {t:.6g} s  {value:.6f}' for t, value in zip(times, values))
+        return '\n'.join(lines)
+
+
+
+def expectation_from_file(filename, observable=cos2theta, chunk=1000):
+    """Expectation value of `observable` at all save times of a stored ensemble
+
+    The precomputed values of :meth:`Ensemble.observables` are used when present; otherwise, the
+    trajectories are read and evaluated in chunks of `chunk` molecules, such that files of any size
+    can be processed without creating |Molecule|s.
+
+    :return: Tuple of the `ndarray`s of the save times and of the expectation values, and the field
+    amplitudes (`ndarray` or `None`)
+
+    """
+    from cmiclassirot.storage import load_metadata, load_states
+    metadata, size = load_metadata(filename)
+    stored = metadata.get('observables') or {}
+    if observable.__name__ in stored:
+        return stored['time'], stored[observable.__name__], stored['field']
+    weights = np.asarray(metadata.get('weights', np.ones(size)), dtype=float)
+    total, time = 0., None
+    for start in range(0, size, chunk):
+        states = load_states(filename, slice(start, start + chunk))[0]
+        if time is None or len(states[0]) < len(time):
+            time = states[0, :, 7]
+            total = total[..., :len(time)] if start else 0.
+        total = total + weights[start:start+chunk] @ observable.evaluate(states[:, :len(time), :4])
+    pulse = metadata.get('E')
+    return time, total / weights.sum(), np.asarray(pulse(time), dtype=float) if callable(pulse) else None
+
+
+
+class Reweighting(object):
+    """Expectation values at many temperatures from a single propagated :class:`Ensemble`
+
+    The thermal ensemble, ideally sampled at a temperature above all targeted ones, is reweighted to
+    the Boltzmann distribution of every requested temperature, see :meth:`Ensemble.reweight`. The
+    effective sample size indicates how reliable the reweighted expectation values are; it should be
+    a sizable fraction of the ensemble size.
+
+    """
+
+    def __init__(self, ensemble, observable=cos2theta):
+        self.ensemble = ensemble
+        self.observable = observable
+        self.values = self.observable(ensemble).values()
+
+
+    def __call__(self, T):
+        """Expectation value at all save times and effective sample size at temperature `T`"""
+        weights = self.ensemble.reweight(T)
+        return np.average(self.values, axis=0, weights=weights), self.ensemble.effective_sample_size(weights)
+
+
+    def scan(self, temperatures):
+        """Expectation values for all `temperatures`
+
+        :return: `ndarray` of shape (temperatures, times) of the expectation values and `ndarray` of
+        the effective sample sizes
+
+        """
+        results = [self(T) for T in temperatures]
+        return np.array([r[0] for r in results]), np.array([r[1] for r in results])
+
+
+
+class DetectorImage(object):
+    """Detector images of the molecular-axis direction, e.g., for Coulomb-explosion imaging
+
+    For every save time, the directions of the molecular axes, i.e., of the fragment momenta of an
+    axial recoil, are projected onto the detector plane (default: the YZ plane, i.e., the detector
+    normal is X and the alignment-laser polarization Z lies in the detector plane) and binned into an
+    image of `bins` x `bins` pixels covering the unit circle. Images are accumulated from chunks of
+    molecules, either from stored files (:meth:`from_file`) or during the propagation as a stage of
+    :class:`Propagate`, such that trajectories never need to be kept in memory completely.
+
+    """
+
+    def __init__(self, bins=64, normal=(1., 0., 0.), acceptance=None, symmetric=True):
+        """Initialize empty image stack
+
+        :param bins: Number of pixels along both detector axes
+
+        :param normal: Normal vector of the detector plane; the horizontal image axis `u` is the
+        projection of the laboratory axis most perpendicular to the normal, the vertical axis `v`
+        completes the right-handed system, e.g., Y and Z for the default normal X
+
+        :param acceptance: Only molecular axes within this angle (rad) of the detector plane are
+        detected (default: None, i.e., all)
+
+        :param symmetric: Image both ends of the molecular axis, as for the two fragments of a
+        symmetric molecule
+
+        """
+        self.bins = bins
+        self.normal = np.asarray(normal, dtype=float) / np.linalg.norm(normal)
+        # orthonormal basis (u, v) of the detector plane
+        order = np.argsort(np.abs(self.normal))
+        u = np.eye(3)[order[0]] - self.normal[order[0]] * self.normal
+        self.u = u / np.linalg.norm(u)
+        self.v = np.cross(self.normal, self.u)
+        self.acceptance = acceptance
+        self.symmetric = symmetric
+        self.images = None
+        self.time = None
+        self.molecules = 0
+
+
+    def accumulate(self, states, weights=None):
+        """Add the molecules with trajectories `states` (molecules, frames, 8) to the images
+
+        :param weights: Statistical weights of the molecules (default: 1)
+
+        """
+        states = np.asarray(states)
+        if not len(states):
+            return self
+        if self.images is None:
+            self.time = states[0, :, 7].copy()
+            self.images = np.zeros((len(self.time), self.bins, self.bins))
+        elif states.shape[1] < len(self.time):
+            self.time = states[0, :, 7].copy()
+            self.images = self.images[:len(self.time)].copy()
+        frames = len(self.time)
+        axis = molecular_axis(states[:, :frames, :4])
+        weights = np.ones(len(states)) if weights is None else np.asarray(weights, dtype=float)
+        weights = np.broadcast_to(weights[:, None], axis.shape[:2])
+        if self.acceptance is not None:
+            weights = weights * (np.abs(axis @ self.normal) <= np.sin(self.acceptance))
+        pixels = []
+        for sign in ((1, -1) if self.symmetric else (1,)):
+            u = np.clip(((sign * axis @ self.u + 1) / 2 * self.bins).astype(int), 0, self.bins - 1)
+            v = np.clip(((sign * axis @ self.v + 1) / 2 * self.bins).astype(int), 0, self.bins - 1)
+            pixels.append((np.arange(frames) * self.bins + v) * self.bins + u)
+        for index in pixels:
+            self.images += np.bincount(index.ravel(), weights=weights.ravel(),
+                                       minlength=self.images.size).reshape(self.images.shape)
+        self.molecules += len(states)
+        return self
+
+
+    @classmethod
+    def from_file(cls, filename, chunk=1000, **kwargs):
+        """Detector images of a stored ensemble, read in chunks of `chunk` molecules"""
+        from cmiclassirot.storage import load_metadata, load_states
+        metadata, size = load_metadata(filename)
+        weights = np.asarray(metadata.get('weights', np.ones(size)), dtype=float)
+        image = cls(**kwargs)
+        for start in range(0, size, chunk):
+            image.accumulate(load_states(filename, slice(start, start + chunk))[0], weights[start:start+chunk])
+        return image
+
+
+    def normalized(self):
+        """Images normalized to unit sum at every save time"""
+        total = self.images.sum(axis=(1, 2), keepdims=True)
+        return np.divide(self.images, total, out=np.zeros_like(self.images), where=total > 0)
+
+
+    def save(self, filename, complevel=5):
+        """Write the image stack as compressed HDF5 array `/images` (times, v, u) with the save times `/time`"""
+        import tables
+        with tables.open_file(filename, mode='w') as f:
+            filters = tables.Filters(complevel=complevel, complib='blosc:zstd', shuffle=True)
+            f.create_carray('/', 'images', obj=self.images.astype(np.float32), filters=filters)
+            f.create_array('/', 'time', self.time)
+            for name in ('bins', 'normal', 'u', 'v', 'acceptance', 'symmetric', 'molecules'):
+                setattr(f.root._v_attrs, name, getattr(self, name))
 
 
 
@@ -0,0 +1,146 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+
+import numpy as np
+
+
+# counters recorded for every propagated molecule
+counters = ('rhs_calls', 'rhs_time', 'field_calls', 'field_time', 'steps', 'rejected_steps',
+            'wall_time', 'pickle_time')
+
+
+
+class TimedField(object):
+    """Proxy of a :class:`Field` that counts and times its evaluations"""
+
+    def __init__(self, field, stats):
+        self.field = field
+        self.stats = stats
+
+
+    def __call__(self, t):
+        starttime = time.perf_counter()
+        amplitude = self.field(t)
+        self.stats['field_time'] += time.perf_counter() - starttime
+        self.stats['field_calls'] += 1
+        return amplitude
+
+
+    def __getattr__(self, name):
+        if name == 'field':
+            raise AttributeError(name)
+        return getattr(self.field, name)
+
+
+
+class PropagationStatistics(object):
+    """Instrumentation data of a propagation
+
+    Collects the per-molecule counts and cumulative times of right-hand-side (RHS) and field
+    evaluations, accepted and rejected solver steps, wall time, and result pickling time, together
+    with the process that propagated the molecule. From these, the utilization and idle time of the
+    worker pool are derived. The time spent writing the output file is added as `io_time` by
+    :meth:`Ensemble._save`.
+
+    The kernels of the batched backends are not instrumented; they record the size, the steps per
+    molecule, and the wall time of every batch in `batches`, which are excluded from the per-molecule
+    totals, outliers, and utilization.
+
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.molecules = []
+        self.batches = []
+        self.wall_time = 0.
+        self.io_time = 0.
+
+
+    @staticmethod
+    def counters():
+        """New set of per-molecule counters"""
+        return dict.fromkeys(counters, 0)
+
+
+    def add(self, stats):
+        """Add the counters of one propagated molecule"""
+        self.molecules.append(stats)
+
+
+    def add_batch(self, size, steps, wall_time):
+        """Add a batch of `size` molecules propagated simultaneously with `steps` steps each"""
+        self.batches.append({'molecules': size, 'steps': steps, 'wall_time': wall_time})
+
+
+    def as_dict(self, outliers=10):
+        """Summary of the statistics as `dict`
+
+        :param outliers: Number of molecules with most solver steps to list individually, to identify
+        stiff outliers
+
+        """
+        totals = {key: float(sum(stats[key] for stats in self.molecules)) for key in counters}
+        busy = {}
+        for stats in self.molecules:
+            busy[stats['pid']] = busy.get(stats['pid'], 0.) + stats['wall_time']
+        # the pool is only measured by the molecules propagated individually
+        capacity = self.workers * self.wall_time if self.molecules else 0.
+        steps = np.array([stats['steps'] for stats in self.molecules])
+        return {'molecules': len(self.molecules) + sum(batch['molecules'] for batch in self.batches),
+                'workers': self.workers,
+                'wall_time': self.wall_time,
+                'io_time': self.io_time,
+                'totals': totals,
+                'steps_per_molecule': {'mean': float(steps.mean()) if len(steps) else 0.,
+                                       'max': int(steps.max()) if len(steps) else 0},
+                'utilization': totals['wall_time'] / capacity if capacity > 0 else None,
+                'idle_time': max(capacity - totals['wall_time'], 0.) if capacity > 0 else None,
+                'worker_busy_time': sorted(busy.values(), reverse=True),
+                'outliers': sorted(self.molecules, key=lambda stats: stats['steps'], reverse=True)[:outliers],
+                'batches': self.batches}
+
+
+    def to_json(self):
+        return json.dumps(self.as_dict())
+
+
+    def report(self):
+        """Human-readable summary of the statistics"""
+        stats = self.as_dict(outliers=3)
+        totals = stats['totals']
+        batches = stats.get('batches', [])
+        if batches:
+            return '\n'.join([
+                f"  {stats['molecules']} molecules in {len(batches)} batches in {stats['wall_time']:.3g} s,"
+                + f" {max(batch['steps'] for batch in batches)} steps per molecule",
+                f"  batches: {sum(batch['wall_time'] for batch in batches):.3g} s;"
+                + " the batched kernels are not instrumented per molecule, no RHS, field, utilization, or outlier"
+                + " statistics"])
+        lines = [f"  {stats['molecules']} molecules on {stats['workers']} workers in {stats['wall_time']:.3g} s,"
+                 + f" utilization {100 * stats['utilization']:.1f} %, idle {stats['idle_time']:.3g} CPU-s",
+                 f"  RHS evaluations: {totals['rhs_calls']:.0f} in {totals['rhs_time']:.3g} s,"
+                 + f" field evaluations: {totals['field_calls']:.0f} in {totals['field_time']:.3g} s",
+                 f"  solver steps: {totals['steps']:.0f} ({totals['rejected_steps']:.0f} rejected),"
+                 + f" max {stats['steps_per_molecule']['max']} per molecule",
+                 f"  pickling results: {totals['pickle_time']:.3g} s"]
+        for outlier in stats['outliers']:
+            lines.append(f"  molecule {outlier['index']}: {outlier['steps']} steps, {outlier['wall_time']:.3g} s")
+        return '\n'.join(lines)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sys
+import time
+
+
+
+class Progress(object):
+    """Progress report of an ensemble propagation
+
+    Progress is counted in completed molecules, each of which corresponds to the propagation over
+    `duration` of simulated time. The report contains the throughput in simulated molecule-picoseconds
+    per second of wall time and an estimated time of arrival (ETA). It is printed to `stream` and,
+    optionally, written as JSON to `status_file` for polling by schedulers; both happen at most every
+    `interval` seconds, such that the overhead per completed molecule is negligible.
+
+    """
+
+    def __init__(self, total, duration, stream=sys.stderr, status_file=None, interval=1.):
+        """Initialize progress report
+
+        :param total: Number of molecules to propagate
+
+        :param duration: Simulated time per molecule (s)
+
+        :param stream: Text stream for the report, or `None` for no terminal output
+
+        :param status_file: Name of the JSON status file, or `None`
+
+        :param interval: Minimal time between updates of the report (s)
+
+        """
+        self.total = total
+        self.duration = duration
+        self.stream = stream
+        self.status_file = status_file
+        self.interval = interval
+        self.completed = 0
+        self.starttime = time.monotonic()
+        self.reported = self.starttime - interval
+
+
+    def add_total(self, n):
+        """Increase the number of molecules to propagate by `n`"""
+        self.total += n
+
+
+    def update(self, n=1):
+        """Register `n` completed molecules and report if the last report is older than `interval`"""
+        self.completed += n
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+
+    def status(self, state='running'):
+        """Current progress as `dict`"""
+        elapsed = time.monotonic() - self.starttime
+        rate = self.completed / elapsed if elapsed > 0 else 0.
+        return {'state': state,
+                'completed': self.completed,
+                'total': self.total,
+                'fraction': self.completed / self.total if self.total else 1.,
+                'simulated_time': self.completed * self.duration,
+                'elapsed': elapsed,
+                'molecules_per_second': rate,
+                'throughput': rate * self.duration * 1e12,
+                'eta': (self.total - self.completed) / rate if rate > 0 else None,
+                'updated': time.time()}
+
+
+    def report(self, state='running'):
+        """Print the progress and write the status file"""
+        status = self.status(state)
+        if self.stream is not None:
+            eta = '?' if status['eta'] is None else f"{status['eta']:.0f} s"
+            line = (f"  {status['completed']}/{status['total']} molecules ({100 * status['fraction']:.1f} %),"
+                    + f" {status['throughput']:.3g} molecule-ps/s, ETA {eta}")
+            if self.stream.isatty():
+                self.stream.write('\r' + line + ('\n' if state != 'running' else ''))
+            else:
+                self.stream.write(line + '\n')
+            self.stream.flush()
+        if self.status_file is not None:
+            # write atomically, such that pollers never read a partial file
+            tmpname = f'{self.status_file}.{os.getpid()}.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump(status, f)
+            os.replace(tmpname, self.status_file)
+        return status
+
+
+    def close(self, state='finished'):
+        """Final report"""
+        return self.report(state)
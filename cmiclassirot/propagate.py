@@ -16,18 +16,33 @@
 # You should have received a copy of the GNU General Public License along with this program. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import copy
+import os
+import pickle
+import sys
+import time
+
 import numpy as np
 import scipy.integrate
 import pyquaternion as quat
 import multiprocessing as mp
 
+from cmiclassirot import kernels
+from cmiclassirot.field import PulseTrain
+from cmiclassirot.postprocessing import AlignmentEvents, cos2theta
+from cmiclassirot.profiling import PropagationStatistics, TimedField
+from cmiclassirot.progress import Progress
 from cmiclassirot.sample import Position
 
 
 class Propagate(object):
     """Propagate an Ensemble in time"""
 
-    def __init__(self, ensemble, field, timerange=(0,1e-9), dt_save=None):
+    def __init__(self, ensemble, field, timerange=(0,1e-9), dt_save=None, cache=None, solver=None,
+                 target_error=None, observable=cos2theta, batch_size=None, max_size=None, profile=False,
+                 progress=False, status_file=None, schedule='dynamic', chunksize=None,
+                 ordering=None, processes=None, stages=(), output=None, compact=None, events=(),
+                 pool=None):
         """Initialize propagator
 
         :param ensemble: :class:`Ensemble` with all |Molecule|s to be propagated
@@ -40,7 +55,83 @@ class Propagate(object):
         :param dt_save: Timesteps for saving the current phase-space positions of the
         :param:`Molecule`s during propagation (default: 1 % of timerange period)
 
+        :param cache: :class:`cmiclassirot.cache.ResultCache` in which to look up and store the
+        propagated ensemble (default: None, i.e., always propagate)
+
+        :param solver: `dict` of solver settings overriding the defaults `integrator='dopri5'`,
+        `nsteps=10000`, and `backend='scipy'`. With `backend='numpy'` or `backend='numba'` the whole
+        ensemble is integrated by the fixed-step Runge-Kutta kernels of :mod:`cmiclassirot.kernels`
+        with steps of at most `dt_step` (s) (default: estimated from the pulse duration and the
+        angular velocities), instead of molecule by molecule with `integrator`. Their state arrays and
+        field tables, and the stored trajectories, are of `dtype`, 'float64' (default) or 'float32'.
+        With `backend='sudden'` the molecules are propagated in the impulsive limit, see
+        :class:`cmiclassirot.impulsive.SuddenKick`, which is validated against the full integration of
+        the first `validate` molecules (default: 20; 0 disables the check) with the tolerance
+        `tolerance` (default: 0.01) of the expectation values of :class:`cos2theta`; the result is
+        stored as `validation`
+
+        :param target_error: If specified, the ensemble is propagated in batches and extended by newly
+        sampled molecules until the standard error of the `observable` is below `target_error` at all
+        save times, or until it contains `max_size` molecules (default: None, i.e., propagate the
+        given ensemble only)
+
+        :param observable: :class:`Expectation` class whose convergence is monitored (default:
+        :class:`cos2theta`)
+
+        :param batch_size: Number of molecules added per batch (default: initial ensemble size)
+
+        :param max_size: Maximum size of the ensemble in convergence mode (default: 100 batches)
+
+        :param profile: Collect instrumentation data of the propagation in `statistics`, a
+        :class:`PropagationStatistics` object that is also written to the output file (default: False)
+
+        :param progress: Report the progress of the propagation on the terminal, or a
+        :class:`Progress` object to which it is reported (default: False)
+
+        :param status_file: Name of a JSON file to which the progress is written for polling, see
+        :class:`Progress` (default: None)
+
+        :param schedule: Distribution of the molecules over the worker processes. 'dynamic' hands out
+        small work units, optionally most expensive first, to whichever worker becomes idle, such
+        that no worker idles at the end of the run; 'static' splits the ensemble in order into few large chunks, as
+        `Pool.map` does (default: 'dynamic')
+
+        :param chunksize: Number of molecules per work unit (default: 1 for 'dynamic' scheduling and
+        a quarter of the share of every worker for 'static' scheduling)
+
+        :param ordering: Cost estimate used to order the work units for 'dynamic' scheduling,
+        'velocity', 'pilot', or None for no reordering; see :meth:`_cost`. Neither estimate improved
+        the balance of the hot nanorod benchmark over unordered single-molecule units, see the user
+        manual (default: None)
+
+        :param processes: Number of worker processes; with 1, the scipy backend integrates the molecules
+        in this process (default: number of CPUs)
+
+        :param pool: Worker pool of the scipy backend that is shared with other propagations, e.g., by
+        the :mod:`cmiclassirot.server`; its workers must not be more than `processes` (default: None,
+        i.e., create and close a pool of `processes` workers)
+
+        :param stages: Analysis stages, objects with a method `accumulate(states, weights)` like
+        :class:`DetectorImage`, that are fed with the trajectories of every propagated batch of
+        molecules, see :meth:`Ensemble.states`
+
+        :param output: Name of the file to which the propagated ensemble is written, see
+        :meth:`Ensemble._save`; required for out-of-core ensembles, i.e., ensembles with a `chunk_size`,
+        which are generated, propagated, and written chunk by chunk (default: None)
+
+        :param compact: Options of the compact output format, see :meth:`Ensemble._save`
+
+        :param events: Kinds of events of the ensemble, 'maximum' and/or 'minimum' of
+        :math:`\\left<\\cos^2\\theta\\right>`, that are located between the save times, see
+        :class:`AlignmentEvents`; their times and values are stored as `events` in the propagator and in
+        the :class:`Ensemble`, and thus in its file (default: none)
+
         """
+        if getattr(ensemble, 'chunk_size', None) is not None:
+            if output is None:
+                raise ValueError('out-of-core ensembles require an output file')
+            if cache is not None or target_error is not None:
+                raise ValueError('out-of-core ensembles support neither caching nor convergence control')
         self.ensemble = ensemble
         self.field = field
         if dt_save:
@@ -48,23 +139,454 @@ class Propagate(object):
         else:
             self.dt_save = timerange[1] - timerange[0]
         self.t_range = timerange
+        self.solver = {'integrator': 'dopri5', 'nsteps': 10000, 'backend': 'scipy'}
+        if solver:
+            self.solver.update(solver)
+        if self.solver.get('dtype', 'float64') not in ('float64', 'float32'):
+            raise ValueError(f"unknown dtype {self.solver['dtype']}")
+        if self.solver.get('dtype', 'float64') != 'float64' and self.solver['backend'] in ('scipy', 'sudden'):
+            raise ValueError('single precision requires a batched backend')
+        if self.solver['backend'] not in ('scipy', 'sudden') + kernels.backends:
+            raise ValueError(f"unknown backend {self.solver['backend']}")
+        if self.solver['backend'] == 'numba' and not kernels.available('numba'):
+            print('numba is not installed, using the numpy backend')
+            self.solver['backend'] = 'numpy'
+        self.cache = cache
+        self.target_error = target_error
+        self.observable = observable
+        self.batch_size = batch_size if batch_size else ensemble.size
+        self.max_size = max_size if max_size else 100 * self.batch_size
+        if schedule not in ('dynamic', 'static'):
+            raise ValueError(f'unknown schedule {schedule}')
+        self.schedule = schedule
+        if ordering not in ('velocity', 'pilot', None):
+            raise ValueError(f'unknown ordering {ordering}')
+        self.chunksize = chunksize
+        self.ordering = ordering
+        self.processes = processes if processes else mp.cpu_count()
+        self.stages = list(stages)
+        self.events = None
+        if events:
+            self.stages.append(AlignmentEvents(events))
+        self.output = output
+        self.compact = compact
+        self.batch = None
+        self.validation = None
+        self.profile = profile
+        self.statistics = None
+        self.pool = pool
+        self.progress = None
+        if isinstance(progress, Progress):
+            self.progress = progress
+        elif progress or status_file:
+            self.progress = Progress(0, timerange[1] - timerange[0], stream=sys.stderr if progress else None,
+                                     status_file=status_file)
         self.run()
 
 
+    def __getstate__(self):
+        # worker processes only need the propagation parameters, not the ensemble and its bookkeeping
+        state = self.__dict__.copy()
+        for name in ('ensemble', 'cache', 'statistics', 'progress', 'stages', 'pool'):
+            state[name] = None
+        return state
+
+
     def run(self):
-        """Propagate all |Molecule|s in the current |Field| over the current time range"""
-        n_cpu = mp.cpu_count()
+        """Propagate all |Molecule|s in the current |Field| over the current time range
+
+        If a :class:`ResultCache` is set and contains the result for identical inputs, the stored
+        ensemble is loaded instead of propagating it again; it is still written to `output`.
+
+        """
+        if self.cache is not None:
+            key = self.cache.key(self)
+            filename = self.cache.lookup(key)
+            if filename is not None:
+                print(f'Using cached result {key}')
+                self.ensemble._load(filename)
+                self._accumulate(self.ensemble.molecules, self.ensemble.weights)
+                self._events()
+                if self.output is not None:
+                    self.ensemble._save(self.output, compact=self.compact)
+                if self.progress is not None:
+                    self.progress.close()
+                return self.ensemble
+        n_cpu = self.processes
         print(f'Running on: {n_cpu} CPUs')
+        starttime = time.perf_counter()
+        if self.profile:
+            self.statistics = PropagationStatistics(n_cpu)
+            self.ensemble.statistics = self.statistics
         self.ensemble.pulse = self.field
-        pool = mp.Pool(n_cpu)
-        results = pool.map(self._propagate, self.ensemble.molecules)
-        pool.close()
-        pool.join()
-        for i in range(len(results)):
-             self.ensemble.molecules[i] = results[i]
+        self.ensemble.dtype = self.solver.get('dtype', 'float64')
+        # the batched backends run in this process, numba parallelizes over molecules in threads; a
+        # single process integrates serially without a pool, e.g., within the workers of an outer pool
+        pool = None
+        if self.solver['backend'] == 'scipy':
+            pool = self.pool if self.pool is not None or n_cpu == 1 else mp.Pool(n_cpu)
+        if self.solver['backend'] in kernels.backends:
+            self.batch = self._batch_setup(self._max_velocity())
+        if self.ensemble.chunk_size is not None:
+            self._stream(pool)
+        else:
+            results = self._map(pool, self.ensemble.molecules)
+            for i in range(len(results)):
+                 self.ensemble.molecules[i] = results[i]
+            self._accumulate(results, self.ensemble.weights)
+            if self.target_error is not None:
+                self._converge(pool)
+            self._events()
+            if self.output is not None:
+                self.ensemble._save(self.output, compact=self.compact)
+        if pool is not None and pool is not self.pool:
+            pool.close()
+            pool.join()
+        if self.profile:
+            self.statistics.wall_time = time.perf_counter() - starttime
+        if self.progress is not None:
+            self.progress.close()
+        if self.cache is not None:
+            self.cache.store(key, self.ensemble)
+        return self.ensemble
+
+
+    def _events(self):
+        """Store the events of the :class:`AlignmentEvents` stage in the propagator and the ensemble"""
+        for stage in self.stages:
+            if isinstance(stage, AlignmentEvents):
+                self.events = self.ensemble.events = stage.events()
+
+
+    def _converge(self, pool):
+        """Extend the propagated ensemble in batches until the observable is converged
+
+        The weighted mean and variance of the observable at all save times are accumulated batch by
+        batch; as in :meth:`Expectation.standard_error`, the standard error uses the effective sample
+        size of the weights. The achieved precision is stored as `precision` in the :class:`Ensemble`,
+        and thus in its file.
+
+        """
+        values = self.observable.evaluate(self.ensemble.states()[..., :4])
+        weights = np.asarray(self.ensemble.weights[:len(values)], dtype=float)
+        n = len(values)
+        norm, norm2 = weights.sum(), (weights**2).sum()
+        total, squares = weights @ values, weights @ values**2
+        while True:
+            mean = total / norm
+            effective = norm**2 / norm2
+            error = np.sqrt(np.maximum(squares/norm - mean**2, 0) / max(effective - 1, 1))
+            print(f'  {n} molecules: standard error of {self.observable.__name__} is {error.max():.2g}')
+            if error.max() <= self.target_error or self.ensemble.size >= self.max_size:
+                break
+            molecules = self.ensemble.extend(min(self.batch_size, self.max_size - self.ensemble.size))
+            results = self._map(pool, molecules)
+            self.ensemble.molecules[-len(results):] = results
+            self._accumulate(results, self.ensemble.weights[-len(results):])
+            values = self.observable.evaluate(np.array([mol.states()[:len(total), :4] for mol in results]))
+            weights = np.asarray(self.ensemble.weights[-len(results):], dtype=float)
+            n, norm, norm2 = n + len(values), norm + weights.sum(), norm2 + (weights**2).sum()
+            total, squares = total + weights @ values, squares + weights @ values**2
+        self.standard_error = error
+        self.ensemble.precision = {'observable': self.observable.__name__, 'target_error': self.target_error,
+                                   'standard_error': error.max(), 'size': self.ensemble.size,
+                                   'converged': bool(error.max() <= self.target_error)}
         return self.ensemble
 
 
+    def _stream(self, pool):
+        """Generate, propagate, and write an out-of-core ensemble chunk by chunk
+
+        Only the molecules of one chunk are held in memory; the stored expectation values and the
+        analysis stages are accumulated chunk by chunk. The written file is identical to that of the
+        same ensemble propagated in memory, up to the rounding of the summation of expectation values.
+
+        """
+        from cmiclassirot.postprocessing import ObservableSums
+        ensemble = self.ensemble
+        writer = ensemble._writer(self.output, self.compact)
+        sums = ObservableSums(len(ensemble.species))
+        io_time = 0.
+        if self.progress is not None:
+            self.progress.add_total(ensemble.size)
+        for start, molecules in ensemble.chunks():
+            results = self._map(pool, molecules)
+            weights = ensemble.weights[start:start+len(results)]
+            self._accumulate(results, weights)
+            states = [mol.states() for mol in results]
+            frames = min(len(state) for state in states)
+            sums.accumulate(np.array([state[:frames] for state in states]), weights,
+                            ensemble.species_index[start:start+len(results)])
+            starttime = time.perf_counter()
+            writer.append(states)
+            io_time += time.perf_counter() - starttime
+        self._events()
+        writer.close(ensemble._header(ensemble._observables(sums), io_time))
+
+
+    def _accumulate(self, molecules, weights):
+        """Feed the trajectories of propagated `molecules` to all analysis stages"""
+        if self.stages and len(molecules):
+            states = [mol.states() for mol in molecules]
+            frames = min(len(state) for state in states)
+            states = np.array([state[:frames] for state in states])
+            for stage in self.stages:
+                stage.accumulate(states, weights)
+
+
+    def _map(self, pool, molecules):
+        """Propagate `molecules` on the worker `pool`
+
+        Results are streamed back as soon as individual molecules are completed, which drives the
+        progress report.
+
+        :return: `list` of the propagated molecules
+
+        """
+        # out-of-core ensembles register their total size once, see :meth:`_stream`
+        if self.progress is not None and self.ensemble.chunk_size is None:
+            self.progress.add_total(len(molecules))
+        if self.solver['backend'] != 'scipy':
+            return self._propagate_batches(molecules)
+        offset = len(self.statistics.molecules) if self.profile else 0
+        function = self._propagate_profiled if self.profile else self._propagate_indexed
+        items = list(enumerate(molecules, offset))
+        if self.schedule == 'dynamic':
+            chunksize = self.chunksize or 1
+            if self.ordering is not None:
+                items = [items[i] for i in np.argsort(-self._cost(pool, molecules), kind='stable')]
+        else:
+            chunksize = self.chunksize or max(1, -(-len(items) // (4 * self.processes)))
+        results = [None] * len(molecules)
+        completed = pool.imap_unordered(function, items, chunksize) if pool is not None else map(function, items)
+        for index, molecule, stats in completed:
+            results[index - offset] = molecule
+            if stats is not None:
+                self.statistics.add(stats)
+            if self.progress is not None:
+                self.progress.update()
+        return results
+
+
+    def _cost(self, pool, molecules):
+        """Estimate the relative cost of propagating `molecules`
+
+        With `ordering='velocity'` the cost is estimated from the magnitude of the initial angular
+        velocity, i.e., from the angle a molecule sweeps over the time range without field. With
+        `ordering='pilot'` a pilot integration with loose tolerance and without intermediate output is
+        run on the worker `pool` and its number of steps is used; this accounts for the kick of the
+        field and typically costs 10-20 % of the actual propagation.
+
+        :return: `ndarray` of the estimated costs
+
+        """
+        if self.ordering == 'pilot':
+            return np.array(list((pool.map if pool is not None else map)(self._pilot, molecules)), dtype=float)
+        return np.array([np.linalg.norm(mol.pos[0].velocity) for mol in molecules])
+
+
+    def _pilot(self, molecule):
+        """Number of steps of a loose-tolerance dopri5 integration of `molecule` over the time range"""
+        integral = scipy.integrate.ode(self._derivative)
+        integral.set_integrator('dopri5', nsteps=self.solver['nsteps'], rtol=1e-3)
+        integral.set_initial_value(np.concatenate((molecule.pos[0].angle.elements, molecule.pos[0].velocity)),
+                                   self.t_range[0]).set_f_params(molecule)
+        integral.integrate(self.t_range[1])
+        return int(integral._integrator.iwork[17])
+
+
+    def _propagate_indexed(self, item):
+        """Propagate an individual molecule given as tuple of index and :class:`Molecule`
+
+        :return: Tuple of the index, the propagated molecule, and `None`
+
+        """
+        index, molecule = item
+        return index, self._propagate(molecule), None
+
+
+    def _propagate_profiled(self, item):
+        """Propagate an individual molecule and collect its instrumentation data
+
+        :param item: Tuple of the index and the :class:`Molecule` to propagate
+
+        :return: Tuple of the index, the propagated molecule, and its counters, see
+        :class:`PropagationStatistics`
+
+        """
+        index, molecule = item
+        stats = PropagationStatistics.counters()
+        stats['index'], stats['pid'] = index, os.getpid()
+        # time the field evaluations through a proxy in a shallow copy of the propagator
+        propagator = copy.copy(self)
+        propagator.field = TimedField(self.field, stats)
+        starttime = time.perf_counter()
+        molecule = propagator._propagate(molecule, stats)
+        stats['wall_time'] = time.perf_counter() - starttime
+        starttime = time.perf_counter()
+        pickle.dumps(molecule)
+        stats['pickle_time'] = time.perf_counter() - starttime
+        return index, molecule, stats
+
+
+    def _propagate_batches(self, molecules, batch=1024):
+        """Propagate `molecules` with the batched backend in batches of at most `batch` molecules
+
+        :return: `list` of the propagated molecules
+
+        """
+        results = []
+        for start in range(0, len(molecules), batch):
+            chunk = molecules[start:start+batch]
+            starttime = time.perf_counter()
+            steps = self._propagate_batch(chunk)
+            if self.profile:
+                # the kernels are not instrumented per molecule
+                self.statistics.add_batch(len(chunk), steps, time.perf_counter() - starttime)
+            if self.progress is not None:
+                self.progress.update(len(chunk))
+            results.extend(chunk)
+        return results
+
+
+    def _propagate_batch(self, molecules):
+        """Propagate `molecules` simultaneously with the fixed-step kernels of the batched backend
+
+        The molecules are integrated with steps of equal size that evenly divide the save interval,
+        using a table of the field amplitudes at all (half) steps, see :meth:`_batch_setup`. The save
+        times are the same as those of :meth:`_propagate`.
+
+        The integration is performed in units of the save interval, of the largest moment of inertia,
+        and of the largest field amplitude, such that all quantities are of order one and single
+        precision neither under- nor overflows; times and the conversion back are in double precision.
+
+        :return: Number of integration steps per molecule
+
+        """
+        if self.solver['backend'] == 'sudden':
+            return self._propagate_sudden(molecules)
+        y0 = np.array([np.concatenate((mol.pos[0].angle.elements, mol.pos[0].velocity)) for mol in molecules])
+        velocity = np.abs(y0[:, 4:]).max()
+        if self.batch is None or velocity > self.batch['velocity']:
+            # molecules added in convergence mode may rotate faster than the initial ensemble
+            self.batch = self._batch_setup(velocity)
+        times, m, table = self.batch['times'], self.batch['steps'], self.batch['table']
+        I, P, factor = kernels.parameters(molecules)
+        mu, dc = kernels.dipoles(molecules), self.batch['dc']
+        # reduced units
+        dtype = np.dtype(self.solver.get('dtype', 'float64'))
+        tau, I_ref, E_ref = self.dt_save, self.batch['I_ref'], self.batch['E_ref']
+        if dc is not None:
+            mu, dc = (mu * (tau**2 * E_ref / I_ref)).astype(dtype), (np.asarray(dc) / E_ref).astype(dtype)
+        y0[:, 4:] *= tau
+        y = kernels.integrate(self.solver['backend'], y0.astype(dtype), len(times), m,
+                              dtype.type(self.dt_save / m / tau), (table / E_ref).astype(dtype),
+                              np.asarray(self.field.Ez, dtype=dtype), (I / I_ref).astype(dtype),
+                              (P * (tau**2 * E_ref**2 / I_ref)).astype(dtype), factor.astype(dtype), mu, dc)
+        y = y.astype(float)
+        y[..., 4:] /= tau
+        for i, molecule in enumerate(molecules):
+            for j, t in enumerate(times):
+                molecule.pos.append(Position(quat.Quaternion(y[i, j, :4]), y[i, j, 4:7], t=t))
+        return len(times) * m
+
+
+    def _propagate_sudden(self, molecules):
+        """Propagate `molecules` in the sudden-kick approximation
+
+        The approximation is validated once, on the first molecules of the first batch, see
+        :meth:`SuddenKick.validate`.
+
+        :return: Number of integration steps per molecule, i.e., 0
+
+        """
+        from cmiclassirot.impulsive import SuddenKick
+        kick = SuddenKick(molecules, self.field, self.t_range, self.dt_save)
+        kick.apply(self.field)
+        if self.validation is None and self.solver.get('validate', 20):
+            self.validation = kick.validate(self.field, self.solver.get('validate', 20),
+                                            self.solver.get('tolerance', 1e-2))
+            print(f"  Sudden-kick approximation deviates by {self.validation['deviation']:.2g} in cos2theta",
+                  f"from the full integration of {self.validation['size']} molecules")
+            if not self.validation['valid']:
+                print(f"  WARNING: deviation exceeds the tolerance {self.validation['tolerance']:.2g};",
+                      'the pulse is not short enough for the sudden approximation')
+        return 0
+
+
+    def _batch_setup(self, velocity):
+        """Save times, step count, field table, and reference units of the batched backends
+
+        These are determined by the parameters of all species of the ensemble and by the largest
+        initial angular velocity `velocity` of all its molecules, not by the molecules of a batch, such
+        that the trajectories do not depend on how the ensemble is split into batches or chunks.
+
+        :return: `dict` of the save times `times`, the number of `steps` per save interval, the field
+        `table` at all (half) steps, the DC field `dc`, and the reference units `I_ref` and `E_ref`
+
+        """
+        t_init = self.t_range[0]
+        times = []
+        t = t_init
+        while t <= self.t_range[1]:
+            t = t + self.dt_save
+            times.append(t)
+        I, P, factor = kernels.parameters(self.ensemble.species)
+        # DC terms only for mixed fields with non-vanishing static field and dipole moments
+        mu, dc = kernels.dipoles(self.ensemble.species), getattr(self.field, 'dc', None)
+        if dc is not None and not np.any(dc):
+            dc = None
+        m = int(np.ceil(self.dt_save / self._step_size(velocity, I, P, mu, dc) * (1 - 1e-12)))
+        h = self.dt_save / m
+        table = np.asarray(self.field(t_init + 0.5 * h * np.arange(2 * len(times) * m + 1)), dtype=float)
+        E_ref = max(np.abs(table).max(), 0. if dc is None else np.linalg.norm(dc))
+        return {'velocity': velocity, 'times': times, 'steps': m, 'table': table, 'dc': dc,
+                'I_ref': I.max() if I.max() > 0 else 1., 'E_ref': E_ref if E_ref > 0 else 1.}
+
+
+    def _max_velocity(self):
+        """Largest initial angular velocity (rad/s) of all molecules of the ensemble
+
+        Out-of-core ensembles are generated for this without keeping them, and the state of the
+        random-number generator is restored afterwards.
+
+        """
+        if self.ensemble.chunk_size is None:
+            return max((np.abs(mol.pos[0].velocity).max() for mol in self.ensemble.molecules), default=0.)
+        state = np.random.get_state()
+        velocity = max((np.abs(mol.pos[0].velocity).max() for start, molecules in self.ensemble.chunks()
+                        for mol in molecules), default=0.)
+        np.random.set_state(state)
+        return velocity
+
+
+    def _step_size(self, velocity, I, P, mu=None, dc=None):
+        """Maximum step size of the batched backends
+
+        Unless `dt_step` is specified in the solver settings, the step is limited to a twentieth of
+        the pulse width and to a rotation by 0.02 rad at the largest angular velocity reached, which
+        is estimated from the largest initial angular velocity `velocity` and the depth of the
+        induced-dipole and, for a DC field `dc`, the permanent-dipole potentials.
+
+        """
+        if self.solver.get('dt_step'):
+            return min(self.solver['dt_step'], self.dt_save)
+        step = self.dt_save
+        samples = np.linspace(self.t_range[0], self.t_range[1], 10001)
+        if getattr(self.field, 'peak_amplitude', None) or isinstance(self.field, PulseTrain):
+            step = min(step, np.min(self.field.sigma) / 20)
+            samples = np.append(samples, self.field.t_peak)
+        E_max = np.max(np.abs(self.field(samples)))
+        inertia = I[I > 0].min() if np.any(I > 0) else 1.
+        depth = np.abs(P).max() * E_max**2
+        if dc is not None:
+            depth += np.abs(mu).max() * np.linalg.norm(dc) + np.abs(P).max() * np.sum(np.square(dc))
+        omega = velocity + np.sqrt(depth / inertia)
+        if omega > 0:
+            step = min(step, 0.02 / omega)
+        return step
+
+
     # @classmethod
     # def molecule(cls, mol, field, timerange, dt_save):
     #     cls.field = field
@@ -74,11 +596,14 @@ class Propagate(object):
     #     return mol
 
 
-    def _propagate(self, molecule):
+    def _propagate(self, molecule, stats=None):
         """Propagate an individual molecule in the current field and over the current time range
 
         :param molecule: The :class:`Molecule` to propagate over the stored time-range and field; see `__init__`.
 
+        :param stats: If specified, `dict` of counters in which the number and time of derivative
+        evaluations and the number of solver steps are accumulated, see :class:`PropagationStatistics`
+
         .. note:: This method must be reentrant so we can run it for many molecules in parallel.
 
         .. todo:: Should use the modern approach, i.e., `scipy.integrate.solve_ivp`
@@ -101,14 +626,26 @@ class Propagate(object):
         """
 
         # initialize ode object
-        integral = scipy.integrate.ode(self._derivative)
+        derivative = self._derivative
+        if stats is not None:
+            def derivative(t, dpos, molecule):
+                starttime = time.perf_counter()
+                result = self._derivative(t, dpos, molecule)
+                stats['rhs_time'] += time.perf_counter() - starttime
+                stats['rhs_calls'] += 1
+                return result
+        integral = scipy.integrate.ode(derivative)
         # choose the integrator
-        integral.set_integrator('dopri5', nsteps=10000)  # alternatively, use integral.set_integrator('lsoda')
+        integral.set_integrator(self.solver['integrator'], nsteps=self.solver['nsteps'])  # alternatively, use integral.set_integrator('lsoda')
         integral.set_initial_value(np.concatenate((molecule.pos[0].angle.elements,
                                                    molecule.pos[0].velocity)), self.t_range[0]).set_f_params(molecule)
         # integrate
         while integral.successful() and integral.t <= self.t_range[1]:
             integral.integrate(integral.t + self.dt_save)
+            if stats is not None and self.solver['integrator'] in ('dopri5', 'dop853'):
+                # step counters of the Hairer integrators of the last call: NSTEP and NREJCT
+                stats['steps'] += int(integral._integrator.iwork[17])
+                stats['rejected_steps'] += int(integral._integrator.iwork[19])
             molecule.pos.append(Position(quat.Quaternion(integral.y[:4]), integral.y[4:7], t=integral.t))
         return molecule
 
@@ -137,6 +674,7 @@ class Propagate(object):
         # E = self.field(t) * self.field.rotate() # uncomment this if you want to rotate the molecule
         E = self.field(t) * self.field.rotate(q.inverse) # rotating the field
         position = Position(q, omega)
-        dw = molecule.acceleration(E, position)
+        dc = getattr(self.field, 'dc', None) # static field of a MixedField
+        dw = molecule.acceleration(E, position, dc=None if dc is None else q.inverse.rotate(dc))
         dq = q.derivative(omega).elements
         return np.concatenate((dq,dw))
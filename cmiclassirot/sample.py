@@ -17,10 +17,12 @@
 # see <http://www.gnu.org/licenses/>.
 
 
+import json
+import time
+
 import numpy as np
 import pyquaternion as quat
 import scipy.constants
-import pandas as pd
 
 
 
@@ -51,8 +53,8 @@ class Molecule(object):
     """Object to be manipulated
 
     The relevant parameters that describe the :class:`Molecule` properties are its principal moments
-    of inertia and its polarizability tensor, both of which must be given in the principal axis of
-    inertia system, i.e., :math:`a`, :math:`b`, :math:`c`.
+    of inertia, its polarizability tensor, and its permanent dipole moment, all of which must be given
+    in the principal axis of inertia system, i.e., :math:`a`, :math:`b`, :math:`c`.
 
     Furthermore, the molecule has a phase-space position, i.e., a :class:`Position object.
 
@@ -66,7 +68,7 @@ class Molecule(object):
         .. code-block:: python
 
             __init__(self, molecule, pos=None, T=None)
-            __init__(self, I, P, angle=None, velocity=None, T=None, t=0.)
+            __init__(self, I, P, angle=None, velocity=None, T=None, t=0., mu=None)
 
         :param molecule: Use first version of constructor: copy the specified molecule and possibly
             update its phase-space position
@@ -76,7 +78,8 @@ class Molecule(object):
         * 'z' places the :class:`Molecule` along the laboratry :math:`z` axis with a angular
         velocity of 0
         * 'random' draws a random direction from a uniform angular distribution and an random
-        angular velocity according to a 3D Maxwell distribution at temperature `temp`
+        angular velocity according to a 3D Maxwell distribution at temperature `temp`, using the
+        `numpy.random.Generator` `rng` if specified and the global `numpy.random` state otherwise
 
         :param I: principal moments of inertia: these are the three diagonal elements of the in the
         inertial tensor in the principle axis of inertia frame (in SI units: kg * m**2)
@@ -94,6 +97,9 @@ class Molecule(object):
 
         :param t: Time at which the molecule is created
 
+        :param mu: permanent dipole moment in the inertial frame of the molecule (in SI units: C * m);
+            default: no dipole moment
+
         """
         if isinstance(args[0], Molecule):
             # first variant of constructor -- get args
@@ -104,17 +110,19 @@ class Molecule(object):
             pos = kwargs.get('pos', None)
             T = kwargs.get('T', 0)
             t = kwargs.get('t', 0)
+            rng = kwargs.get('rng', None)
 
             # construct object
             self._I = mol.I
             self._P = mol.P
+            self._mu = mol.mu
             if pos == None or pos == 'keep':
                 self.pos = mol.pos
             elif pos == 'z':
                 self.pos = [Position()]
             elif pos == 'random':
-                self.pos = [self._thermal_position(T, t)]
-            elif isinstance(pos, Position(t=t)):
+                self.pos = [self._thermal_position(T, t, rng)]
+            elif isinstance(pos, Position):
                 self.pos = [pos]
             elif isinstance(pos, list):
                 self.pos = pos
@@ -128,6 +136,7 @@ class Molecule(object):
                 self._P = args[1]
             else:
                 self._P = kwargs.get('P')
+            self._mu = np.zeros(3) if kwargs.get('mu') is None else np.asarray(kwargs['mu'], dtype=float)
             angle = kwargs.get('angle', None)
             velocity = kwargs.get('velocity', None)
             T = kwargs.get('T', None)
@@ -161,11 +170,20 @@ class Molecule(object):
         return self._P
 
 
-    def acceleration(self, field, position, factor=1):
+    @property
+    def mu(self):
+        # molecules pickled before the dipole moment was introduced have none
+        return getattr(self, '_mu', np.zeros(3))
+
+
+    def acceleration(self, field, position, factor=1, dc=None):
         """Calculate the molecule's angular acceleration at its current position in a field
 
         :param field: Field (amplitude, V/m) for which to calculate the acceleration
 
+        :param dc: Static (DC) electric field (V/m) in the molecular frame, which exerts a torque on the
+        permanent dipole moment and on the dipole it induces (default: None, i.e., no DC field)
+
 
         .. todo:: Refactor code to get rid of the IFs.
 
@@ -181,6 +199,8 @@ class Molecule(object):
         I, P = np.diagonal(self._I), self._P
         dipole = np.dot(P, field)
         torque = factor * np.cross(dipole, field)
+        if dc is not None:
+            torque = torque + np.cross(self.mu, dc) + factor * np.cross(np.dot(P, dc), dc)
         #a = np.dot(np.linalg.inv(I),   # if you decided to rotate the molecule
         #     (torque - np.cross(v, np.dot(I,v)))) #uncomment these lines and comment the next lines
         a = np.zeros(3)
@@ -194,12 +214,16 @@ class Molecule(object):
         return a
 
 
-    def _thermal_position(self, temp, t):
+    def _thermal_position(self, temp, t=0., rng=None):
         """Calculate a random phase-space position for the specified temperature for generating
            random orientation of the particles, we rotate the molecules (initially on the Z-axis)
            around random axes on the x-y plane. The angle is calculated based on cosine destribution
            angle = acos(random.uniform(-1,1))
 
+        Random numbers are drawn from the `numpy.random.Generator` `rng`, or from the global
+        `numpy.random` state if it is not specified; in either case, three normally and three uniformly
+        distributed numbers are drawn, independent of the molecular parameters.
+
         .. todo:: this can be optimized, but let's write it down explicitely first
 
         """
@@ -216,15 +240,31 @@ class Molecule(object):
         if I[2]!=0:
             velocity_sigma[2] = np.sqrt(k*temp/I[2])
 
-        velocity = np.random.normal(0., 1., 3)*velocity_sigma
+        velocity = (np.random if rng is None else rng).normal(0., 1., 3)*velocity_sigma
         #print(velocity)
         #angle = acos(random.uniform(-1,1))
         #q = quat.Quaternion(axis=[random.uniform(-1,1),
         #    random.uniform(-1,1), 0], angle=angle)
-        q = quat.Quaternion.random()
+        if rng is None:
+            q = quat.Quaternion.random()
+        else:
+            # uniformly distributed rotation, as in Quaternion.random
+            r1, r2, r3 = rng.random(3)
+            q = quat.Quaternion(np.sqrt(1 - r1) * np.sin(2 * np.pi * r2), np.sqrt(1 - r1) * np.cos(2 * np.pi * r2),
+                                np.sqrt(r1) * np.sin(2 * np.pi * r3), np.sqrt(r1) * np.cos(2 * np.pi * r3))
         return Position(q, velocity, t)
 
 
+    def states(self):
+        """Phase-space trajectory of the molecule
+
+        :return: `ndarray` of shape (frames, 8) with the quaternion, the angular velocity, and the time
+        of all stored phase-space positions
+
+        """
+        return np.array([np.concatenate((p.angle.elements, p.velocity, [p.time])) for p in self.pos])
+
+
     def rotate(self, q):
         #R = q.inverse.rotation_matrix
         R = q.rotation_matrix.T
@@ -234,41 +274,225 @@ class Molecule(object):
 
 
 
+def _apportion(quota, size):
+    """Distribute `size` items over bins proportional to `quota` by the largest-remainder method"""
+    quota = np.asarray(quota, dtype=float)
+    quota = quota / quota.sum() * size
+    counts = np.floor(quota).astype(int)
+    counts[np.argsort(counts - quota, kind='stable')[:size - counts.sum()]] += 1
+    return counts
+
+
+
 class Ensemble(object):
     """Source of randomly distributed Molecules
 
     This is also an iterator over :class:`Molecule`s
 
+    Every molecule carries a statistical weight, stored in `weights`, which is 1 for molecules sampled
+    from the thermal distribution at the ensemble `temperature`; see :meth:`reweight`.
+
+    Polydisperse samples, e.g., nanorods with a distribution of lengths, or mixtures are described by
+    several `species`, i.e., template |Molecule|s with their own moments of inertia, polarizability,
+    and dipole moment, of which the ensemble contains molecules in proportion to their `fractions`;
+    `species_index` holds the species of every molecule. The molecules reference the tensors of their
+    species, which are stored only once per species.
+
+    Ensembles larger than the memory are processed out of core: with a `chunk_size`, no molecules are
+    held in memory, but :class:`Propagate` generates, propagates, and writes them chunk by chunk, see
+    :meth:`chunks`.
+
+    With a `seed`, the molecules are sampled in blocks of `block_size` molecules, each from its own
+    random stream, the block's child of the `numpy.random.SeedSequence` of the seed. The initial
+    conditions then depend on the seed only, neither on the global random state nor on the order in
+    which, or the chunks and processes in which, the molecules are generated.
+
     """
 
-    def __init__(self, size, molecule, T=0., t=0.):
+    # number of molecules sampled from one random stream of a seeded ensemble
+    block_size = 1024
+
+    def __init__(self, size, molecule, T=0., t=0., fractions=None, chunk_size=None, seed=None):
         """Generate an ensemble  of |Molecule|s
 
         :param size: number of molecules in ensemble
 
-        :param molecule:
+        :param molecule: Template :class:`Molecule`, or `list` of templates of all species
 
         :param temperature:
 
         :param time: Time for the molecule to be create.
 
+        :param fractions: Relative abundances of the species (default: equal abundances); the number
+        of molecules of every species is the rounded product with `size`
+
+        :param chunk_size: Number of molecules per chunk of out-of-core processing (default: None,
+        i.e., generate all molecules now and keep them in memory)
+
+        :param seed: Seed (non-negative integer) of the random streams of the molecules (default:
+        None, i.e., use the global `numpy.random` state)
+
         .. todo:: add a constructor to create an ensemble from a data file
 
         """
-        self.size = size
+        self.species = list(molecule) if isinstance(molecule, (list, tuple)) else [molecule]
+        self.molecule = self.species[0]
+        fractions = np.ones(len(self.species)) if fractions is None else np.asarray(fractions, dtype=float)
+        if fractions.shape != (len(self.species),) or np.any(fractions < 0) or not fractions.sum() > 0:
+            raise ValueError('fractions must be non-negative abundances of all species')
+        self.fractions = fractions / fractions.sum()
+        self.species_index = np.zeros(0, dtype=int)
         self.molecules = []
-        for i in range(self.size):
-            self.molecules.append(Molecule(molecule, pos='random', T=T, t=t))
-        self.index = self.size
+        self.size = 0
         self.temperature = T
         self.time = t
+        self.weights = np.zeros(0)
+        self.chunk_size = chunk_size
+        self.seed = seed
+        if chunk_size is None:
+            self.extend(size)
+        else:
+            self.species_index = self._sample_species(size)
+            self.weights = np.ones(size)
+            self.size = self.index = size
         self.pulse = None
+        self.precision = None
+        self.statistics = None
+        self.events = None
+        self.dtype = 'float64'
 
 
     @classmethod
     def FromFile(cls, name):
-        cls._load(cls, name)
-        return cls
+        """Load an ensemble from a file written by :meth:`_save`"""
+        ensemble = cls.__new__(cls)
+        ensemble.precision = ensemble.statistics = ensemble.chunk_size = ensemble.seed = None
+        ensemble._load(name)
+        ensemble.time = ensemble.molecules[0].pos[0].time if ensemble.molecules else 0.
+        return ensemble
+
+
+    @classmethod
+    def FromMolecules(cls, molecules, T=0.):
+        """Ensemble of given |Molecule|s with unit weights, e.g., of a subsample of another ensemble
+
+        Every molecule is its own species, such that the molecules need not share their tensors.
+
+        """
+        molecules = list(molecules)
+        ensemble = cls(0, molecules, T=T, t=molecules[0].pos[0].time if molecules else 0.)
+        ensemble.molecules = molecules
+        ensemble.species_index = np.arange(len(molecules))
+        ensemble.weights = np.ones(len(molecules))
+        ensemble.size = ensemble.index = len(molecules)
+        return ensemble
+
+
+    def extend(self, size):
+        """Add `size` randomly sampled |Molecule|s to the ensemble
+
+        :return: `list` of the new molecules
+
+        """
+        if self.chunk_size is not None:
+            raise ValueError('out-of-core ensembles cannot be extended')
+        index = self._sample_species(size)
+        molecules = self._generate(index, self.size)
+        self.molecules.extend(molecules)
+        self.species_index = np.concatenate((self.species_index, index))
+        self.weights = np.concatenate((self.weights, np.ones(size)))
+        self.size += size
+        self.index = self.size
+        return molecules
+
+
+    def chunks(self):
+        """Generate the molecules of an out-of-core ensemble in chunks of `chunk_size` molecules
+
+        The random numbers are drawn in the same order as for an ensemble that is kept in memory, such
+        that both contain identical molecules for the same seed or state of the random-number
+        generator.
+
+        :return: iterator over tuples of the index of the first molecule and the `list` of molecules
+        of every chunk
+
+        """
+        for start in range(0, self.size, self.chunk_size):
+            yield start, self._generate(self.species_index[start:start+self.chunk_size], start)
+
+
+    def _sample_species(self, size):
+        """Species of `size` new molecules
+
+        The composition of the whole ensemble is kept as close as possible to the fractions.
+
+        """
+        counts = np.bincount(self.species_index, minlength=len(self.species))
+        deficit = np.maximum(self.fractions * (self.size + size) - counts, 0)
+        return np.repeat(np.arange(len(self.species)), _apportion(deficit, size) if size else 0)
+
+
+    def _generate(self, index, start):
+        """Thermally sampled molecules `start`, `start` + 1, ... of the ensemble with the species `index`"""
+        if self.seed is None:
+            return [Molecule(self.species[i], pos='random', T=self.temperature, t=self.time) for i in index]
+        molecules = []
+        for n, i in enumerate(index, start):
+            if n == start or n % self.block_size == 0:
+                # stream of the block, identical to the child `block` of SeedSequence(seed).spawn()
+                block = n // self.block_size
+                rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(block,)))
+                # skip the molecules of the block before `start`; the draws do not depend on the species
+                for skipped in range(block * self.block_size, n):
+                    self.molecule._thermal_position(self.temperature, self.time, rng)
+            molecules.append(Molecule(self.species[i], pos='random', T=self.temperature, t=self.time, rng=rng))
+        return molecules
+
+
+    def states(self):
+        """Phase-space trajectories of all molecules
+
+        :return: `ndarray` of shape (molecules, frames, 8), see :meth:`Molecule.states`; trajectories
+        are truncated to the shortest one, i.e., to the frames available for all molecules
+
+        """
+        states = [mol.states() for mol in self.molecules]
+        frames = min(len(state) for state in states)
+        return np.array([state[:frames] for state in states])
+
+
+    def reweight(self, T):
+        """Statistical weights of the molecules for a thermal ensemble at temperature `T`
+
+        The initial angular velocities of the molecules were sampled from the Maxwell distribution at
+        the ensemble temperature; their weights for temperature `T` are obtained by multiplication with
+        the ratio of the two distributions. Sampling at a higher temperature than the targeted ones
+        gives a broad reference distribution that is reliably reweighted, see
+        :meth:`effective_sample_size`.
+
+        :param T: Target temperature (K)
+
+        :return: `ndarray` of the weights, normalized to a sum equal to the number of molecules
+
+        """
+        if not (self.temperature > 0 and T > 0):
+            raise ValueError('reweighting requires positive temperatures')
+        k = scipy.constants.Boltzmann
+        I = np.array([np.diagonal(mol.I) for mol in self.molecules])
+        velocity = np.array([mol.pos[0].velocity for mol in self.molecules])
+        # log of the ratio of the 1D Maxwell distributions of all rotation axes with non-zero inertia
+        energy = 0.5 * np.sum(I * velocity**2, axis=1)
+        dof = np.count_nonzero(I, axis=1)
+        log_weights = np.log(self.weights) - energy / k * (1/T - 1/self.temperature) \
+            + 0.5 * dof * np.log(self.temperature / T)
+        weights = np.exp(log_weights - log_weights.max())
+        return weights * len(weights) / weights.sum()
+
+
+    @staticmethod
+    def effective_sample_size(weights):
+        """Kish's effective sample size :math:`(\\sum w)^2 / \\sum w^2` of weighted molecules"""
+        return np.sum(weights)**2 / np.sum(weights**2)
 
 
     def __iter__(self):
@@ -285,32 +509,137 @@ class Ensemble(object):
 
 
     def _load(self, filename):
+        """Load the ensemble from the file `filename` in table or compact format, see :meth:`_save`"""
+        import pandas as pd
+        from cmiclassirot.storage import is_compact, load_metadata, load_states
         self.molecules=[]
-        with pd.HDFStore(filename) as store:
-            tensors = store.get_storer('Molecule0').attrs.metadata
-            self.size = len(store.keys())
-            self.pulse = tensors['E']
-            for i in store.keys():
-               df = store[i]
+        if is_compact(filename):
+            states, tensors = load_states(filename)
+            self._metadata(tensors, len(states))
+            for trajectory, index in zip(states, self.species_index):
+                mol = Molecule(self.species[index])
+                mol.pos = [Position(quat.Quaternion(j[:4]), j[4:7], t=j[7]) for j in trajectory]
+                self.molecules.append(mol)
+            return
+        self._metadata(*load_metadata(filename))
+        with pd.HDFStore(filename, mode='r') as store:
+            for i in range(self.size):
+               df = store['Molecule'+str(i)]
                pos = []
                for j in df.values:
                    pos.append(Position(quat.Quaternion(j[:4]), j[4:7], t=j[7]))
-               mol = Molecule(tensors['I'], tensors['P'])
+               mol = Molecule(self.species[self.species_index[i]])
                mol.pos = pos
                self.molecules.append(mol)
-        self.index = self.size
 
 
-    def _save(self, filename):
-        df = pd.DataFrame(columns=['r', 'i', 'j', 'k',
-                                   'omega_x', 'omega_y', 'omega_z', 'time'])
-        store = pd.HDFStore(filename)
-        for i in range(len(self.molecules)):
-            df = pd.DataFrame(columns=df.columns)
-            for k, j in enumerate(self.molecules[i].pos):
-                df.loc[k] = list(np.concatenate((j.angle.elements, j.velocity)))+[j.time]
-            store.put('Molecule'+str(i), df)
-        metadata = {'I':self.molecules[0].I,'P':self.molecules[0].P,
-                    'T':self.temperature, 'E': self.pulse}
-        store.get_storer('Molecule0').attrs.metadata = metadata
-        store.close()
+    def _metadata(self, tensors, size):
+        """Restore the ensemble attributes from the stored metadata `tensors`"""
+        self.size = size
+        self.index = size
+        # the tensors of several species are stacked along the first axis
+        I, P = np.asarray(tensors['I']), np.asarray(tensors['P'])
+        mu = np.zeros((len(I), 3)) if tensors.get('mu') is None else np.asarray(tensors['mu'])
+        if I.ndim == 2:
+            I, P, mu = I[None], P[None], mu[None]
+        self.species = [Molecule(I[i], P[i], mu=mu[i]) for i in range(len(I))]
+        self.molecule = self.species[0]
+        self.species_index = np.asarray(tensors.get('species', np.zeros(size, dtype=int)), dtype=int)
+        self.fractions = tensors.get('fractions', np.ones(len(I)) / len(I))
+        self.pulse = tensors['E']
+        self.temperature = tensors['T']
+        self.precision = tensors.get('precision')
+        self.events = tensors.get('events')
+        self.weights = tensors.get('weights', np.ones(self.size))
+        self.dtype = tensors.get('dtype', 'float64')
+        self.seed = tensors.get('seed')
+        self.statistics = json.loads(tensors['statistics']) if tensors.get('statistics') else None
+
+
+    def observables(self):
+        """Expectation values at all save times, which are stored with the ensemble for fast plotting
+
+        :return: `dict` of the save times, the field amplitudes, and the expectation values of all
+        observables of :data:`cmiclassirot.postprocessing.observables`; for several species, `species`
+        holds their expectation values of shape (species, times)
+
+        """
+        from cmiclassirot.postprocessing import ObservableSums
+        sums = ObservableSums(len(self.species))
+        states = self.states()
+        sums.accumulate(states, self.weights[:len(states)], self.species_index[:len(states)])
+        return self._observables(sums)
+
+
+    def _observables(self, sums):
+        """Stored expectation values, see :meth:`observables`, from the accumulated :class:`ObservableSums`"""
+        result = {'time': sums.time if sums.time is not None else np.zeros(0)}
+        try:
+            result['field'] = np.asarray(self.pulse(result['time']), dtype=float) if callable(self.pulse) else None
+        except ValueError:
+            # numerically specified fields are not defined beyond their table
+            result['field'] = None
+        result.update(sums.result())
+        return result
+
+
+    def _writer(self, filename, compact=None):
+        """Writer of the trajectories to the file `filename`, see :meth:`_save`"""
+        from cmiclassirot.storage import TableWriter, TrajectoryWriter
+        if compact is not None:
+            return TrajectoryWriter(filename, **{'dtype': self.dtype, **compact})
+        return TableWriter(filename, dtype=self.dtype)
+
+
+    def _header(self, observables, io_time=None):
+        """Metadata stored with the trajectories, see :meth:`_save`
+
+        :param io_time: Time spent writing the trajectories, recorded in the statistics
+
+        """
+        statistics = self.statistics
+        if statistics is not None and not isinstance(statistics, dict):
+            statistics.io_time = io_time
+            statistics = statistics.as_dict()
+        if len(self.species) == 1:
+            metadata = {'I': self.molecule.I, 'P': self.molecule.P, 'mu': self.molecule.mu}
+        else:
+            metadata = {'I': np.array([mol.I for mol in self.species]), 'P': np.array([mol.P for mol in self.species]),
+                        'mu': np.array([mol.mu for mol in self.species]), 'fractions': self.fractions,
+                        'species': self.species_index.astype(np.min_scalar_type(len(self.species)))}
+        metadata.update({'statistics': None if statistics is None else json.dumps(statistics),
+                         'T': self.temperature, 'E': self.pulse, 'precision': self.precision,
+                         'weights': self.weights, 'dtype': self.dtype, 'seed': self.seed,
+                         'events': self.events, 'observables': observables})
+        return metadata
+
+
+    def _save(self, filename, compact=None):
+        """Save the ensemble to the HDF5 file `filename`
+
+        Quaternions and angular velocities are stored with the precision `dtype` of the ensemble, times
+        always in double precision.
+
+        :param compact: `dict` of options of :class:`cmiclassirot.storage.TrajectoryWriter` to write
+        the compact format, or `None` to write one table per molecule, see
+        :class:`cmiclassirot.storage.TableWriter`
+
+        The stored expectation values are accumulated from the chunks of molecules as they are
+        written, such that the trajectories of all molecules are never stacked into one array.
+
+        """
+        from cmiclassirot.postprocessing import ObservableSums
+        sums = ObservableSums(len(self.species))
+        io_time = 0.
+        starttime = time.perf_counter()
+        writer = self._writer(filename, compact)
+        io_time += time.perf_counter() - starttime
+        for start in range(0, len(self.molecules), 1024):
+            states = [mol.states() for mol in self.molecules[start:start+1024]]
+            frames = min(len(state) for state in states)
+            sums.accumulate(np.array([state[:frames] for state in states]), self.weights[start:start+len(states)],
+                            self.species_index[start:start+len(states)])
+            starttime = time.perf_counter()
+            writer.append(states)
+            io_time += time.perf_counter() - starttime
+        writer.close(self._header(self._observables(sums), io_time))
@@ -0,0 +1,430 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Local job server that runs queued calculations on one shared worker pool
+
+Instead of every calculation starting a pool of one worker per CPU, calculations are submitted to a
+:class:`JobServer` on the same machine, which runs them one after another, in the order of
+submission, on a single pool. Clients communicate through a Unix socket with newline-delimited JSON
+messages, see :class:`Client` and ``cmiclassirot-client``:
+
+* ``{"command": "submit", "specification": {...}, "output": filename, "options": {...}}`` queues a
+  declarative specification, see :mod:`cmiclassirot.specification`, and replies with the job `id`;
+  `options` are `compact` (options of the compact format), `chunk_size`, and `events`, as for
+  ``cmiclassirot``
+* ``{"command": "status"}`` replies with the states of all jobs
+* ``{"command": "watch", "job": id}`` streams the progress of the job and finally its result, the
+  stored expectation values and events, or its error
+* ``{"command": "cancel", "job": id}`` removes a queued job
+
+Invalid requests are answered by ``{"rejected": reason}``; specifications and options are validated
+on submission. Filenames, the `output` and the ``filename`` of the ``field``, must be absolute, as the
+server does not run in the working directory of the client; :class:`Client` resolves them.
+
+Only declarative specifications are accepted, as Python inputs would be executed by the server.
+
+"""
+
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import multiprocessing as mp
+import os
+import socket
+import tempfile
+import time
+import traceback
+
+import numpy as np
+
+from cmiclassirot.progress import Progress
+
+
+
+def default_socket():
+    """Socket of the server, `$CMICLASSIROT_SOCKET` or `cmiclassirot.sock` in the temporary directory"""
+    return os.environ.get('CMICLASSIROT_SOCKET', os.path.join(tempfile.gettempdir(), 'cmiclassirot.sock'))
+
+
+def _jsonable(obj):
+    """Convert (nested) results with `ndarray`s to JSON-serializable objects"""
+    if isinstance(obj, dict):
+        return {str(key): _jsonable(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(item) for item in obj]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _integer(name, value, minimum, maximum=None):
+    """Check that the option `name` is an integer `value` in the range [`minimum`, `maximum`]"""
+    if (not isinstance(value, int) or isinstance(value, bool) or value < minimum
+            or (maximum is not None and value > maximum)):
+        raise ValueError(f'{name} must be an integer of at least {minimum}'
+                         + (f' and at most {maximum}' if maximum is not None else ''))
+
+
+def _options(options):
+    """Validate the `options` of a submitted job, see the module documentation
+
+    :return: `dict` of the options
+
+    """
+    from cmiclassirot.postprocessing import AlignmentEvents
+    from cmiclassirot.storage import encodings
+    options = dict(options) if options else {}
+    unknown = set(options) - {'compact', 'chunk_size', 'events'}
+    if unknown:
+        raise ValueError(f'unknown options {sorted(unknown)}')
+    compact = options.get('compact')
+    if compact is not None:
+        if not isinstance(compact, dict) or not set(compact) <= {'quaternions', 'velocity_stride', 'complevel'}:
+            raise ValueError('compact must be a dictionary of quaternions, velocity_stride, and complevel')
+        if compact.get('quaternions', 'float32') not in encodings:
+            raise ValueError(f"unknown quaternion encoding {compact['quaternions']}")
+        _integer('velocity_stride', compact.get('velocity_stride', 1), 1)
+        _integer('complevel', compact.get('complevel', 5), 0, 9)
+    if options.get('chunk_size') is not None:
+        _integer('chunk_size', options['chunk_size'], 1)
+    events = options.get('events', ())
+    if not isinstance(events, (list, tuple)):
+        raise ValueError('events must be a list of kinds of events')
+    AlignmentEvents(events)
+    return options
+
+
+
+class JobProgress(Progress):
+    """Progress of a job that is reported to a callback instead of a terminal or file"""
+
+    def __init__(self, duration, callback, interval=1.):
+        super().__init__(0, duration, stream=None, interval=interval)
+        self.callback = callback
+
+
+    def report(self, state='running'):
+        status = self.status(state)
+        self.callback(status)
+        return status
+
+
+
+class Job(object):
+    """Calculation submitted to the :class:`JobServer`"""
+
+    def __init__(self, id, specification, output, options=None):
+        self.id = id
+        self.specification = specification
+        self.output = output
+        self.options = options if options else {}
+        self.state = 'queued'
+        self.submitted = time.time()
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.watchers = []
+
+
+    def summary(self):
+        """State of the job as `dict`"""
+        return {'job': self.id, 'state': self.state, 'output': self.output, 'submitted': self.submitted,
+                'progress': self.progress, 'error': self.error}
+
+
+    def finished(self):
+        return self.state in ('finished', 'failed', 'cancelled')
+
+
+
+class JobServer(object):
+    """Queue of calculations that are run one after another on a shared worker pool
+
+    :param path: Name of the Unix socket (default: :func:`default_socket`)
+
+    :param processes: Number of worker processes (default: number of CPUs)
+
+    :param mode: Permissions of the socket; clients of all users with write access to it run
+    calculations as the user of the server and write their output files with its permissions
+    (default: 0o600, i.e., only the user of the server)
+
+    """
+
+    def __init__(self, path=None, processes=None, mode=0o600):
+        self.path = path if path else default_socket()
+        self.processes = processes if processes else mp.cpu_count()
+        self.mode = mode
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.queue = None
+        self.pool = None
+        self.loop = None
+
+
+    def serve(self):
+        """Run the server until it is interrupted"""
+        self.pool = mp.Pool(self.processes)
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.pool.close()
+            self.pool.join()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        if os.path.exists(self.path):
+            # a stale socket of a server that did not shut down cleanly
+            if Client(self.path).alive():
+                raise RuntimeError(f'a server is already listening on {self.path}')
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._connection, path=self.path)
+        os.chmod(self.path, self.mode)
+        print(f'Serving on {self.path} with {self.processes} worker processes')
+        runner = asyncio.ensure_future(self._runner())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            runner.cancel()
+
+
+    async def _runner(self):
+        """Run the queued jobs one after another in a thread, such that the server stays responsive"""
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        while True:
+            job = await self.queue.get()
+            if job.state != 'queued':
+                continue
+            job.state = 'running'
+            self._publish(job)
+            try:
+                job.result = await self.loop.run_in_executor(executor, self._run, job)
+                job.state = 'finished'
+            except Exception as e:
+                job.error = f'{type(e).__name__}: {e}'
+                job.state = 'failed'
+                traceback.print_exc()
+            self._publish(job)
+
+
+    def _run(self, job):
+        """Propagate the specification of `job` on the shared pool and write its output file
+
+        :return: `dict` of the stored expectation values and of the events of the ensemble
+
+        """
+        from cmiclassirot.propagate import Propagate
+        from cmiclassirot.specification import Specification
+        from cmiclassirot.storage import load_metadata
+        specification = Specification(job.specification)
+        ensemble = specification.create_ensemble(chunk_size=job.options.get('chunk_size'))
+        timerange = specification.timerange
+        progress = JobProgress(timerange[1] - timerange[0],
+                               lambda status: self.loop.call_soon_threadsafe(self._progress, job, status))
+        print(f'Running job {job.id}, output {job.output}')
+        Propagate(ensemble, specification.create_field(), timerange, specification.dt_save,
+                  solver=specification.solver, progress=progress, processes=self.processes, pool=self.pool,
+                  output=job.output, compact=job.options.get('compact'), events=job.options.get('events', ()),
+                  **specification.convergence)
+        metadata = load_metadata(job.output)[0]
+        return _jsonable({'observables': metadata['observables'], 'events': metadata.get('events'),
+                          'precision': metadata.get('precision')})
+
+
+    def _progress(self, job, status):
+        job.progress = status
+        self._publish(job)
+
+
+    def _publish(self, job):
+        """Notify all watchers of `job` of a change of its state"""
+        for watcher in job.watchers:
+            watcher.put_nowait(job.state)
+
+
+    async def _connection(self, reader, writer):
+        """Handle the requests of a client connection"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    await self._handle(request, writer)
+                except Exception as e:
+                    await self._send(writer, {'rejected': f'{type(e).__name__}: {e}'})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def _handle(self, request, writer):
+        command = request.get('command')
+        if command == 'submit':
+            from cmiclassirot.specification import Specification
+            # reject invalid specifications and options immediately, not when the job starts
+            specification = Specification(request['specification'])
+            options = _options(request.get('options'))
+            if not os.path.isabs(request.get('output', '')):
+                raise ValueError('output must be an absolute filename')
+            if not os.path.isabs(specification.field.get('filename', os.sep)):
+                raise ValueError('the filename of the field must be an absolute filename')
+            job = Job(next(self.ids), request['specification'], request['output'], options)
+            self.jobs[job.id] = job
+            self.queue.put_nowait(job)
+            await self._send(writer, {'job': job.id, 'position': sum(1 for j in self.jobs.values()
+                                                                     if j.state in ('queued', 'running'))})
+        elif command == 'status':
+            await self._send(writer, {'jobs': [job.summary() for job in self.jobs.values()]})
+        elif command == 'watch':
+            job = self._job(request)
+            watcher = asyncio.Queue()
+            job.watchers.append(watcher)
+            try:
+                while True:
+                    message = job.summary()
+                    if job.finished():
+                        message['result'] = job.result
+                    await self._send(writer, message)
+                    if job.finished():
+                        break
+                    # woken up by every change of the job
+                    await watcher.get()
+            finally:
+                job.watchers.remove(watcher)
+        elif command == 'cancel':
+            job = self._job(request)
+            if job.state != 'queued':
+                raise ValueError(f'job {job.id} is {job.state} and cannot be cancelled')
+            job.state = 'cancelled'
+            self._publish(job)
+            await self._send(writer, job.summary())
+        elif command == 'ping':
+            await self._send(writer, {'pong': True})
+        else:
+            raise ValueError(f'unknown command {command}')
+
+
+    def _job(self, request):
+        try:
+            return self.jobs[int(request['job'])]
+        except (KeyError, ValueError):
+            raise ValueError(f"unknown job {request.get('job')}")
+
+
+    @staticmethod
+    async def _send(writer, message):
+        writer.write(json.dumps(_jsonable(message)).encode() + b'\n')
+        await writer.drain()
+
+
+
+class ServerError(RuntimeError):
+    """Error reported by the :class:`JobServer`"""
+    pass
+
+
+
+class Client(object):
+    """Blocking client of a :class:`JobServer`
+
+    :param path: Name of the Unix socket (default: :func:`default_socket`)
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path else default_socket()
+
+
+    def _messages(self, request):
+        """Send `request` and iterate over the replies until the connection is closed by the caller"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(self.path)
+            s.sendall(json.dumps(_jsonable(request)).encode() + b'\n')
+            with s.makefile('r') as f:
+                for line in f:
+                    message = json.loads(line)
+                    if 'rejected' in message:
+                        raise ServerError(message['rejected'])
+                    yield message
+
+
+    def _request(self, request):
+        return next(self._messages(request))
+
+
+    def alive(self):
+        """Check whether a server is listening on the socket"""
+        try:
+            return self._request({'command': 'ping'}).get('pong', False)
+        except (OSError, StopIteration):
+            return False
+
+
+    def submit(self, specification, output, **options):
+        """Queue the calculation of the (nested) `dict` `specification`, written to the file `output`
+
+        Relative filenames, of `output` and of the field, are resolved in the current directory.
+
+        :return: Id of the job
+
+        """
+        specification = dict(specification)
+        field = specification.get('field')
+        if isinstance(field, dict) and isinstance(field.get('filename'), str):
+            specification['field'] = dict(field, filename=os.path.abspath(field['filename']))
+        return self._request({'command': 'submit', 'specification': specification,
+                              'output': os.path.abspath(output), 'options': options})['job']
+
+
+    def status(self):
+        """States of all jobs of the server"""
+        return self._request({'command': 'status'})['jobs']
+
+
+    def watch(self, job):
+        """Iterate over the progress messages of `job` up to its final state, which contains the `result`"""
+        for message in self._messages({'command': 'watch', 'job': job}):
+            yield message
+            if message['state'] in ('finished', 'failed', 'cancelled'):
+                return
+
+
+    def wait(self, job):
+        """Wait for `job` to finish
+
+        :return: Final message of the job, see :meth:`watch`
+
+        """
+        for message in self.watch(job):
+            pass
+        return message
+
+
+    def cancel(self, job):
+        """Remove the queued `job`"""
+        return self._request({'command': 'cancel', 'job': job})
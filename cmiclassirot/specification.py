@@ -0,0 +1,321 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Declarative (JSON, TOML, or YAML) specification of a calculation
+
+A specification contains the sections `molecule`, `field`, `ensemble`, `timerange`, `dt_save`, and,
+optionally, `solver` and `convergence`; all values are in SI units. An example in TOML format is
+
+.. code-block:: toml
+
+    timerange = [-10e-12, 40e-12]
+    dt_save = 250e-15
+
+    [molecule]
+    I = [1.38e-45, 1.38e-45, 0.0]      # principal moments of inertia (kg m^2), or a 3x3 tensor
+    P = [4.31e-40, 4.31e-40, 8.37e-40] # polarizability (C m^2 / V), or a 3x3 tensor
+    mu = [0.0, 0.0, 2.39e-30]          # optional permanent dipole moment (C m)
+
+    [field]
+    peak_intensity = 1e17              # W/m^2; alternatively peak_amplitude (V/m) or filename
+    FWHM = 500e-15
+    t_peak = 0.0
+    dc = [0.0, 0.0, 1e5]               # optional static field (V/m) for mixed-field orientation
+
+    [ensemble]
+    size = 10000
+    T = 2.0
+    seed = 42                          # optional, for reproducible initial conditions
+
+    [solver]
+    integrator = "dopri5"
+    nsteps = 10000
+    backend = "scipy"                  # or "numpy"/"numba" for batched fixed-step integration, or
+                                       # "sudden" for the impulsive limit, validated on `validate`
+                                       # molecules with `tolerance` (defaults 20 and 0.01)
+    dtype = "float64"                  # or "float32" with a batched backend
+
+    [convergence]                      # extend the ensemble until the standard error of
+    target_error = 1e-3                # <cos^2 theta> is below target_error at all times
+    batch_size = 1000
+    max_size = 100000
+
+Mixtures and polydisperse samples are specified by several ``[[molecule]]`` tables (a list of
+molecule sections in JSON and YAML), each with an optional relative abundance ``fraction``.
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+class SpecificationError(ValueError):
+    """Invalid specification of a calculation"""
+    pass
+
+
+
+class Specification(object):
+    """Validated declarative specification of a calculation
+
+    The specification is completely validated on construction, i.e., before any :class:`Molecule`,
+    :class:`Ensemble`, or :class:`Field` is created, and it can be used for cheap cost estimates.
+
+    """
+
+    # allowed keys of all sections; `None` marks mandatory keys
+    sections = {'molecule': {'I': None, 'P': None, 'mu': False, 'fraction': False},
+                'field': {'peak_intensity': False, 'peak_amplitude': False, 'filename': False,
+                          'FWHM': 10.e-9, 't_peak': 0., 'dc': False},
+                'ensemble': {'size': None, 'T': 0., 't': False, 'seed': False},
+                'solver': {'integrator': 'dopri5', 'nsteps': 10000, 'backend': 'scipy', 'dt_step': False,
+                           'dtype': 'float64', 'validate': False, 'tolerance': False},
+                'convergence': {'target_error': False, 'batch_size': False, 'max_size': False}}
+    optional = ('solver', 'convergence')
+    integrators = ('dopri5', 'dop853', 'lsoda', 'vode')
+    backends = ('scipy', 'numpy', 'numba', 'sudden')
+
+    # reference cost of the dopri5 propagation of one molecule over one saving interval (s), measured
+    # for the OCS impulsive-alignment example
+    seconds_per_frame = 3.3e-3
+
+
+    def __init__(self, specification):
+        """Validate a specification given as (nested) dictionary
+
+        :raise SpecificationError: if the specification is incomplete or invalid
+
+        """
+        if not isinstance(specification, dict):
+            raise SpecificationError('specification must be a mapping')
+        unknown = set(specification) - set(self.sections) - {'timerange', 'dt_save'}
+        if unknown:
+            raise SpecificationError(f'unknown entries {sorted(unknown)}')
+        for name, defaults in self.sections.items():
+            section = specification.get(name, {} if name in self.optional else None)
+            if name == 'molecule' and isinstance(section, list) and section:
+                # several species, e.g., [[molecule]] tables in TOML
+                self.species = [self._section(name, species, defaults) for species in section]
+                self.molecule = self.species[0]
+            else:
+                setattr(self, name, self._section(name, section, defaults))
+                if name == 'molecule':
+                    self.species = [self.molecule]
+        # molecular parameters
+        for species in self.species:
+            for key in ('I', 'P'):
+                species[key] = self._tensor(species[key], key)
+            if np.any(np.diagonal(species['I']) < 0):
+                raise SpecificationError('moments of inertia must not be negative')
+            if 'mu' in species:
+                species['mu'] = self._vector(species['mu'], 'mu')
+            if 'fraction' in species and self._number(species['fraction'], 'fraction') < 0:
+                raise SpecificationError('fraction must not be negative')
+        if not sum(species.get('fraction', 1.) for species in self.species) > 0:
+            raise SpecificationError('fractions of the species must not all vanish')
+        if 'dc' in self.field:
+            self.field['dc'] = self._vector(self.field['dc'], 'dc')
+        # field
+        sources = [key for key in ('peak_intensity', 'peak_amplitude', 'filename') if key in self.field]
+        if len(sources) != 1:
+            raise SpecificationError('field requires exactly one of peak_intensity, peak_amplitude, filename')
+        if 'filename' in self.field:
+            if not os.path.exists(self.field['filename']):
+                raise SpecificationError(f'field file {self.field["filename"]} does not exist')
+        elif self._number(self.field[sources[0]], sources[0]) <= 0:
+            raise SpecificationError(f'{sources[0]} must be positive')
+        if self._number(self.field['FWHM'], 'FWHM') <= 0:
+            raise SpecificationError('FWHM must be positive')
+        self._number(self.field['t_peak'], 't_peak')
+        # time range and saving interval
+        if 'timerange' not in specification or 'dt_save' not in specification:
+            raise SpecificationError('timerange and dt_save must be specified')
+        timerange = specification['timerange']
+        if not (isinstance(timerange, (list, tuple)) and len(timerange) == 2):
+            raise SpecificationError('timerange must be a pair (t_init, t_final)')
+        self.timerange = tuple(self._number(t, 'timerange') for t in timerange)
+        if self.timerange[1] <= self.timerange[0]:
+            raise SpecificationError('timerange must be increasing')
+        self.dt_save = self._number(specification['dt_save'], 'dt_save')
+        if not 0 < self.dt_save <= self.timerange[1] - self.timerange[0]:
+            raise SpecificationError('dt_save must be positive and not exceed the time range')
+        # ensemble
+        size = self.ensemble['size']
+        if isinstance(size, bool) or not isinstance(size, int) or size < 1:
+            raise SpecificationError('ensemble size must be a positive integer')
+        if self._number(self.ensemble['T'], 'T') < 0:
+            raise SpecificationError('temperature must not be negative')
+        self.ensemble.setdefault('t', self.timerange[0])
+        self._number(self.ensemble['t'], 't')
+        seed = self.ensemble.get('seed', 0)
+        if isinstance(seed, bool) or not isinstance(seed, int) or seed < 0:
+            raise SpecificationError('seed must be a non-negative integer')
+        # solver
+        if self.solver['integrator'] not in self.integrators:
+            raise SpecificationError(f'integrator must be one of {self.integrators}')
+        nsteps = self.solver['nsteps']
+        if isinstance(nsteps, bool) or not isinstance(nsteps, int) or nsteps < 1:
+            raise SpecificationError('nsteps must be a positive integer')
+        if self.solver['backend'] not in self.backends:
+            raise SpecificationError(f'backend must be one of {self.backends}')
+        if 'dt_step' in self.solver and self._number(self.solver['dt_step'], 'dt_step') <= 0:
+            raise SpecificationError('dt_step must be positive')
+        if self.solver['dtype'] not in ('float64', 'float32'):
+            raise SpecificationError('dtype must be float64 or float32')
+        validate = self.solver.get('validate', 0)
+        if isinstance(validate, bool) or not isinstance(validate, int) or validate < 0:
+            raise SpecificationError('validate must be a non-negative integer')
+        if 'tolerance' in self.solver and self._number(self.solver['tolerance'], 'tolerance') <= 0:
+            raise SpecificationError('tolerance must be positive')
+        if self.solver['dtype'] != 'float64' and self.solver['backend'] in ('scipy', 'sudden'):
+            raise SpecificationError('dtype float32 requires the numpy or numba backend')
+        # convergence-driven ensemble size
+        if self.convergence and 'target_error' not in self.convergence:
+            raise SpecificationError('missing entry target_error in section [convergence]')
+        if 'target_error' in self.convergence and self._number(self.convergence['target_error'],
+                                                               'target_error') <= 0:
+            raise SpecificationError('target_error must be positive')
+        for key in ('batch_size', 'max_size'):
+            value = self.convergence.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                raise SpecificationError(f'{key} must be a positive integer')
+
+
+    @classmethod
+    def FromFile(cls, filename):
+        """Read and validate a specification from a JSON (.json), TOML (.toml), or YAML (.yaml, .yml) file"""
+        return cls(cls.read(filename))
+
+
+    @staticmethod
+    def read(filename):
+        """Read the unvalidated specification (nested dictionary) from a file, see :meth:`FromFile`"""
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.json':
+            with open(filename) as f:
+                specification = json.load(f)
+        elif extension == '.toml':
+            try:
+                import tomllib
+            except ImportError:
+                import tomli as tomllib
+            with open(filename, 'rb') as f:
+                specification = tomllib.load(f)
+        elif extension in ('.yaml', '.yml'):
+            import yaml
+            with open(filename) as f:
+                specification = yaml.safe_load(f)
+        else:
+            raise SpecificationError(f'unknown specification format {extension}')
+        return specification
+
+
+    @staticmethod
+    def is_specification(filename):
+        """Check whether `filename` is a declarative specification (by its extension)"""
+        return os.path.splitext(filename)[1].lower() in ('.json', '.toml', '.yaml', '.yml')
+
+
+    @staticmethod
+    def _section(name, section, defaults):
+        """Validate `section` against its allowed keys and `defaults`; see :attr:`sections`"""
+        if not isinstance(section, dict):
+            raise SpecificationError(f'missing or invalid section [{name}]')
+        unknown = set(section) - set(defaults)
+        if unknown:
+            raise SpecificationError(f'unknown entries {sorted(unknown)} in section [{name}]')
+        values = {}
+        for key, default in defaults.items():
+            if key in section:
+                values[key] = section[key]
+            elif default is None:
+                raise SpecificationError(f'missing entry {key} in section [{name}]')
+            elif default is not False:
+                values[key] = default
+        return values
+
+
+    @staticmethod
+    def _number(value, name):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value):
+            raise SpecificationError(f'{name} must be a finite number')
+        return float(value)
+
+
+    @staticmethod
+    def _tensor(value, name):
+        """Convert a 3-vector of principal values or a 3x3 matrix to a 3x3 tensor"""
+        try:
+            tensor = np.array(value, dtype=float)
+        except (TypeError, ValueError):
+            raise SpecificationError(f'{name} must be a list of numbers')
+        if tensor.shape == (3,):
+            tensor = np.diag(tensor)
+        if tensor.shape != (3, 3) or not np.all(np.isfinite(tensor)):
+            raise SpecificationError(f'{name} must be a 3-vector or a 3x3 matrix')
+        return tensor
+
+
+    @staticmethod
+    def _vector(value, name):
+        try:
+            vector = np.array(value, dtype=float)
+        except (TypeError, ValueError):
+            raise SpecificationError(f'{name} must be a list of numbers')
+        if vector.shape != (3,) or not np.all(np.isfinite(vector)):
+            raise SpecificationError(f'{name} must be a 3-vector')
+        return vector
+
+
+    def create_field(self):
+        """Create the specified :class:`Field`, a :class:`MixedField` if a DC field `dc` is given"""
+        from cmiclassirot.field import Field, MixedField
+        if 'dc' in self.field:
+            return MixedField(**self.field)
+        return Field(**self.field)
+
+
+    def create_ensemble(self, chunk_size=None):
+        """Create the specified :class:`Ensemble`, out of core for a `chunk_size`, see :class:`Ensemble`"""
+        from cmiclassirot.sample import Ensemble, Molecule
+        species = [Molecule(mol['I'], mol['P'], t=self.ensemble['t'], mu=mol.get('mu')) for mol in self.species]
+        fractions = [mol.get('fraction', 1.) for mol in self.species]
+        return Ensemble(self.ensemble['size'], species, T=self.ensemble['T'], t=self.ensemble['t'],
+                        fractions=fractions, chunk_size=chunk_size, seed=self.ensemble.get('seed'))
+
+
+    def estimate(self):
+        """Estimate the cost of the specified calculation
+
+        :return: `dict` with the number of molecules, of saved frames per molecule, of bytes of
+        trajectory data, and an estimate of the single-CPU propagation time (s)
+
+        """
+        return self.estimate_from(self.ensemble['size'], self.timerange, self.dt_save)
+
+
+    @classmethod
+    def estimate_from(cls, size, timerange, dt_save):
+        """Estimate the cost of propagating `size` molecules over `timerange`; see :meth:`estimate`"""
+        frames = int(np.floor((timerange[1] - timerange[0]) / dt_save * (1 + 1e-12))) + 2
+        return {'molecules': size,
+                'frames': frames,
+                'data': size * frames * 8 * 8,
+                'cpu_time': size * frames * cls.seconds_per_frame}
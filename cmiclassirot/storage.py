@@ -0,0 +1,290 @@
+# -*- coding: utf-8; fill-column: 100 -*-
+#
+# This file is part of CMIclassirot -- classical-physics rotational molecular-dynamics simulations
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE.md file
+# for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Compact HDF5 storage of ensemble trajectories
+
+The compact format stores the trajectories of all molecules in a few chunked and compressed
+(blosc:zstd) arrays of shape (molecules, frames, ...) with a single, shared time axis:
+
+- `/time`: time of the frames (float64)
+- `/quaternions`: orientation quaternions as float64 or float32 (molecules, frames, 4), or, with
+  the `smallest-three` encoding, `/quaternion_index` (uint8) of the largest component of the
+  normalized and sign-fixed quaternion and `/quaternions` (uint16) of the other three components
+- `/velocities`: angular velocities (molecules, frames, 3) of every `velocity_stride`-th frame
+
+The `smallest-three` encoding quantizes the three smaller components, which lie in
+:math:`[-1/\\sqrt{2}, 1/\\sqrt{2}]`, to 16 bit, i.e., with an error of at most
+:math:`1.1\\times10^{-5}` per component, which bounds the error of the direction of the molecular
+axis to :math:`5\\times10^{-5}` rad and that of :math:`\\cos^2\\theta` to :math:`10^{-4}`.
+Angular velocities of frames that are not stored are linearly interpolated on loading.
+
+The table format, written by :class:`TableWriter`, stores one table per molecule instead. Files
+written by :class:`TrajectoryWriter` are recognized and read by :meth:`Ensemble._load`, such that
+the format is transparent to all users of :class:`Ensemble`; :func:`load_states` reads the
+trajectories of either format as one array without creating |Molecule|s.
+
+"""
+
+import pickle
+
+import numpy as np
+
+
+format_name = 'cmiclassirot-compact'
+encodings = ('float64', 'float32', 'smallest-three')
+# metadata larger than this (bytes, pickled) exceeds the 64 kiB limit of HDF5 attributes
+attribute_limit = 60000
+
+
+
+def set_metadata(h5file, node, metadata):
+    """Store the `metadata` of an ensemble in the open PyTables file `h5file`
+
+    Metadata is stored as attribute `metadata` of `node`; large metadata, e.g., the weights of big
+    ensembles, is stored as compressed, pickled byte array `/metadata` instead.
+
+    """
+    import tables
+    data = pickle.dumps(metadata)
+    if len(data) < attribute_limit:
+        h5file.get_node(node)._v_attrs.metadata = metadata
+    else:
+        h5file.create_carray('/', 'metadata', obj=np.frombuffer(data, dtype=np.uint8),
+                             filters=tables.Filters(complevel=5, complib='blosc:zstd'))
+
+
+def get_metadata(h5file, node):
+    """Read the metadata stored by :func:`set_metadata`"""
+    if '/metadata' in h5file:
+        return pickle.loads(h5file.root.metadata[:].tobytes())
+    return h5file.get_node(node)._v_attrs.metadata
+
+
+
+def encode_smallest_three(q):
+    """Encode quaternions `q` (..., 4) as index of their largest component and 16-bit values of the others"""
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    index = np.argmax(np.abs(q), axis=-1)
+    # q and -q are the same rotation; choose the sign that makes the dropped component positive
+    q = q * np.where(np.take_along_axis(q, index[..., None], axis=-1) < 0, -1., 1.)
+    others = np.stack([np.take_along_axis(q, ((index + i) % 4)[..., None], axis=-1)[..., 0] for i in (1, 2, 3)],
+                      axis=-1)
+    values = np.rint((others * np.sqrt(2) + 1) / 2 * 65535)
+    return index.astype(np.uint8), np.clip(values, 0, 65535).astype(np.uint16)
+
+
+def decode_smallest_three(index, values):
+    """Decode quaternions from :func:`encode_smallest_three`"""
+    others = (values.astype(float) / 65535 * 2 - 1) / np.sqrt(2)
+    largest = np.sqrt(np.maximum(1 - np.sum(others**2, axis=-1), 0))
+    q = np.empty(index.shape + (4,))
+    index = index.astype(int)
+    np.put_along_axis(q, index[..., None], largest[..., None], axis=-1)
+    for i in (1, 2, 3):
+        np.put_along_axis(q, ((index + i) % 4)[..., None], others[..., i-1:i], axis=-1)
+    return q
+
+
+
+class TrajectoryWriter(object):
+    """Writer of the compact trajectory format
+
+    Molecules are appended in chunks, such that ensembles need not be held in memory completely.
+
+    """
+
+    def __init__(self, filename, quaternions='float32', velocity_stride=1, dtype='float32', complevel=5):
+        """Create the file `filename`
+
+        :param quaternions: Encoding of the quaternions, one of `encodings`
+
+        :param velocity_stride: Store the angular velocities of every `velocity_stride`-th frame only
+
+        :param dtype: Precision of the angular velocities, 'float64' or 'float32'
+
+        :param complevel: Compression level of blosc:zstd, 0 for no compression
+
+        """
+        import tables
+        if quaternions not in encodings:
+            raise ValueError(f'unknown quaternion encoding {quaternions}')
+        if velocity_stride < 1:
+            raise ValueError('velocity_stride must be a positive integer')
+        self.quaternions = quaternions
+        self.velocity_stride = velocity_stride
+        self.dtype = np.dtype(dtype)
+        self.filters = tables.Filters(complevel=complevel, complib='blosc:zstd', shuffle=True)
+        self.file = tables.open_file(filename, mode='w')
+        self.time = None
+        self.molecules = 0
+
+
+    def _create(self, time):
+        """Create the arrays for frames at `time`"""
+        import tables
+        frames = len(time)
+        self.time = time
+        self.file.create_array('/', 'time', np.asarray(time, dtype=float))
+        chunk = lambda *shape: (max(1, 2**16 // int(np.prod(shape) * frames)), frames) + shape
+        if self.quaternions == 'smallest-three':
+            self.file.create_earray('/', 'quaternion_index', tables.UInt8Atom(), (0, frames),
+                                    filters=self.filters, chunkshape=chunk())
+            self.file.create_earray('/', 'quaternions', tables.UInt16Atom(), (0, frames, 3),
+                                    filters=self.filters, chunkshape=chunk(3))
+        else:
+            self.file.create_earray('/', 'quaternions', tables.Atom.from_dtype(np.dtype(self.quaternions)),
+                                    (0, frames, 4), filters=self.filters, chunkshape=chunk(4))
+        frames = len(range(0, frames, self.velocity_stride))
+        self.file.create_earray('/', 'velocities', tables.Atom.from_dtype(self.dtype), (0, frames, 3),
+                                filters=self.filters, chunkshape=chunk(3))
+
+
+    def append(self, states):
+        """Append the trajectories `states` (molecules, frames, 8) of a chunk of molecules
+
+        :raise ValueError: if the molecules were not saved at the times of the previous molecules
+
+        """
+        states = np.asarray(states)
+        if self.time is None:
+            self._create(states[0, :, 7])
+        if states.shape[1] != len(self.time) or not np.allclose(states[..., 7], self.time, rtol=0,
+                                                               atol=1e-9 * np.abs(self.time).max()):
+            raise ValueError('compact storage requires identical save times of all molecules')
+        if self.quaternions == 'smallest-three':
+            index, values = encode_smallest_three(states[..., :4])
+            self.file.root.quaternion_index.append(index)
+            self.file.root.quaternions.append(values)
+        else:
+            self.file.root.quaternions.append(states[..., :4].astype(self.quaternions))
+        self.file.root.velocities.append(states[:, ::self.velocity_stride, 4:7].astype(self.dtype))
+        self.molecules += len(states)
+
+
+    def close(self, metadata):
+        """Store the `metadata` of the ensemble (see :meth:`Ensemble._save`) and close the file"""
+        attrs = self.file.root._v_attrs
+        attrs.format = format_name
+        attrs.quaternion_encoding = self.quaternions
+        attrs.velocity_stride = self.velocity_stride
+        set_metadata(self.file, '/', metadata)
+        self.file.close()
+
+
+
+class TableWriter(object):
+    """Writer of the table format, one table of quaternions, angular velocities, and times per molecule
+
+    Molecules are appended in chunks like with :class:`TrajectoryWriter`; their trajectories may have
+    different lengths.
+
+    """
+
+    columns = ['r', 'i', 'j', 'k', 'omega_x', 'omega_y', 'omega_z', 'time']
+
+    def __init__(self, filename, dtype='float64'):
+        """Create the file `filename`
+
+        :param dtype: Precision of the quaternions and angular velocities, 'float64' or 'float32'
+
+        """
+        import pandas as pd
+        self.filename = filename
+        self.dtype = dtype
+        self.store = pd.HDFStore(filename, mode='w')
+        self.molecules = 0
+
+
+    def append(self, states):
+        """Append the trajectories `states`, a sequence of arrays (frames, 8), of a chunk of molecules"""
+        import pandas as pd
+        for trajectory in states:
+            df = pd.DataFrame(trajectory, columns=self.columns).astype(dict.fromkeys(self.columns[:7], self.dtype))
+            self.store.put('Molecule'+str(self.molecules), df)
+            self.molecules += 1
+
+
+    def close(self, metadata):
+        """Store the `metadata` of the ensemble (see :meth:`Ensemble._save`) and close the file"""
+        import tables
+        self.store.close()
+        with tables.open_file(self.filename, mode='a') as f:
+            set_metadata(f, '/Molecule0', metadata)
+
+
+
+def is_compact(filename):
+    """Check whether `filename` is in the compact trajectory format"""
+    import tables
+    with tables.open_file(filename, mode='r') as f:
+        return getattr(f.root._v_attrs, 'format', None) == format_name
+
+
+def load_metadata(filename):
+    """Metadata of a compact or table-format ensemble file, see :meth:`Ensemble._save`
+
+    :return: Tuple of the `dict` of metadata and the number of molecules
+
+    """
+    import tables
+    if not is_compact(filename):
+        with tables.open_file(filename, mode='r') as f:
+            size = sum(1 for name in f.root._v_groups if name.startswith('Molecule'))
+            return get_metadata(f, '/Molecule0'), size
+    with tables.open_file(filename, mode='r') as f:
+        return get_metadata(f, '/'), len(f.root.quaternions)
+
+
+def load_states(filename, molecules=slice(None)):
+    """Read trajectories of a compact or table-format ensemble file
+
+    :param molecules: Selection (slice or index array) of the molecules to read
+
+    :return: Tuple of the `ndarray` of states (molecules, frames, 8), see :meth:`Ensemble.states`, and
+    the `dict` of metadata of the ensemble
+
+    """
+    import tables
+    if not is_compact(filename):
+        import pandas as pd
+        metadata, size = load_metadata(filename)
+        with pd.HDFStore(filename, mode='r') as store:
+            keys = [f'/Molecule{i}' for i in range(size)]
+            trajectories = [store[key].values for key in np.array(keys)[molecules]]
+        frames = min(len(trajectory) for trajectory in trajectories)
+        return np.array([trajectory[:frames] for trajectory in trajectories], dtype=float), metadata
+    with tables.open_file(filename, mode='r') as f:
+        attrs = f.root._v_attrs
+        time = f.root.time[:]
+        if attrs.quaternion_encoding == 'smallest-three':
+            q = decode_smallest_three(f.root.quaternion_index[molecules], f.root.quaternions[molecules])
+        else:
+            q = f.root.quaternions[molecules].astype(float)
+        velocities = f.root.velocities[molecules].astype(float)
+        metadata = get_metadata(f, '/')
+        stride = attrs.velocity_stride
+    states = np.empty(q.shape[:2] + (8,))
+    states[..., :4] = q
+    if stride == 1:
+        states[..., 4:7] = velocities
+    else:
+        stored = time[::stride]
+        for i in range(3):
+            states[..., 4+i] = np.array([np.interp(time, stored, v) for v in velocities[..., i]]).reshape(q.shape[:2])
+    states[..., 7] = time
+    return states, metadata
@@ -0,0 +1,53 @@
+# -*- coding: utf-8; fill-column: 120 -*-
+#
+# This file is part of CMIclassirot -- example calculation for a polydisperse sample of Au nanorods
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# If you use this programm for scientific work, you must correctly reference it; see LICENSE file for details.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# Au nanorods of 2 nm radius with a Gaussian distribution of lengths (10 +- 1 nm), discretized into species, are
+# propagated together; use this file as input of `cmiclassirot`, preferably with a batched solver backend.
+
+import math
+import numpy as np
+from scipy.constants import epsilon_0
+
+from cmiclassirot.field import *
+from cmiclassirot.sample import *
+
+
+# define timerange of integration and stepsize for saving the distribution
+timerange = (0., 15.e-9)
+dt_save = 5.e-11
+
+# define the alignment field
+field = Field(peak_intensity=1.e15, FWHM=2.35e-9, t_peak=3.e-9)
+
+nm = 1.e-9
+rho = 19.3e3                                    # density of gold (kg/m**3)
+radius = 2 * nm
+lengths = np.linspace(7, 13, 13) * nm           # length of the species
+fractions = np.exp(-0.5 * ((lengths - 10 * nm) / nm)**2)
+
+# polarizability of the 10 nm rod; it scales with the volume, i.e., the length, of the rods
+P_10nm = 1.e-30 * epsilon_0 * np.array([[5.646E5, 0., 0.],
+                                        [0., 5.646E5, 0.],
+                                        [0., 0., 4.860E6]])
+species = []
+for length in lengths:
+    mass = math.pi * radius**2 * length * rho
+    Iz = 0.5 * mass * radius**2
+    Ix = Iy = 1./12 * mass * (3 * radius**2 + length**2)
+    species.append(Molecule(np.diag([Ix, Iy, Iz]), P_10nm * length / (10 * nm), t=timerange[0]))
+
+# we calculate the alignment for an ensemble of 1300 rods at 20 K
+ensemble = Ensemble(1300, species, T=20., t=timerange[0], fractions=fractions)
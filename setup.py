@@ -30,7 +30,11 @@ setup(name=name,
     version             = version,
     packages            = ['cmiclassirot'],
     scripts             = ['bin/cmiclassirot',
-                           'bin/cmiclassirot-plot'],
+                           'bin/cmiclassirot-cache',
+                           'bin/cmiclassirot-client',
+                           'bin/cmiclassirot-plot',
+                           'bin/cmiclassirot-precision',
+                           'bin/cmiclassirot-server'],
     python_requires     = '>=3.9',
     install_requires    = ['numpy>=1.16.0',
                            'pyquaternion',
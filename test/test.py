@@ -22,7 +22,27 @@ __doc__ = """Running this file gives mane warnings -- fix.
 
 from cmiclassirot.sample import *
 from cmiclassirot.field import *
+from cmiclassirot import kernels
+from cmiclassirot.cache import ResultCache
+from cmiclassirot.field import MixedField
+from cmiclassirot.focal import FocalVolume
+from cmiclassirot.impulsive import SuddenKick, free
+from cmiclassirot.optimize import PulseOptimizer
+from cmiclassirot.postprocessing import (AlignmentEvents, DetectorImage, Expectation, cos2theta, cos2theta_2D,
+                                         expectation_from_file)
+from cmiclassirot.progress import Progress
+from cmiclassirot.propagate import Propagate
+from cmiclassirot.server import Client, ServerError
+from cmiclassirot.specification import Specification, SpecificationError
+from cmiclassirot.storage import load_states
 from math import pi
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from pyquaternion import Quaternion
 from scipy.constants import c, epsilon_0
@@ -46,6 +66,18 @@ P = np.array([[  1.1e-26, 0.,       0],
               [  0,       0,  2.5e-25]])
 
 T = 0.4 #K
+
+# inertia and polarizability tensors of a linear molecule (OCS-like) for short propagations
+I_linear = np.diag([1.38e-45, 1.38e-45, 0.])
+P_linear = np.diag([4.3e-40, 4.3e-40, 8.4e-40])
+pulse = Field(peak_intensity=1e17, FWHM=100e-15, t_peak=0.)
+timerange = (-200e-15, 200e-15)
+dt_save = 100e-15
+
+def two_pulses(peak_intensity, delay):
+    """Pulse train of the optimization test; module-level for pickling"""
+    return PulseTrain(peak_intensity=peak_intensity, FWHM=100e-15, t_peak=[-100e-15, delay])
+
 # testing the first version of the constructor of the molecule class
 class TestCMIclassirot(unittest.TestCase):
 
@@ -125,5 +157,629 @@ class TestCMIclassirot(unittest.TestCase):
         E = Field(amplitude=A, sigma=5e-9, mean=0., intensity=True)
         self.assertEqual(E(0.)[2], 1.)
 
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_store_and_lookup(self):
+        """identical inputs are served from the cache, LRU eviction empties it"""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory)
+            ensemble = Ensemble(2, Molecule(I_linear, P_linear), T=1.)
+            initial = [mol.pos[0] for mol in ensemble.molecules]
+            Propagate(ensemble, pulse, timerange, dt_save, cache=cache)
+            self.assertEqual(len(cache.entries()), 1)
+            again = Ensemble(2, Molecule(I_linear, P_linear), T=1.)
+            for mol, pos in zip(again.molecules, initial):
+                mol.pos = [pos]
+            p = Propagate(again, pulse, timerange, dt_save, cache=cache)
+            self.assertIsNotNone(cache.lookup(cache.key(p)))
+            self.assertEqual(len(again.molecules[0].pos), len(ensemble.molecules[0].pos))
+            self.assertEqual(len(cache.evict(0)), 1)
+            self.assertEqual(cache.entries(), [])
+
+    def test_weights(self):
+        """ensembles that differ in their weights only are not served from each other's cache entries"""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory)
+            keys = []
+            for weights in ([10., 1., 1., 1.], [1., 1., 1., 1.]):
+                ensemble = Ensemble(4, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=9)
+                ensemble.weights = np.array(weights)
+                p = Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'}, cache=cache)
+                keys.append(cache.key(p))
+                np.testing.assert_array_equal(ensemble.weights, weights)
+            self.assertNotEqual(keys[0], keys[1])
+            self.assertEqual(len(cache.entries()), 2)
+
+    def test_output(self):
+        """cached results are written to the output file and complete the progress status"""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(os.path.join(directory, 'cache'))
+            for name in ('first', 'second'):
+                ensemble = Ensemble(2, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=4)
+                output, status = (os.path.join(directory, name + extension) for extension in ('.h5', '.json'))
+                Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'}, cache=cache,
+                          output=output, status_file=status)
+                self.assertEqual(len(cache.entries()), 1)
+                with open(status) as f:
+                    self.assertEqual(json.load(f)['state'], 'finished')
+            first, second = (expectation_from_file(os.path.join(directory, name + '.h5'))
+                             for name in ('first', 'second'))
+            np.testing.assert_array_equal(first[1], second[1])
+
+
+
+class TestConvergence(unittest.TestCase):
+
+    def test_cos2theta(self):
+        """vectorized <cos^2 theta> agrees with the rotation matrices of the molecules"""
+        ensemble = Ensemble(5, Molecule(I_linear, P_linear), T=1.)
+        reference = np.mean([mol.pos[0].angle.rotation_matrix[2][2]**2 for mol in ensemble.molecules])
+        self.assertAlmostEqual(cos2theta(ensemble)()[0], reference)
+
+    def test_adaptive_ensemble_size(self):
+        """the ensemble is extended in batches until the target error or the size limit is reached"""
+        ensemble = Ensemble(2, Molecule(I_linear, P_linear), T=1.)
+        Propagate(ensemble, pulse, timerange, dt_save, target_error=1e-9, batch_size=3, max_size=7)
+        self.assertEqual(ensemble.size, 7)
+        self.assertEqual(len(ensemble.molecules), 7)
+        self.assertFalse(ensemble.precision['converged'])
+        ensemble = Ensemble(4, Molecule(I_linear, P_linear), T=1.)
+        Propagate(ensemble, pulse, timerange, dt_save, target_error=1.)
+        self.assertEqual(ensemble.size, 4)
+        self.assertTrue(ensemble.precision['converged'])
+
+    def test_weighted_error(self):
+        """the stopping criterion is the weighted standard error of the reported expectation value"""
+        ensemble = Ensemble(6, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=8)
+        ensemble.weights = np.array([5., 1., 1., 1., 1., 1.])
+        p = Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'}, target_error=1.)
+        np.testing.assert_allclose(p.standard_error, cos2theta(ensemble).standard_error())
+
+
+
+class TestReweighting(unittest.TestCase):
+
+    def test_reweight_temperature(self):
+        """reweighting a 10 K ensemble to 5 K reproduces the thermal rotational energy at 5 K"""
+        ensemble = Ensemble(4000, Molecule(I_linear, P_linear), T=10.)
+        np.testing.assert_allclose(ensemble.reweight(10.), np.ones(4000))
+        weights = ensemble.reweight(5.)
+        energy = np.array([0.5 * np.sum(np.diagonal(mol.I) * mol.pos[0].velocity**2) for mol in ensemble.molecules])
+        self.assertAlmostEqual(np.average(energy, weights=weights) / (scipy.constants.Boltzmann * 5.), 1., delta=0.1)
+        self.assertLess(Ensemble.effective_sample_size(weights), 4000)
+        self.assertGreater(Ensemble.effective_sample_size(weights), 1000)
+
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_statistics(self):
+        """instrumentation counts RHS and field evaluations and solver steps and is stored in the file"""
+        ensemble = Ensemble(2, Molecule(I_linear, P_linear), T=1.)
+        p = Propagate(ensemble, pulse, timerange, dt_save, profile=True)
+        stats = p.statistics.as_dict()
+        self.assertEqual(stats['molecules'], 2)
+        self.assertGreater(stats['totals']['steps'], 0)
+        self.assertEqual(stats['totals']['rhs_calls'], stats['totals']['field_calls'])
+        with tempfile.TemporaryDirectory() as directory:
+            ensemble._save(os.path.join(directory, 'profile.h5'))
+            loaded = Ensemble(0, Molecule(I_linear, P_linear))
+            loaded._load(os.path.join(directory, 'profile.h5'))
+        self.assertEqual(loaded.statistics['totals']['steps'], stats['totals']['steps'])
+
+    def test_batches(self):
+        """batched backends record their batches instead of made-up per-molecule counters"""
+        ensemble = Ensemble(3, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=10)
+        p = Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'}, profile=True)
+        stats = p.statistics.as_dict()
+        self.assertEqual(stats['molecules'], 3)
+        self.assertEqual(len(stats['batches']), 1)
+        self.assertEqual(stats['outliers'], [])
+        self.assertIsNone(stats['utilization'])
+        self.assertEqual(stats['totals']['steps'], 0)
+        self.assertIn('not instrumented', p.statistics.report())
+
+
+
+class TestProgress(unittest.TestCase):
+
+    def test_status_file(self):
+        """streamed results drive the machine-readable status file"""
+        with tempfile.TemporaryDirectory() as directory:
+            status_file = os.path.join(directory, 'status.json')
+            ensemble = Ensemble(3, Molecule(I_linear, P_linear), T=1.)
+            Propagate(ensemble, pulse, timerange, dt_save, status_file=status_file)
+            with open(status_file) as f:
+                status = json.load(f)
+        self.assertEqual(status['state'], 'finished')
+        self.assertEqual(status['completed'], 3)
+        self.assertAlmostEqual(status['simulated_time'], 3 * (timerange[1] - timerange[0]))
+        self.assertTrue(all(len(mol.pos) > 1 for mol in ensemble.molecules))
+
+    def test_out_of_core(self):
+        """the progress of out-of-core ensembles refers to the whole ensemble from the first chunk on"""
+        class Totals(Progress):
+            def report(self, state='running'):
+                self.totals = getattr(self, 'totals', []) + [self.total]
+                return super().report(state)
+        with tempfile.TemporaryDirectory() as directory:
+            ensemble = Ensemble(7, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], chunk_size=3)
+            progress = Totals(0, timerange[1] - timerange[0], stream=None, interval=0.)
+            Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'}, progress=progress,
+                      output=os.path.join(directory, 'ensemble.h5'))
+        self.assertEqual(set(progress.totals), {7})
+        self.assertEqual(progress.completed, 7)
+
+
+
+class TestScheduling(unittest.TestCase):
+
+    def test_order_of_results(self):
+        """reordered work units are returned in the order of the ensemble"""
+        for schedule, ordering, processes in (('static', None, 2), ('dynamic', 'velocity', 2),
+                                             ('dynamic', 'pilot', 2), ('dynamic', 'pilot', 1)):
+            ensemble = Ensemble(4, Molecule(I_linear, P_linear), T=1.)
+            initial = [mol.pos[0].velocity for mol in ensemble.molecules]
+            Propagate(ensemble, pulse, timerange, dt_save, schedule=schedule, ordering=ordering,
+                      processes=processes)
+            for mol, velocity in zip(ensemble.molecules, initial):
+                np.testing.assert_array_equal(mol.pos[0].velocity, velocity)
+                self.assertGreater(len(mol.pos), 1)
+
+
+
+class TestSpecification(unittest.TestCase):
+
+    specification = {'molecule': {'I': [1.38e-45, 1.38e-45, 0.], 'P': P_linear.tolist()},
+                     'field': {'peak_intensity': 1e17, 'FWHM': 100e-15},
+                     'ensemble': {'size': 3, 'T': 1.},
+                     'timerange': [-200e-15, 200e-15],
+                     'dt_save': 100e-15}
+
+    def test_valid(self):
+        """a valid specification creates field and ensemble"""
+        spec = Specification(self.specification)
+        self.assertEqual(spec.molecule['I'].shape, (3, 3))
+        self.assertEqual(spec.solver['integrator'], 'dopri5')
+        self.assertEqual(spec.estimate()['frames'], 6)
+        self.assertEqual(spec.create_ensemble().size, 3)
+        self.assertAlmostEqual(spec.create_field()(0.), Field.intensity2amplitude(1e17))
+
+    def test_invalid(self):
+        """typos and inconsistent values are rejected before any computation"""
+        for section, key, value in (('field', 'peak_intensty', 1e17), ('ensemble', 'size', 0),
+                                    ('molecule', 'P', [1., 2.]), ('solver', 'integrator', 'euler')):
+            spec = {name: dict(value) if isinstance(value, dict) else value
+                    for name, value in self.specification.items()}
+            spec.setdefault(section, {})[key] = value
+            with self.assertRaises(SpecificationError):
+                Specification(spec)
+
+
+
+class TestKernels(unittest.TestCase):
+
+    def test_derivative(self):
+        """batched derivatives agree with the reference derivative to round-off"""
+        molecules = (Ensemble(5, Molecule(I_linear, P_linear), T=1.).molecules
+                     + Ensemble(5, Molecule(np.diag(I), P), T=T).molecules)
+        propagator = Propagate(Ensemble(0, Molecule(I_linear, P_linear)), pulse, timerange, dt_save)
+        states = np.array([mol.states()[0, :7] for mol in molecules])
+        reference = np.array([propagator._derivative(1e-14, y, mol) for y, mol in zip(states, molecules)])
+        parameters = kernels.parameters(molecules)
+        derivative = kernels.derivative(states, pulse(1e-14), pulse.Ez, *parameters)
+        np.testing.assert_allclose(derivative, reference, rtol=1e-12, atol=1e-12 * np.abs(reference).max())
+        for i in range(len(molecules)):
+            dy = np.empty(7)
+            kernels._rhs(states[i], pulse(1e-14), pulse.Ez, *(x[i] for x in parameters), np.zeros(3), np.zeros(3),
+                         False, dy)
+            np.testing.assert_allclose(dy, reference[i], rtol=1e-12, atol=1e-12 * np.abs(reference[i]).max())
+
+    def test_mixed_field(self):
+        """permanent-dipole and DC-induced torques agree with the reference derivative"""
+        mixed = MixedField(dc=[0., 2e5, 1e6], peak_intensity=1e17, FWHM=100e-15, t_peak=0.)
+        molecules = Ensemble(5, Molecule(I_linear, P_linear, mu=[0., 0., 2.4e-30]), T=1.).molecules
+        propagator = Propagate(Ensemble(0, molecules[0]), mixed, timerange, dt_save)
+        states = np.array([mol.states()[0, :7] for mol in molecules])
+        reference = np.array([propagator._derivative(1e-14, y, mol) for y, mol in zip(states, molecules)])
+        derivative = kernels.derivative(states, mixed(1e-14), mixed.Ez, *kernels.parameters(molecules),
+                                        kernels.dipoles(molecules), mixed.dc)
+        np.testing.assert_allclose(derivative, reference, rtol=1e-12, atol=1e-12 * np.abs(reference).max())
+        # the static field rotates the dipole moment towards it, here the molecular z axis towards x
+        acceleration = molecules[0].acceleration(np.zeros(3), Position(), dc=np.array([1e6, 0., 1e6]))
+        self.assertGreater(acceleration[1], 0.)
+
+    def test_backend(self):
+        """the batched backend reproduces the alignment of the scipy integrator"""
+        results = []
+        for backend in ('scipy', 'numpy'):
+            np.random.seed(3)
+            ensemble = Ensemble(4, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0])
+            Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': backend}, processes=1)
+            results.append(cos2theta(ensemble)())
+        np.testing.assert_allclose(results[1], results[0], atol=1e-6)
+
+    def test_single_precision(self):
+        """single-precision propagation agrees with double precision and is stored as float32"""
+        results = []
+        for dtype in ('float64', 'float32'):
+            np.random.seed(3)
+            ensemble = Ensemble(4, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0])
+            Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy', 'dtype': dtype})
+            results.append(cos2theta(ensemble)())
+        np.testing.assert_allclose(results[1], results[0], atol=1e-5)
+        self.assertEqual(ensemble.dtype, 'float32')
+        with tempfile.TemporaryDirectory() as directory:
+            ensemble._save(os.path.join(directory, 'ensemble.h5'))
+            import pandas as pd
+            with pd.HDFStore(os.path.join(directory, 'ensemble.h5')) as store:
+                self.assertEqual(store['Molecule0']['r'].dtype, np.float32)
+                self.assertEqual(store['Molecule0']['time'].dtype, np.float64)
+
+
+
+class TestStorage(unittest.TestCase):
+
+    def test_compact(self):
+        """compact files are read transparently, within the error bound of the quaternion encoding"""
+        ensemble = Ensemble(5, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0])
+        Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        with tempfile.TemporaryDirectory() as directory:
+            for quaternions, tolerance in (('float64', 1e-15), ('smallest-three', 1e-4)):
+                filename = os.path.join(directory, f'{quaternions}.h5')
+                ensemble._save(filename, compact={'quaternions': quaternions, 'velocity_stride': 2})
+                loaded = Ensemble.FromFile(filename)
+                self.assertEqual(loaded.size, ensemble.size)
+                self.assertEqual(loaded.temperature, ensemble.temperature)
+                np.testing.assert_allclose(cos2theta(loaded)(), cos2theta(ensemble)(), atol=tolerance)
+                np.testing.assert_array_equal(loaded.states()[:, ::2, 4:], ensemble.states()[:, ::2, 4:])
+
+    def test_expectation_from_file(self):
+        """expectation values are read from stored observables or calculated in chunks"""
+        ensemble = Ensemble(5, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0])
+        Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'ensemble.h5')
+            ensemble._save(filename, compact={'quaternions': 'float64'})
+            t, stored, field = expectation_from_file(filename)
+            np.testing.assert_allclose(stored, cos2theta(ensemble)(), atol=1e-15)
+            np.testing.assert_allclose(field, pulse(t))
+            # observables that are not stored are calculated from the trajectories
+            class sin2theta(Expectation):
+                @staticmethod
+                def evaluate(quaternions):
+                    return 1 - cos2theta.evaluate(quaternions)
+            t, calculated, field = expectation_from_file(filename, sin2theta, chunk=2)
+            np.testing.assert_allclose(calculated, 1 - cos2theta(ensemble)(), atol=1e-15)
+
+    def test_chunked_observables(self):
+        """observables accumulated from the written chunks agree with those of the whole ensemble"""
+        ensemble = Ensemble(1100, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=11)
+        ensemble.weights = np.linspace(1., 2., 1100)
+        Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'ensemble.h5')
+            ensemble._save(filename, compact={'quaternions': 'float64'})
+            stored = load_states(filename)[1]['observables']
+        expected = ensemble.observables()
+        for name in ('time', 'cos2theta', 'cos2theta_2D'):
+            np.testing.assert_allclose(stored[name], expected[name], rtol=1e-12)
+
+    def test_out_of_core(self):
+        """out-of-core propagation writes the same file as propagation in memory"""
+        species = [Molecule(I_linear, P_linear, t=timerange[0]), Molecule(2 * I_linear, P_linear, t=timerange[0])]
+        with tempfile.TemporaryDirectory() as directory:
+            results = []
+            for chunk_size in (None, 3):
+                np.random.seed(1)
+                ensemble = Ensemble(8, species, T=1., t=timerange[0], chunk_size=chunk_size)
+                filename = os.path.join(directory, f'{chunk_size}.h5')
+                Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'}, output=filename,
+                          compact={'quaternions': 'float64'})
+                results.append(load_states(filename))
+            self.assertEqual(ensemble.molecules, [])
+            np.testing.assert_array_equal(results[0][0], results[1][0])
+            for name in ('cos2theta', 'cos2theta_2D'):
+                np.testing.assert_array_equal(results[0][1]['observables'][name], results[1][1]['observables'][name])
+            np.testing.assert_array_equal(results[0][1]['species'], results[1][1]['species'])
+            with self.assertRaises(ValueError):
+                Propagate(ensemble, pulse, timerange, dt_save)
+
+
+
+class TestSpecies(unittest.TestCase):
+
+    species = [Molecule(I_linear, P_linear, t=timerange[0]), Molecule(2 * I_linear, 3 * P_linear, t=timerange[0])]
+
+    def test_composition(self):
+        """molecules are distributed over the species according to their fractions"""
+        ensemble = Ensemble(10, self.species, T=1., t=timerange[0], fractions=[3., 1.])
+        self.assertEqual(list(np.bincount(ensemble.species_index)), [8, 2])
+        ensemble.extend(10)
+        self.assertEqual(list(np.bincount(ensemble.species_index)), [15, 5])
+        for mol, index in zip(ensemble.molecules, ensemble.species_index):
+            self.assertIs(mol.I, self.species[index].I)
+        with self.assertRaises(ValueError):
+            Ensemble(10, self.species, fractions=[1.])
+
+    def test_propagate(self):
+        """species are propagated in one pass like separate ensembles, and stored and loaded"""
+        np.random.seed(0)
+        ensemble = Ensemble(6, self.species, T=1., t=timerange[0])
+        solver = {'backend': 'numpy', 'dt_step': 5e-15}
+        separate = [copy.deepcopy(ensemble) for i in range(2)]
+        Propagate(ensemble, pulse, timerange, dt_save, solver=solver)
+        for i, single in enumerate(separate):
+            single.molecules = [mol for mol, index in zip(single.molecules, single.species_index) if index == i]
+            single.size, single.weights = 3, np.ones(3)
+            Propagate(single, pulse, timerange, dt_save, solver=solver)
+            np.testing.assert_allclose(cos2theta(ensemble).by_species()[i], cos2theta(single)(), atol=1e-12)
+        with tempfile.TemporaryDirectory() as directory:
+            for compact in (None, {'quaternions': 'float64'}):
+                filename = os.path.join(directory, 'species.h5')
+                ensemble._save(filename, compact=compact)
+                loaded = Ensemble.FromFile(filename)
+                np.testing.assert_array_equal(loaded.species_index, ensemble.species_index)
+                np.testing.assert_array_equal(loaded.molecules[-1].P, 3 * P_linear)
+                np.testing.assert_allclose(loaded.observables()['species']['cos2theta'],
+                                           cos2theta(ensemble).by_species(), atol=1e-15)
+
+    def test_seed(self):
+        """seeded ensembles are identical however they are generated"""
+        class Ensemble4(Ensemble):
+            block_size = 4
+        reference = Ensemble4(11, self.species, T=1., seed=5).states()[:, 0]
+        np.random.seed(0)
+        chunked = Ensemble4(11, self.species, T=1., seed=5, chunk_size=3)
+        states = [[mol.states()[0] for mol in molecules] for start, molecules in chunked.chunks()]
+        np.testing.assert_array_equal(np.concatenate(states), reference)
+        # blocks are independent of each other and of the global random state
+        tail = chunked._generate(chunked.species_index[6:], 6)
+        np.testing.assert_array_equal([mol.states()[0] for mol in tail], reference[6:])
+        self.assertFalse(np.array_equal(Ensemble4(11, self.species, T=1., seed=6).states()[:, 0], reference))
+
+    def test_specification(self):
+        """several molecule sections define the species of the ensemble"""
+        specification = {'molecule': [{'I': [1.38e-45, 1.38e-45, 0.], 'P': [4.3e-40, 4.3e-40, 8.4e-40],
+                                       'fraction': 0.75},
+                                      {'I': [2.76e-45, 2.76e-45, 0.], 'P': [4.3e-40, 4.3e-40, 8.4e-40],
+                                       'fraction': 0.25}],
+                         'field': {'peak_intensity': 1e17, 'FWHM': 100e-15},
+                         'ensemble': {'size': 8}, 'timerange': [0., 1e-12], 'dt_save': 1e-13}
+        ensemble = Specification(specification).create_ensemble()
+        self.assertEqual(list(np.bincount(ensemble.species_index)), [6, 2])
+        specification['molecule'][1]['fraction'] = -1.
+        with self.assertRaises(SpecificationError):
+            Specification(specification)
+
+
+
+class TestDetectorImage(unittest.TestCase):
+
+    def test_images(self):
+        """images accumulated during propagation and from files agree and reflect the alignment"""
+        ensemble = Ensemble(20, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0])
+        image = DetectorImage(bins=16)
+        Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'}, stages=[image])
+        np.testing.assert_array_equal(image.images.sum(axis=(1, 2)), 2 * ensemble.size)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'ensemble.h5')
+            ensemble._save(filename)
+            np.testing.assert_array_equal(DetectorImage.from_file(filename, chunk=3, bins=16).images, image.images)
+        # <cos^2 theta_2D> from the pixel centers agrees within the pixel size
+        center = (np.arange(16) + 0.5) / 8 - 1
+        u, v = np.meshgrid(center, center)
+        estimate = np.sum(image.normalized() * v**2 / (u**2 + v**2), axis=(1, 2))
+        np.testing.assert_allclose(estimate, cos2theta_2D(ensemble)(), atol=0.05)
+        accepted = DetectorImage(bins=16, acceptance=0.1).accumulate(ensemble.states())
+        self.assertLess(accepted.images.sum(), image.images.sum())
+
+    def test_short_batch(self):
+        """images are truncated to the frames of shorter trajectories of later batches"""
+        ensemble = Ensemble(4, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=7)
+        Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        states = ensemble.states()
+        image = DetectorImage(bins=8).accumulate(states[:2]).accumulate(states[2:, :3])
+        self.assertEqual(image.images.shape, (3, 8, 8))
+        np.testing.assert_array_equal(image.time, states[0, :3, 7])
+        np.testing.assert_array_equal(image.images.sum(axis=(1, 2)), 2 * 4)
+
+
+
+class TestSuddenKick(unittest.TestCase):
+
+    def test_free(self):
+        """the analytic free rotation of symmetric tops agrees with the numerical integration"""
+        np.random.seed(5)
+        molecules = Ensemble(3, Molecule(np.diag(I), P), T=T).molecules
+        y = np.array([mol.states()[0, :7] for mol in molecules])
+        inertia = np.tile(I, (3, 1))
+        times = np.linspace(1e-10, 1e-9, 4)
+        np.testing.assert_allclose(free(y, inertia * [1, 1 + 1e-9, 1], 0., times), free(y, inertia, 0., times),
+                                   rtol=1e-6, atol=1e-6)
+
+    def test_kick(self):
+        """the sudden approximation reproduces the full integration in a weak short pulse"""
+        weak = pulse.rescaled(1e15)
+        longer = (-200e-15, 2e-12)
+        np.random.seed(3)
+        ensemble = Ensemble(20, Molecule(I_linear, P_linear, t=longer[0]), T=1., t=longer[0])
+        kick = SuddenKick(ensemble.molecules, weak, longer, dt_save)
+        Propagate(ensemble, weak, longer, dt_save, solver={'backend': 'numpy'})
+        states = kick.states(weak)
+        np.testing.assert_allclose(states[..., 7], ensemble.states()[..., 7])
+        np.testing.assert_allclose(kick.expectation(weak), cos2theta(ensemble)(), atol=1e-3)
+        # the kick table is shared by intensity scans
+        scan = kick.scan(weak, [1e14, 1e15])
+        np.testing.assert_allclose(scan[1], kick.expectation(weak))
+        self.assertEqual(len(kick.tables), 1)
+
+    def test_propagate(self):
+        """the sudden backend is validated on a subsample"""
+        np.random.seed(3)
+        ensemble = Ensemble(6, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0])
+        p = Propagate(ensemble, pulse.rescaled(1e15), timerange, dt_save,
+                      solver={'backend': 'sudden', 'validate': 3}, processes=1)
+        self.assertEqual(p.validation['size'], 3)
+        self.assertTrue(p.validation['valid'])
+        self.assertEqual(len(ensemble.molecules[0].pos), 6)
+        with self.assertRaises(ValueError):
+            Propagate(ensemble, MixedField(dc=[0., 0., 1e5], peak_intensity=1e15, FWHM=100e-15), timerange,
+                      dt_save, solver={'backend': 'sudden'})
+
+    def test_subsample(self):
+        """the reference subsample is an ensemble of the given molecules with unit weights"""
+        ensemble = Ensemble(4, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=6)
+        subsample = Ensemble.FromMolecules(ensemble.molecules[:2])
+        self.assertEqual(subsample.size, 2)
+        np.testing.assert_array_equal(subsample.weights, [1., 1.])
+        self.assertEqual(subsample.time, timerange[0])
+        Propagate(subsample, pulse, timerange, dt_save, processes=1)
+        self.assertEqual(subsample.states().shape, (2, 6, 8))
+
+
+
+class TestPulseOptimizer(unittest.TestCase):
+
+    def test_pulse_train(self):
+        """a train of one pulse is the Gaussian pulse and the intensities of several pulses add up"""
+        t = np.linspace(*timerange, 9)
+        np.testing.assert_allclose(PulseTrain(peak_intensity=1e17, FWHM=100e-15)(t), pulse(t))
+        train = PulseTrain(peak_intensity=[1e17, 1e16], FWHM=100e-15, t_peak=[0., 50e-15])
+        np.testing.assert_allclose(Field.amplitude2intensity(train(t)),
+                                   Field.amplitude2intensity(pulse(t)) + Field.amplitude2intensity(
+                                       Field(peak_intensity=1e16, FWHM=100e-15, t_peak=50e-15)(t)))
+        self.assertAlmostEqual(train.rescaled(1e15).peak_intensity() / 1e15, 1.)
+
+    def test_optimize(self):
+        """all candidates are propagated with common initial conditions and evaluated once"""
+        ensemble = Ensemble(4, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=2)
+        optimizer = PulseOptimizer(two_pulses, {'peak_intensity': (1e16, 1e17), 'delay': (0., 100e-15)},
+                                   ensemble, timerange, dt_save, processes=1)
+        best, value = optimizer.run(maxiter=1, popsize=2)
+        # repeated candidates are taken from the evaluated points
+        self.assertLessEqual(len(optimizer.results), optimizer.result.nfev)
+        self.assertEqual(value, max(objective for parameters, objective in optimizer.results.values()))
+        self.assertEqual(optimizer.evaluate([best['peak_intensity'], best['delay']]), value)
+        self.assertEqual(len(ensemble.molecules[0].pos), 1)
+
+    def test_pool(self):
+        """candidates are propagated by the scipy backend within the workers of the pool"""
+        ensemble = Ensemble(2, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=2)
+        optimizer = PulseOptimizer(two_pulses, {'peak_intensity': (1e16, 1e17), 'delay': (0., 100e-15)},
+                                   ensemble, timerange, dt_save, solver={'backend': 'scipy'}, processes=2)
+        best, value = optimizer.run(maxiter=1, popsize=2)
+        self.assertEqual(value, optimizer.evaluate([best['peak_intensity'], best['delay']]))
+
+
+
+class TestAlignmentEvents(unittest.TestCase):
+
+    def test_maximum(self):
+        """alignment maxima located on a coarse grid agree with those of a fine grid"""
+        longer = (-200e-15, 2e-12)
+        events = []
+        for step in (10e-15, 200e-15):
+            np.random.seed(3)
+            ensemble = Ensemble(20, Molecule(I_linear, P_linear, t=longer[0]), T=1., t=longer[0])
+            p = Propagate(ensemble, pulse, longer, step, solver={'backend': 'numpy'},
+                          events=('maximum', 'minimum'))
+            events.append(p.events['maximum'])
+            if step == 10e-15:
+                # the fine grid resolves the maximum itself
+                self.assertLess(abs(events[0][1][0] - cos2theta(ensemble)().max()), 1e-4)
+        np.testing.assert_allclose(events[1][0][0], events[0][0][0], atol=5e-15)
+        np.testing.assert_allclose(events[1][1][0], events[0][1][0], atol=2e-3)
+        with tempfile.TemporaryDirectory() as directory:
+            ensemble._save(os.path.join(directory, 'ensemble.h5'))
+            stored = Ensemble.FromFile(os.path.join(directory, 'ensemble.h5')).events
+        np.testing.assert_array_equal(stored['minimum'][0], p.events['minimum'][0])
+        report = AlignmentEvents.report(p.events)
+        self.assertIn('Alignment maxima', report)
+        self.assertIn('Alignment minima', report)
+
+
+
+class TestFocalVolume(unittest.TestCase):
+
+    def test_bins(self):
+        """intensity bins lie on a fixed grid and carry the volume fractions of the focus"""
+        focus = FocalVolume(30e-6, per_decade=2, radius=30e-6 * np.sqrt(np.log(10) / 2))
+        bins = focus.bins(pulse)
+        intensities, weights = np.array(bins).T
+        self.assertAlmostEqual(weights.sum(), 1.)
+        np.testing.assert_allclose(np.log10(intensities) * 2, np.rint(np.log10(intensities) * 2))
+        # intensities are uniformly distributed in log over one decade for a uniform disk
+        self.assertEqual(len(bins), 3)
+        np.testing.assert_allclose(weights, [0.25, 0.5, 0.25], atol=0.01)
+
+    def test_reuse(self):
+        """scans over the peak intensity reuse the results of shared intensity bins"""
+        ensemble = Ensemble(3, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0])
+        focus = FocalVolume(30e-6, per_decade=2, samples=1000)
+        t, average = focus.propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        propagated = len(focus.results)
+        self.assertEqual(propagated, len(focus.bins(pulse)))
+        focus.propagate(ensemble, pulse.rescaled(10**17.5), timerange, dt_save, solver={'backend': 'numpy'})
+        self.assertEqual(len(focus.results), propagated + 1)
+        self.assertEqual(average.shape, t.shape)
+
+    def test_propagated(self):
+        """bins of a propagated ensemble start from its initial positions, not its last frames"""
+        ensemble = Ensemble(3, Molecule(I_linear, P_linear, t=timerange[0]), T=1., t=timerange[0], seed=5)
+        focus = FocalVolume(30e-6, per_decade=2, samples=1000)
+        t, average = focus.propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        Propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        again = FocalVolume(30e-6, per_decade=2, samples=1000)
+        t_again, average_again = again.propagate(ensemble, pulse, timerange, dt_save, solver={'backend': 'numpy'})
+        np.testing.assert_array_equal(t_again, t)
+        np.testing.assert_allclose(average_again, average)
+
+
+
+class TestJobServer(unittest.TestCase):
+
+    def test_queue(self):
+        """submitted jobs run in order on the server and report their results"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'server.sock')
+            server = subprocess.Popen([sys.executable, '-c', 'from cmiclassirot.server import JobServer; '
+                                       f'JobServer({path!r}, processes=1).serve()'])
+            try:
+                client = Client(path)
+                for i in range(100):
+                    if client.alive():
+                        break
+                    time.sleep(0.1)
+                specification = dict(TestSpecification.specification, solver={'backend': 'numpy'})
+                first = client.submit(specification, os.path.join(directory, 'first.h5'))
+                second = client.submit(specification, os.path.join(directory, 'second.h5'), events=['maximum'])
+                third = client.submit(specification, os.path.join(directory, 'third.h5'))
+                self.assertEqual(client.cancel(third)['state'], 'cancelled')
+                with self.assertRaises(ServerError):
+                    client.submit({'timerange': [0., 1.]}, os.path.join(directory, 'invalid.h5'))
+                result = client.wait(second)
+                self.assertEqual(result['state'], 'finished')
+                self.assertEqual([job['state'] for job in client.status()], ['finished', 'finished', 'cancelled'])
+                self.assertEqual(len(result['result']['observables']['time']), 6)
+                self.assertIn('maximum', result['result']['events'])
+                self.assertFalse(os.path.exists(os.path.join(directory, 'third.h5')))
+                # invalid options are rejected on submission, relative field files are resolved by the client
+                for options in ({'events': ['maxima']}, {'compact': {'quaternions': 'float16'}},
+                                {'chunk_size': 0}):
+                    with self.assertRaises(ServerError):
+                        client.submit(specification, os.path.join(directory, 'invalid.h5'), **options)
+                table = os.path.join(directory, 'field.txt')
+                open(table, 'w').close()
+                client.submit(dict(specification, field={'filename': os.path.relpath(table)}),
+                              os.path.join(directory, 'table.h5'))
+            finally:
+                server.terminate()
+                server.wait()
+
+
+
 if __name__ == '__main__':
     unittest.main()